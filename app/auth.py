@@ -1,44 +1,49 @@
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Optional
-from fastapi import HTTPException, status, Depends, Security
+from fastapi import HTTPException, Request, status, Depends, Security
 from fastapi.security import SecurityScopes, OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.asyncio import Redis
 from jose import JWTError, jwt
 from app.core.jwt_config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
 from pydantic import ValidationError
-import bcrypt
 from app.schemas.token import Token, TokenData
 from app.models.models import User
-from app.dependecies import get_db
+from app.dependecies import get_db, get_redis
+from app.services.user_cache import user_cache
+from app.core.security import password_hasher
 
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/users/token",
 )
 
 
-def get_user(username: str, db) -> User:
+async def get_user(username: str, db: AsyncSession) -> User:
     """
     Get user by username
     :param username:
     :param db:
     :return:
     """
-    user: Optional[User] = db.query(User).filter(User.username == username, User.disabled == False).first()
+    result = await db.execute(select(User).filter(User.username == username, User.disabled == False))
+    user: Optional[User] = result.scalars().first()
     return user
 
 
-def get_user_by_email(email: str, db) -> User:
+async def get_user_by_email(email: str, db: AsyncSession) -> User:
     """
     Get user by email
     :param email:
     :param db:
     :return:
     """
-    user: Optional[User] = db.query(User).filter(User.email == email, User.disabled == False).first()
+    result = await db.execute(select(User).filter(User.email == email, User.disabled == False))
+    user: Optional[User] = result.scalars().first()
     return user
 
 
-def authenticate_user(username: str, password: str, db) -> User:
+async def authenticate_user(username: str, password: str, db: AsyncSession) -> User:
     """
     Authenticate user
     :param username:
@@ -46,58 +51,44 @@ def authenticate_user(username: str, password: str, db) -> User:
     :param db:
     :return:
     """
-    user = get_user(username, db)
+    user = await get_user(username, db)
     if not user or user.disabled:
         return False
-    if not verify_password(password, user.password):
+    if not await password_hasher.verify(password, user.password):
         return False
     return user
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
-                           db: Session = Depends(get_db, use_cache=True)) -> User:
+async def get_current_user(request: Request,
+                           token: Annotated[str, Depends(oauth2_scheme)],
+                           db: AsyncSession = Depends(get_db, use_cache=True),
+                           redis: Redis = Depends(get_redis)) -> User:
     """
-    Get current user from token
+    Get current user from token. Token verified by AuthMiddleware is not decoded again.
+    User is taken from cache, DB is queried only on cache miss
+    :param request:
     :param token:
     :param db:
+    :param redis:
     :return:
     """
+    username: Optional[str] = getattr(request.state, "principal", None)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
+        if username is None:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Could not validate credentials")
         token_data = TokenData(username=username)
     except (JWTError, ValidationError):
         raise HTTPException(status_code=401, detail="Could not validate credentials")
-    user = get_user(username=token_data.username, db=db)
+    user = await user_cache.get(redis, token_data.username)
+    if user is None:
+        user = await get_user(username=token_data.username, db=db)
+        if user is not None:
+            await user_cache.set(redis, user)
     if user is None:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
     if user.disabled:
         raise HTTPException(status_code=403, detail="Forbidden: Inactive user")
     return user
-
-
-def verify_password(plain_password, hashed_password) -> bool:
-    """
-    Verify password with hashed password
-    :param plain_password:
-    :param hashed_password:
-    :return:
-    """
-    password_byte_enc = plain_password.encode('utf-8')
-    hashed_password_byte_enc = hashed_password.encode('utf-8')
-    return bcrypt.checkpw(password=password_byte_enc, hashed_password=hashed_password_byte_enc)
-
-
-def get_password_hash(password) -> str:
-    """
-    Get password hash
-    :param password:
-    :return:
-    """
-    pwd_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password=pwd_bytes, salt=salt)
-    string_password = hashed_password.decode('utf8')
-    return string_password
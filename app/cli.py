@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, TextIO
+
+from pydantic import ValidationError
+from redis.asyncio import Redis
+
+from app.proxy_pool import get_proxy_pool
+from app.rate_limiter import RateLimiter
+from app.schemas.search_form import SearchForm
+from app.search_engine import SearchEngine
+from app.search_log import logger, setup_logging, stop_logging
+from app.services.redis_client import RedisClient
+
+# User id of batch searches in Redis keys
+BATCH_USER_ID = "batch"
+# Redis set with checkpoints of batch searches. Batch searches are resumed by the batch runner, not by web workers
+BATCH_CHECKPOINTS_KEY = "batch_search_checkpoints"
+# Separators of query lists and of queries in the list in the input line
+LISTS_SEPARATOR = "|"
+QUERIES_SEPARATOR = ","
+
+
+@dataclass
+class BatchJob:
+    """
+    One search of the batch: line of the input and its query lists
+    """
+    line: int
+    form: SearchForm
+
+    @property
+    def search_uuid(self) -> str:
+        """
+        Stable id of the search, so the interrupted run continues the same searches
+        :return:
+        """
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{self.line}:{self.form.fingerprint}"))
+
+
+def parse_line(text: str) -> Optional[SearchForm]:
+    """
+    Parse line of the input: "query1, query2 | query3" or JSON array [["query1", "query2"], ["query3"]].
+    Returns None for empty line or comment. Raises ValueError for invalid line
+    :param text:
+    :return:
+    """
+    text = text.strip()
+    if not text or text.startswith("#"):
+        return None
+    if text.startswith("["):
+        lists = json.loads(text)
+    else:
+        lists = [[query for query in part.split(QUERIES_SEPARATOR) if query.strip()]
+                 for part in text.split(LISTS_SEPARATOR)]
+    if len(lists) != 2 or not all(lists):
+        raise ValueError("Two non-empty lists of queries are expected")
+    try:
+        return SearchForm(names_list1=lists[0], names_list2=lists[1])
+    except ValidationError as e:
+        raise ValueError(str(e)) from e
+
+
+def read_jobs(stream: TextIO) -> list[BatchJob]:
+    """
+    Read searches from the input. Invalid lines are reported and skipped
+    :param stream:
+    :return:
+    """
+    jobs = []
+    for line, text in enumerate(stream, start=1):
+        try:
+            form = parse_line(text)
+        except ValueError as e:
+            logger.warning(f"Line {line} is skipped: {e}")
+            continue
+        if form:
+            jobs.append(BatchJob(line, form))
+    return jobs
+
+
+def read_checkpoint(path: Optional[str]) -> set[str]:
+    """
+    Returns ids of searches completed by previous runs
+    :param path:
+    :return:
+    """
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class BatchRunner:
+    """
+    Runs searches of the batch with limited number of concurrent searches and shared rate limit of requests.
+    Result of each search is written to NDJSON output as soon as the search is finished,
+    id of the search is appended to checkpoint file after its result is written
+    """
+
+    def __init__(self, redis: Redis, output: TextIO, checkpoint: Optional[TextIO] = None,
+                 concurrency: int = 2, rate: float = 0.5, enable_pause: Optional[bool] = None):
+        """
+        :param redis:
+        :param output: NDJSON output
+        :param checkpoint: file for ids of completed searches
+        :param concurrency: max number of concurrent searches
+        :param rate: max number of requests to the website per second for all searches, 0 for no limit
+        :param enable_pause: override of enable_pause setting
+        """
+        self.redis = redis
+        self.output = output
+        self.checkpoint = checkpoint
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(rate, burst=concurrency)
+        self.enable_pause = enable_pause
+        self.stats = {
+            "completed": 0,
+            "failed": 0,
+            "skipped": 0,
+        }
+
+    async def run(self, jobs: list[BatchJob], completed: set[str] = frozenset()) -> dict:
+        """
+        Run searches which are not completed yet
+        :param jobs:
+        :param completed: ids of completed searches
+        :return: statistics of the run
+        """
+        pending = [job for job in jobs if job.search_uuid not in completed]
+        self.stats["skipped"] = len(jobs) - len(pending)
+        await asyncio.gather(*(self._run_job(job) for job in pending))
+        return {**self.stats, **self.rate_limiter.get_metrics()}
+
+    async def _run_job(self, job: BatchJob):
+        async with self.semaphore:
+            engine = SearchEngine(BATCH_USER_ID, job.search_uuid, self.redis)
+            engine.fingerprint = job.form.fingerprint
+            engine.checkpoints_key = BATCH_CHECKPOINTS_KEY
+            engine.rate_limiter = self.rate_limiter
+            if self.enable_pause is not None:
+                engine.enable_pause = self.enable_pause
+            record = {
+                "line": job.line,
+                "search_uuid": job.search_uuid,
+                "queries_list": [list(queries) for queries in job.form.queries_list],
+            }
+            started_at = time.monotonic()
+            try:
+                # Search interrupted by previous run continues from its checkpoint in Redis
+                results = await engine.intersection_in_global_search(job.form.queries_list, resume=True)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Search on line {job.line} failed: {e}", extra={"search": job.search_uuid[-4:]})
+                self._write(record | {"error": str(e)})
+                return
+            record |= {
+                "finished_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "duration": round(time.monotonic() - started_at, 1),
+                "stores_count": len(results),
+                "results": results,
+            }
+            search_key = f"{BATCH_USER_ID}:{job.search_uuid}"
+            await self.redis.delete(f"{search_key}:messages", f"{search_key}:results", f"{search_key}:results_index")
+            if engine.failed_queries:
+                # Results are incomplete, the search is repeated by the next run
+                self.stats["failed"] += 1
+                self._write(record | {"failed_queries": engine.failed_queries})
+                return
+            self.stats["completed"] += 1
+            self._write(record)
+            if self.checkpoint:
+                self.checkpoint.write(f"{job.search_uuid}\n")
+                self.checkpoint.flush()
+
+    def _write(self, record: dict):
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+
+def parse_args(args: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.cli",
+        description="Run batch of searches without web interface. Each input line is one search: "
+                    f'queries of two lists separated by "{LISTS_SEPARATOR}", '
+                    f'queries in the list separated by "{QUERIES_SEPARATOR}", e.g. "7260ac, 7260 ac | DW5823e", '
+                    'or JSON array [["7260ac"], ["DW5823e"]]',
+    )
+    parser.add_argument("input", nargs="?", default="-", help="file with searches, stdin by default")
+    parser.add_argument("-o", "--output", default="-", help="NDJSON file for results, stdout by default")
+    parser.add_argument("--checkpoint", help="file with completed searches for resuming interrupted run, "
+                                             "<output>.checkpoint by default")
+    parser.add_argument("-c", "--concurrency", type=int, default=2, help="max number of concurrent searches")
+    parser.add_argument("-r", "--rate", type=float, default=0.5,
+                        help="max requests per second to the website for all searches, 0 for no limit")
+    parser.add_argument("--no-pause", action="store_true",
+                        help="disable random pauses between requests, only rate limit is applied")
+    return parser.parse_args(args)
+
+
+async def run_batch(args: argparse.Namespace) -> int:
+    """
+    Run batch of searches from command line arguments
+    :param args:
+    :return: exit code
+    """
+    if args.input == "-":
+        jobs = read_jobs(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            jobs = read_jobs(f)
+    checkpoint_path = args.checkpoint or (f"{args.output}.checkpoint" if args.output != "-" else None)
+    completed = read_checkpoint(checkpoint_path)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8") if checkpoint_path else None
+    redis = RedisClient().get_redis()
+    runner = BatchRunner(redis, output, checkpoint, concurrency=args.concurrency, rate=args.rate,
+                         enable_pause=False if args.no_pause else None)
+    try:
+        stats = await runner.run(jobs, completed)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if checkpoint:
+            checkpoint.close()
+        await get_proxy_pool().close()
+        await RedisClient().close()
+    logger.info(f"Batch finished: {stats}")
+    return 1 if stats["failed"] else 0
+
+
+def main():
+    args = parse_args()
+    setup_logging()
+    try:
+        exit_code = asyncio.run(run_batch(args))
+    except KeyboardInterrupt:
+        logger.warning("Batch interrupted, run the same command to continue")
+        exit_code = 130
+    finally:
+        stop_logging()
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import bcrypt
+from fastapi import HTTPException
+
+# Number of threads for password hashing and max number of operations waiting for a free thread
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', 32))
+
+
+def verify_password(plain_password, hashed_password) -> bool:
+    """
+    Verify password with hashed password
+    :param plain_password:
+    :param hashed_password:
+    :return:
+    """
+    password_byte_enc = plain_password.encode('utf-8')
+    hashed_password_byte_enc = hashed_password.encode('utf-8')
+    return bcrypt.checkpw(password=password_byte_enc, hashed_password=hashed_password_byte_enc)
+
+
+def get_password_hash(password) -> str:
+    """
+    Get password hash
+    :param password:
+    :return:
+    """
+    pwd_bytes = password.encode('utf-8')
+    salt = bcrypt.gensalt()
+    hashed_password = bcrypt.hashpw(password=pwd_bytes, salt=salt)
+    string_password = hashed_password.decode('utf8')
+    return string_password
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt operations in dedicated bounded thread pool, so they don't block the event loop.
+    When all threads are busy and the queue is full, new operations are rejected with 503 error
+    """
+
+    def __init__(self, max_workers: int = PASSWORD_HASH_WORKERS, queue_size: int = PASSWORD_HASH_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._pending = 0
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "runs": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "run_time_total": 0.0,
+        }
+
+    async def _run(self, func: Callable, *args):
+        """
+        Run function in thread pool and collect timing of the operation.
+        Operation is counted as pending until it is finished or cancelled in the pool, so cancelled requests
+        don't free a place in the queue while bcrypt is still running for them
+        :param func:
+        :param args:
+        :return:
+        """
+        with self._stats_lock:
+            if self._pending >= self.max_workers + self.queue_size:
+                self.stats["rejected"] += 1
+                raise HTTPException(status_code=503, detail="Server is busy, try again later")
+            self._pending += 1
+
+        submitted_at = time.perf_counter()
+
+        def timed_call():
+            started_at = time.perf_counter()
+            try:
+                return func(*args)
+            except Exception:
+                with self._stats_lock:
+                    self.stats["failed"] += 1
+                raise
+            finally:
+                wait_time = started_at - submitted_at
+                with self._stats_lock:
+                    self.stats["runs"] += 1
+                    self.stats["wait_time_total"] += wait_time
+                    self.stats["wait_time_max"] = max(self.stats["wait_time_max"], wait_time)
+                    self.stats["run_time_total"] += time.perf_counter() - started_at
+
+        def on_done(_):
+            with self._stats_lock:
+                self._pending -= 1
+
+        future = self._executor.submit(timed_call)
+        future.add_done_callback(on_done)
+        result = await asyncio.wrap_future(future)
+        self.stats["completed"] += 1
+        return result
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """
+        Verify password with hashed password in thread pool
+        :param plain_password:
+        :param hashed_password:
+        :return:
+        """
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        """
+        Get password hash in thread pool
+        :param password:
+        :return:
+        """
+        return await self._run(get_password_hash, password)
+
+    def get_metrics(self) -> dict:
+        """
+        Returns state of the pool and timing of operations in seconds. Completed operations returned the result
+        to the caller, timing includes all operations which were run by the pool
+        :return:
+        """
+        runs = self.stats["runs"]
+        return {
+            "workers": self.max_workers,
+            "queue_size": self.queue_size,
+            "pending": self._pending,
+            "completed": self.stats["completed"],
+            "failed": self.stats["failed"],
+            "rejected": self.stats["rejected"],
+            "wait_time_avg": round(self.stats["wait_time_total"] / runs, 4) if runs else 0.0,
+            "wait_time_max": round(self.stats["wait_time_max"], 4),
+            "run_time_avg": round(self.stats["run_time_total"] / runs, 4) if runs else 0.0,
+        }
+
+
+password_hasher = PasswordHasher()
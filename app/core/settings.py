@@ -0,0 +1,166 @@
+import asyncio
+import configparser
+import dataclasses
+import os
+import signal
+from dataclasses import dataclass
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_FILE = os.path.join(BASE_DIR, 'config.ini')
+# Prefix of environment variables which override values from config file, e.g. SEARCH_MAX_PAGE=4
+ENV_PREFIX = "SEARCH_"
+# Interval in seconds for checking modification of config file
+SETTINGS_WATCH_INTERVAL = 5
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Search settings from [settings] section of config file. Values can be overridden by environment variables
+    """
+    # Base url of the website with global search results
+    base_url: str = 'https://www.aliexpress.com/w/wholesale'
+    # Max number of result pages for parsing. After 8 pages results are often  not relevant
+    max_page: int = 6
+    # Max number of pages without new products in search result
+    max_zero_pages: int = 2
+    # Rechecking the product name for compliance with the search query
+    filter_result: bool = True
+    # Enable pause between requests
+    enable_pause: bool = True
+    # Max pause time in seconds
+    max_pause_time: int = 5
+    # Enable save results to JSON file
+    enable_save_to_json: bool = False
+    # Stop paging when the last page gives too few new relevant products or too many already seen products
+    adaptive_depth: bool = True
+    # Number of pages which are always processed before adaptive stop
+    adaptive_min_pages: int = 2
+    # Min number of new relevant products on the page for processing next page
+    min_page_yield: int = 3
+    # Max share of relevant products on the page which were already found on previous pages
+    max_duplicate_rate: float = 0.8
+    # Comma separated list of HTTP or SOCKS proxies for requests to the website, "direct" for connection without proxy
+    proxies: str = ""
+    # Base quarantine time in seconds for proxy with repeated errors or blocks
+    proxy_quarantine_time: int = 60
+    # Number of sessions with own cookies which are used for requests in turn
+    session_pool_size: int = 4
+    # Number of challenges (captcha or block) in row after which the session is replaced by new one
+    session_max_challenges: int = 2
+    # Url of search page in the store
+    store_search_url: str = 'https://www.aliexpress.com/store/{store_id}/search'
+    # Max number of candidate stores after the first product list which are checked by search in each store
+    # instead of global search for remaining lists. 0 to always use global search
+    store_verification_max_candidates: int = 5
+    # Max memory in MB which parsing of one page may take in a search, the search is stopped when it is exceeded.
+    # Measured with tracemalloc. 0 to disable
+    search_memory_budget: int = 64
+    # Level of search log in console: "info" for events shown to the user, "debug" for all events
+    log_level: str = "info"
+    # Max number of requests per second for all scheduled searches of the watchlist
+    watchlist_rate: float = 0.2
+    # Max number of scheduled searches which run at once
+    watchlist_concurrency: int = 1
+    # Local hours "start-end" for daily scheduled searches, e.g. 1-6. Empty to run them at any time
+    off_peak_hours: str = "1-6"
+    # OTLP/HTTP endpoint of collector for traces of searches, e.g. http://localhost:4318/v1/traces. Empty to disable
+    otlp_endpoint: str = ""
+    # Max age in seconds of finished search results which are reused for identical searches. 0 to disable
+    result_reuse_max_age: int = 600
+
+
+def _convert(value: str, value_type: type):
+    """
+    Convert value from config file or environment variable into type of the setting
+    :param value:
+    :param value_type:
+    :return:
+    """
+    if value_type is bool:
+        if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError(f"Not a boolean: {value}")
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    return value_type(value)
+
+
+def load_settings(config_file: str = CONFIG_FILE) -> Settings:
+    """
+    Read settings from config file and environment variables. Raises ValueError for invalid values
+    :param config_file:
+    :return:
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    section = dict(config['settings']) if config.has_section('settings') else {}
+    values = {}
+    for field in dataclasses.fields(Settings):
+        value = os.getenv(f"{ENV_PREFIX}{field.name.upper()}", section.get(field.name))
+        if value is not None:
+            values[field.name] = _convert(value, field.type)
+    return Settings(**values)
+
+
+_settings = load_settings()
+_config_mtime = os.path.getmtime(CONFIG_FILE) if os.path.exists(CONFIG_FILE) else None
+
+
+def get_settings() -> Settings:
+    """
+    Returns current settings. Settings are loaded once and replaced by reload_settings
+    :return:
+    """
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """
+    Reload settings from config file and environment variables. Running searches use new values from next access.
+    Invalid config keeps previous settings
+    :return:
+    """
+    global _settings
+    try:
+        new_settings = load_settings()
+    except ValueError as e:
+        print(f"Failed to reload settings: {e}")
+        return _settings
+    changes = {
+        field.name: getattr(new_settings, field.name)
+        for field in dataclasses.fields(Settings)
+        if getattr(new_settings, field.name) != getattr(_settings, field.name)
+    }
+    if changes:
+        print(f"Settings reloaded: {changes}")
+    _settings = new_settings
+    return _settings
+
+
+async def watch_settings(interval: int = SETTINGS_WATCH_INTERVAL):
+    """
+    Reload settings when config file is modified. Starts as task in lifespan
+    :param interval:
+    :return:
+    """
+    global _config_mtime
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.path.getmtime(CONFIG_FILE)
+        except OSError:
+            continue
+        if mtime != _config_mtime:
+            _config_mtime = mtime
+            reload_settings()
+
+
+def install_reload_signal_handler():
+    """
+    Reload settings by SIGHUP signal, e.g. "kill -HUP <pid>". Must be called from running event loop
+    :return:
+    """
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_settings)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        # Signal handlers are not supported on Windows
+        pass
@@ -11,8 +11,9 @@ def get_redis():
     return redis_client.get_redis()
 
 
-def get_db():
+async def get_db():
     """
-    Wrapper for FastAPI dependency to get database connection for unified usage of dependencies
+    Wrapper for FastAPI dependency to get async database session for unified usage of dependencies
     """
-    yield from database_get_db()
\ No newline at end of file
+    async for db in database_get_db():
+        yield db
\ No newline at end of file
@@ -9,10 +9,23 @@ from starlette.datastructures import State
 from app.resources import static_files, templates
 from app.dependecies import get_redis
 from app.search_engine import SearchEngine
-from app.routers import history, search, users
-from app.middleware import refresh_token_middleware, add_token_to_header_middleware
+from app.routers import history, metrics, search, status, users, watchlist
+from app.routers.search import resume_searches
+from app.middleware import AuthMiddleware
 from app.models.models import User
 from app.auth import get_current_user
+from app.services.user_cache import user_cache
+from app.core.settings import watch_settings, install_reload_signal_handler
+from app.search_log import logger, setup_logging, stop_logging
+from app.metrics import active_searches as active_searches_gauge, monitor_event_loop_lag
+from app.services.database import SessionLocal
+from app.watchlist_scheduler import watchlist_scheduler
+from app.tracing import otlp_exporter
+
+# Interval in seconds for checking searches to resume. Must be less than CHECKPOINT_LEASE_TIME
+RESUME_SEARCHES_INTERVAL = 20
+# Interval in seconds for checking watched searches which are due
+WATCHLIST_CHECK_INTERVAL = 60
 
 
 async def scheduled_redis_clear_task():
@@ -26,14 +39,56 @@ async def scheduled_redis_clear_task():
         await redis.delete_incomplete_searches()
 
 
+async def scheduled_resume_searches_task():
+    """
+    Scheduled task to resume searches interrupted by restart of the server or another worker
+    :return:
+    """
+    redis = get_redis()
+    while True:
+        try:
+            await resume_searches(app.state.active_searches, redis)
+        except Exception as e:
+            logger.warning(f"Failed to resume searches: {e}")
+        await asyncio.sleep(RESUME_SEARCHES_INTERVAL)
+
+
+async def scheduled_watchlist_task():
+    """
+    Scheduled task to repeat watched searches which are due
+    :return:
+    """
+    redis = get_redis()
+    while True:
+        try:
+            await watchlist_scheduler.run_due(redis, SessionLocal, len(app.state.active_searches))
+        except Exception as e:
+            logger.warning(f"Failed to run watched searches: {e}")
+        await asyncio.sleep(WATCHLIST_CHECK_INTERVAL)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_logging()
     task = asyncio.create_task(scheduled_redis_clear_task())
+    resume_task = asyncio.create_task(scheduled_resume_searches_task())
+    user_cache_task = asyncio.create_task(user_cache.listen_invalidations(get_redis()))
+    settings_task = asyncio.create_task(watch_settings())
+    watchlist_task = asyncio.create_task(scheduled_watchlist_task())
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    install_reload_signal_handler()
     try:
         yield
     finally:
         task.cancel()
+        resume_task.cancel()
+        user_cache_task.cancel()
+        settings_task.cancel()
+        watchlist_task.cancel()
+        loop_lag_task.cancel()
         await get_redis().close()
+        await otlp_exporter.close()
+        stop_logging()
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
@@ -41,14 +96,18 @@ if not app.state:
     app.state = State()
 active_searches: dict[str, SearchEngine] = {}
 app.state.active_searches = active_searches
+# Identical searches share one engine
+active_searches_gauge.set_function(lambda: len({id(se) for se in active_searches.values()}))
 
 app.mount("/static", static_files, name="static")
 app.include_router(search.router, tags=["search"])
 app.include_router(history.router, tags=["history"])
 app.include_router(users.router, tags=["users"])
+app.include_router(status.router, tags=["status"])
+app.include_router(watchlist.router, tags=["watchlist"])
+app.include_router(metrics.router, tags=["metrics"])
 
-app.middleware('http')(refresh_token_middleware)
-app.middleware('http')(add_token_to_header_middleware)
+app.add_middleware(AuthMiddleware)
 
 
 @app.get("/", response_class=HTMLResponse)
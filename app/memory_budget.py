@@ -0,0 +1,85 @@
+import tracemalloc
+
+# Parsing is measured for every n-th page of a search, starting from the first one.
+# Tracing slows down allocations, so pages between samples are parsed without it
+SAMPLE_INTERVAL = 4
+
+
+class MemoryBudget:
+    """
+    Peak memory of page parsing for one search, sampled with tracemalloc.
+    Tracing is started only for the measured section, so there is no overhead between samples.
+    Parsing of the page is synchronous, so allocations in the section belong to one search
+    """
+
+    def __init__(self):
+        self.peak = 0
+        self.exceeded = False
+        self._limit = 0
+        self._sections = 0
+        self._owns_tracing = False
+        self._base = 0
+        self._outer_peak = 0
+
+    def start(self, limit: int):
+        """
+        Start measuring if the section is sampled.
+        If tracemalloc is already tracing, e.g. started by profiler, it is not stopped after measuring
+        and its peak is kept
+        :param limit: budget in bytes, 0 to skip measuring
+        :return:
+        """
+        self._sections += 1
+        self._limit = limit if (self._sections - 1) % SAMPLE_INTERVAL == 0 else 0
+        if not self._limit:
+            return
+        self._owns_tracing = not tracemalloc.is_tracing()
+        if self._owns_tracing:
+            tracemalloc.start()
+        # Peak of the outer tracing is not reset, it is compared with the peak after the section
+        self._base, self._outer_peak = tracemalloc.get_traced_memory()
+
+    def stop(self) -> int:
+        """
+        Stop measuring and check peak of the section against the limit.
+        If tracing is not owned and the section stays below the earlier peak of the outer tracing,
+        the peak of the section can't be seen, memory still allocated at the end of the section is used instead
+        :return: peak in bytes allocated in the section, 0 if the section is not sampled
+        """
+        if not self._limit:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        if peak <= self._outer_peak and not self._owns_tracing:
+            peak = current
+        peak = max(0, peak - self._base)
+        if self._owns_tracing:
+            tracemalloc.stop()
+        self.peak = max(self.peak, peak)
+        memory_stats.record(peak, exceeded=peak > self._limit)
+        if peak > self._limit:
+            self.exceeded = True
+        return peak
+
+
+class MemoryStats:
+    """
+    Peak memory of page parsing over all searches
+    """
+
+    def __init__(self):
+        self.stats = {
+            "measured_pages": 0,
+            "max_peak": 0,
+            "budget_exceeded": 0,
+        }
+
+    def record(self, peak: int, exceeded: bool = False):
+        self.stats["measured_pages"] += 1
+        self.stats["max_peak"] = max(self.stats["max_peak"], peak)
+        self.stats["budget_exceeded"] += exceeded
+
+    def get_metrics(self) -> dict:
+        return dict(self.stats)
+
+
+memory_stats = MemoryStats()
@@ -0,0 +1,155 @@
+import asyncio
+import re
+import secrets
+import time
+from typing import Optional
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, GCCollector, ProcessCollector
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.requests import Request
+
+# Registry of the application metrics, exposed at /metrics
+REGISTRY = CollectorRegistry()
+ProcessCollector(registry=REGISTRY)
+GCCollector(registry=REGISTRY)
+
+# Buckets of request latency in seconds: requests to the website take from tens of milliseconds
+# to the timeout, calls to Redis and the database take from fractions of millisecond
+FETCH_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+PARSE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+CALL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# Interval in seconds between checks of event loop lag
+LOOP_LAG_INTERVAL = 1
+# Clients which may scrape metrics without token
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+# Fields of /status metrics which are cumulative totals of the worker, they are exported as counters.
+# Other numeric fields are point-in-time values, e.g. size of the pool or latency, and are exported as gauges
+STATUS_COUNTER_FIELDS = {
+    "connects", "checkouts", "checkins", "invalidations", "local_hits", "redis_hits", "misses",
+    "completed", "failed", "rejected", "requests", "errors", "blocks", "bytes_downloaded",
+    "leases", "created", "retired", "challenges", "measured_pages", "budget_exceeded",
+    "skipped", "runs", "diffs", "wait_time", "exported",
+}
+# Sections of /status metrics where all fields are totals, e.g. numbers of responses by class
+STATUS_COUNTER_SECTIONS = {"response_classes"}
+
+page_fetch_seconds = Histogram(
+    "alisearch_page_fetch_seconds",
+    "Time of request of the search page to the website by class of the response",
+    ["response_class"], buckets=FETCH_BUCKETS, registry=REGISTRY,
+)
+parse_stage_seconds = Histogram(
+    "alisearch_parse_stage_seconds",
+    "Time of the stages of search page parsing",
+    ["stage"], buckets=PARSE_BUCKETS, registry=REGISTRY,
+)
+parse_errors = Counter(
+    "alisearch_parse_errors_total",
+    "Pages which were downloaded but can't be parsed, by reason",
+    ["reason"], registry=REGISTRY,
+)
+products_per_page = Histogram(
+    "alisearch_products_per_page",
+    "Products on the search page before relevance filter",
+    buckets=(0, 1, 5, 10, 20, 30, 40, 50, 60, 80), registry=REGISTRY,
+)
+relevance_ratio = Histogram(
+    "alisearch_relevance_ratio",
+    "Share of products on the page which passed relevance filter",
+    buckets=(0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1), registry=REGISTRY,
+)
+page_retries = Counter(
+    "alisearch_page_retries_total",
+    "Repeated requests of search pages after failed attempt",
+    registry=REGISTRY,
+)
+pause_seconds = Counter(
+    "alisearch_pause_seconds_total",
+    "Time of pauses between requests and back offs",
+    ["kind"], registry=REGISTRY,
+)
+redis_call_seconds = Histogram(
+    "alisearch_redis_call_seconds",
+    "Time of Redis commands",
+    ["command"], buckets=CALL_BUCKETS, registry=REGISTRY,
+)
+db_query_seconds = Histogram(
+    "alisearch_db_query_seconds",
+    "Time of database queries",
+    buckets=CALL_BUCKETS, registry=REGISTRY,
+)
+active_searches = Gauge(
+    "alisearch_active_searches",
+    "Searches running in this worker",
+    registry=REGISTRY,
+)
+event_loop_lag_seconds = Histogram(
+    "alisearch_event_loop_lag_seconds",
+    "Delay of the event loop in waking up a sleeping task",
+    buckets=CALL_BUCKETS, registry=REGISTRY,
+)
+
+
+class StatusCollector:
+    """
+    Exposes numeric values of the /status metrics as "alisearch_<section>_<name>": totals as counters
+    (see STATUS_COUNTER_FIELDS) and states of pools as gauges. Lists of items, e.g. metrics of proxies,
+    are labeled by string values of the items. Values are read on each scrape
+    """
+
+    def __init__(self, get_status):
+        """
+        :param get_status: function which returns /status metrics {section: {name: value}}
+        """
+        self.get_status = get_status
+
+    def collect(self):
+        families = {}
+        self._collect_values(families, "alisearch", self.get_status(), {})
+        yield from families.values()
+
+    def _collect_values(self, families: dict, prefix: str, values, labels: dict, counters: bool = False):
+        if isinstance(values, list):
+            for item in values:
+                if isinstance(item, dict):
+                    item_labels = {name: value for name, value in item.items() if isinstance(value, str)}
+                    self._collect_values(families, prefix, item, labels | item_labels, counters)
+            return
+        for name, value in values.items():
+            metric_name = re.sub(r"\W", "_", f"{prefix}_{name}")
+            if isinstance(value, (dict, list)):
+                self._collect_values(families, metric_name, value, labels, name in STATUS_COUNTER_SECTIONS)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                if metric_name not in families:
+                    family_class = (CounterMetricFamily if counters or name in STATUS_COUNTER_FIELDS
+                                    else GaugeMetricFamily)
+                    families[metric_name] = family_class(metric_name, f"Value of {name} from /status",
+                                                         labels=list(labels))
+                families[metric_name].add_metric(list(labels.values()), value)
+
+
+def is_metrics_request_allowed(request: Request, token: Optional[str]) -> bool:
+    """
+    Checks bearer token of the scrape. Without token only requests from the same host are allowed,
+    because metrics include states of the services which are shown only to logged-in users at /status
+    :param request:
+    :param token: expected token
+    :return:
+    """
+    if token:
+        authorization = request.headers.get("authorization", "")
+        return secrets.compare_digest(authorization, f"Bearer {token}")
+    return request.client is not None and request.client.host in LOCAL_HOSTS
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """
+    Task which measures how late the event loop wakes it up. Lag grows when the loop is blocked
+    by synchronous work, e.g. parsing of big pages
+    :param interval:
+    :return:
+    """
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - started_at - interval))
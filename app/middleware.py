@@ -1,46 +1,92 @@
-import uuid
-
-from fastapi import Request, HTTPException
 from datetime import timedelta
-from jose import ExpiredSignatureError
+from http.cookies import SimpleCookie
+
+from jose import ExpiredSignatureError, JWTError, jwt
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.jwt_config import ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
+from app.core.jwt import create_access_token
+
+
+def decode_username(token: str) -> str | None:
+    """
+    Returns username from token or None if token has no username.
+    Raises ExpiredSignatureError for expired token and JWTError for invalid token
+    :param token:
+    :return:
+    """
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    return payload.get("sub")
+
 
-from app.core.jwt_config import ACCESS_TOKEN_EXPIRE_MINUTES
-from app.core.jwt import verify_token, create_access_token
+class AuthMiddleware:
+    """
+    Pure ASGI middleware for authentication by tokens in cookies.
+    Token is decoded once per request. Verified username is saved to request.state.principal
+    and access token is added to Authorization header for OAuth2 dependency.
+    Expired or missing access token is refreshed by refresh token and new access token is set to cookie
+    """
 
+    def __init__(self, app: ASGIApp, exclude_refresh_paths: tuple = ("/", "/users/login", "/users/register")):
+        self.app = app
+        self.exclude_refresh_paths = exclude_refresh_paths
 
-async def refresh_token_middleware(request: Request, call_next):
-    if request.url.path in ["/", "/users/login", "/users/register"]:
-        return await call_next(request)
-    try:
-        access_token = request.cookies.get("access_token")
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        cookies = {}
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                cookies = cookie_parser(value.decode("latin-1"))
+                break
+
+        access_token = cookies.get("access_token")
+        new_access_token = None
+        username = None
+        expired = access_token is None
         if access_token:
-            verify_token(access_token)
-    except ExpiredSignatureError:
-        refresh_token = request.cookies.get("refresh_token")
-        if refresh_token:
-            username = verify_token(refresh_token)
-            if not username:
-                raise HTTPException(status_code=401, detail="Invalid refresh token")
-            new_access_token = create_access_token({"sub": username}, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-            # request = Request(scope=request.scope, receive=request.receive)
-            request._cookies["access_token"] = new_access_token
-
-            response = await call_next(request)
-
-            response.set_cookie("access_token", new_access_token, httponly=True)
-            return response
-        else:
-            raise HTTPException(status_code=401, detail="Missing refresh token") from None
-    response = await call_next(request)
-    return response
-
-
-async def add_token_to_header_middleware(request: Request, call_next):
-    access_token = request.cookies.get("access_token")
-    if access_token:
-        access_token = f"Bearer {access_token}"
-        request.headers.__dict__["_list"].append((b"authorization", access_token.encode()))
-    response = await call_next(request)
-    return response
+            try:
+                username = decode_username(access_token)
+            except ExpiredSignatureError:
+                expired = True
+            except JWTError:
+                pass
+
+        refresh_token = cookies.get("refresh_token")
+        if expired and refresh_token and scope["path"] not in self.exclude_refresh_paths:
+            try:
+                username = decode_username(refresh_token)
+            except JWTError:
+                username = None
+            if username:
+                new_access_token = create_access_token({"sub": username},
+                                                       timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+                access_token = new_access_token
+
+        if username:
+            scope.setdefault("state", {})["principal"] = username
+            headers = [(name, value) for name, value in scope["headers"] if name != b"authorization"]
+            headers.append((b"authorization", f"Bearer {access_token}".encode("latin-1")))
+            scope = {**scope, "headers": headers}
+
+        if new_access_token is None:
+            await self.app(scope, receive, send)
+            return
 
+        async def send_with_cookie(message: Message):
+            if message["type"] == "http.response.start":
+                cookie = SimpleCookie()
+                cookie["access_token"] = new_access_token
+                cookie["access_token"]["httponly"] = True
+                cookie["access_token"]["max-age"] = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+                cookie["access_token"]["path"] = "/"
+                cookie["access_token"]["samesite"] = "lax"
+                headers = list(message.get("headers", []))
+                headers.append((b"set-cookie", cookie.output(header="").strip().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
 
+        await self.app(scope, receive, send_with_cookie)
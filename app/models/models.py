@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, func
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Boolean, ForeignKey, Index, LargeBinary, func
 from sqlalchemy.dialects.postgresql import ARRAY, JSON, TIMESTAMP
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from app.services.base import Base
 
 
@@ -24,8 +24,108 @@ class Search(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     names_list1 = Column(ARRAY(String), nullable=False)
     names_list2 = Column(ARRAY(String), nullable=False)
-    messages = Column(ARRAY(String))
-    results = Column(JSON)
+    # Columns of searches saved by previous versions. Not loaded until requested
+    messages = deferred(Column(ARRAY(String)))
+    results = deferred(Column(JSON))
+    # Message log as zlib compressed JSON list
+    messages_compressed = deferred(Column(LargeBinary))
+    # Timeline of the search stages as zlib compressed JSON, see app.tracing
+    trace_compressed = deferred(Column(LargeBinary))
+    # Number of stores in results, calculated when search is saved
+    results_count = Column(Integer, nullable=False, server_default='0')
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
-    user = relationship('User', back_populates='searches')
\ No newline at end of file
+    user = relationship('User', back_populates='searches')
+    stores = relationship('SearchStore', back_populates='search', cascade='all, delete-orphan', passive_deletes=True)
+
+    __table_args__ = (
+        # Keyset pagination of the user history
+        Index('ix_searches_user_id_created_at_id', user_id, created_at.desc(), id.desc()),
+    )
+
+
+class SearchStore(Base):
+    """
+    Store found by saved search
+    """
+    __tablename__ = 'search_stores'
+
+    id = Column(Integer, primary_key=True)
+    search_id = Column(Integer, ForeignKey('searches.id', ondelete='CASCADE'), nullable=False, index=True)
+    store_link = Column(String, nullable=False)
+    store_id = Column(BigInteger, index=True)
+    store_title = Column(String)
+
+    search = relationship('Search', back_populates='stores')
+    products = relationship('SearchProduct', back_populates='store', cascade='all, delete-orphan',
+                            passive_deletes=True)
+
+
+class SearchProduct(Base):
+    """
+    Product of the store found by saved search
+    """
+    __tablename__ = 'search_products'
+
+    id = Column(Integer, primary_key=True)
+    search_id = Column(Integer, ForeignKey('searches.id', ondelete='CASCADE'), nullable=False, index=True)
+    store_pk = Column(Integer, ForeignKey('search_stores.id', ondelete='CASCADE'), nullable=False, index=True)
+    product_id = Column(BigInteger, nullable=False)
+    title = Column(String)
+    link = Column(String)
+    image = Column(String)
+    currency = Column(String)
+    original_price = Column(Float)
+    sale_price = Column(Float)
+    shipping = Column(String)
+
+    store = relationship('SearchStore', back_populates='products')
+
+    __table_args__ = (
+        # Lowest recorded price for product
+        Index('ix_search_products_product_id_sale_price', product_id, sale_price),
+    )
+
+
+class Watch(Base):
+    """
+    Saved search which is re-run on schedule. Only changes of the results are stored
+    """
+    __tablename__ = 'watches'
+
+    id = Column(Integer, primary_key=True)
+    search_id = Column(Integer, ForeignKey('searches.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    interval_hours = Column(Integer, nullable=False, server_default='24')
+    enabled = Column(Boolean, nullable=False, server_default='true')
+    next_run_at = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+    last_run_at = Column(TIMESTAMP(timezone=True))
+    # Prices of products found by the last run {store_link: {product_id: sale_price}} as zlib compressed JSON
+    snapshot = deferred(Column(LargeBinary))
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+    search = relationship('Search')
+    diffs = relationship('WatchDiff', back_populates='watch', cascade='all, delete-orphan', passive_deletes=True)
+
+
+class WatchDiff(Base):
+    """
+    Changes of the results of the watched search found by one run
+    """
+    __tablename__ = 'watch_diffs'
+
+    id = Column(Integer, primary_key=True)
+    watch_id = Column(Integer, ForeignKey('watches.id', ondelete='CASCADE'), nullable=False)
+    added_stores = Column(Integer, nullable=False, server_default='0')
+    removed_stores = Column(Integer, nullable=False, server_default='0')
+    changed_products = Column(Integer, nullable=False, server_default='0')
+    # Added and removed stores and products, price changes as zlib compressed JSON
+    diff = deferred(Column(LargeBinary))
+    seen = Column(Boolean, nullable=False, server_default='false')
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+    watch = relationship('Watch', back_populates='diffs')
+
+    __table_args__ = (
+        Index('ix_watch_diffs_watch_id_created_at', watch_id, created_at.desc()),
+    )
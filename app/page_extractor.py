@@ -0,0 +1,73 @@
+class PageExtractor:
+    """
+    Incremental extractor of the parts of search results page which are used by the search engine:
+    pagination list and script with window._dida_config_ data.
+    Page is fed by chunks while it is downloaded, the rest of the page can be skipped when both parts are captured.
+    Only the part of the page which can contain unfinished fragment is kept in memory
+    """
+
+    PARTS = {
+        "pagination": ('<ul class="comet-pagination"', '</ul>'),
+        "script": ('window._dida_config_ =', '</script>'),
+    }
+
+    def __init__(self):
+        self._buffer = ""
+        # Position in buffer where capturing of the part started
+        self._starts: dict[str, int] = {}
+        self.parts: dict[str, str] = {}
+        self._keep_size = max(len(marker) for markers in self.PARTS.values() for marker in markers)
+
+    @property
+    def is_complete(self) -> bool:
+        """
+        All parts are captured
+        :return:
+        """
+        return len(self.parts) == len(self.PARTS)
+
+    def feed(self, chunk: str):
+        """
+        Process next chunk of the page
+        :param chunk:
+        :return:
+        """
+        self._buffer += chunk
+        for name, (start_marker, end_marker) in self.PARTS.items():
+            if name in self.parts:
+                continue
+            if name not in self._starts:
+                # Marker can be split between chunks, so the search starts before the new chunk
+                position = self._buffer.find(start_marker, max(0, len(self._buffer) - len(chunk) - len(start_marker)))
+                if position == -1:
+                    continue
+                self._starts[name] = position
+            start = self._starts[name]
+            end = self._buffer.find(end_marker, max(start, len(self._buffer) - len(chunk) - len(end_marker)))
+            if end != -1:
+                self.parts[name] = self._buffer[start:end + len(end_marker)]
+                del self._starts[name]
+        self._trim()
+
+    def _trim(self):
+        """
+        Remove the part of the buffer which is not needed for capturing
+        :return:
+        """
+        if self._starts:
+            offset = min(self._starts.values())
+        else:
+            offset = max(0, len(self._buffer) - self._keep_size)
+        if offset:
+            self._buffer = self._buffer[offset:]
+            self._starts = {name: start - offset for name, start in self._starts.items()}
+
+    def get_html(self) -> str:
+        """
+        Returns minimal HTML document with captured parts, which can be parsed instead of the full page
+        :return:
+        """
+        html = [self.parts.get("pagination", "")]
+        if "script" in self.parts:
+            html.append(f"<script>{self.parts['script']}")
+        return f"<html><body>{''.join(html)}</body></html>"
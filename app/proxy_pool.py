@@ -0,0 +1,232 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import httpx
+
+from app.core.settings import get_settings
+
+# Name of the endpoint without proxy in the list of proxies
+DIRECT = "direct"
+# Weight of the last request in moving averages of latency, error rate and block rate
+EWMA_ALPHA = 0.2
+# Number of failed requests in a row which puts proxy into quarantine
+QUARANTINE_FAILURES = 3
+# Max quarantine time in seconds, quarantine time doubles for each repeated quarantine
+MAX_QUARANTINE_TIME = 1800
+# Latency in seconds assumed for proxy without requests
+DEFAULT_LATENCY = 1.0
+# Interval in seconds for throughput accounting
+THROUGHPUT_WINDOW = 60
+
+
+def create_client(proxy: Optional[str]) -> httpx.AsyncClient:
+    """
+    Returns client with connection pool for the proxy. SOCKS proxies require socksio package
+    :param proxy: proxy url or None for direct connection
+    :return:
+    """
+    return httpx.AsyncClient(proxy=proxy, timeout=httpx.Timeout(10.0, read=10.0))
+
+
+class Proxy:
+    """
+    Egress endpoint of the search engine with its own client and health statistics
+    """
+
+    def __init__(self, url: Optional[str], client: httpx.AsyncClient):
+        self.url = url
+        self.client = client
+        self.latency = DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.block_rate = 0.0
+        self.in_flight = 0
+        self.failures_in_row = 0
+        self.quarantine_count = 0
+        self.quarantined_until = 0.0
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "blocks": 0,
+            "bytes_downloaded": 0,
+        }
+        self._recent_requests: deque[float] = deque()
+
+    @property
+    def name(self) -> str:
+        """
+        Proxy url without user and password, used in metrics, messages and traces.
+        Credentials are kept only in url of the client
+        """
+        if not self.url:
+            return DIRECT
+        return str(httpx.URL(self.url).copy_with(userinfo=b""))
+
+    @property
+    def is_quarantined(self) -> bool:
+        return self.quarantined_until > time.monotonic()
+
+    @property
+    def score(self) -> float:
+        """
+        Expected cost of the request through the proxy, the lower the better.
+        Latency is increased by error and block rates and by requests which are in progress
+        """
+        return self.latency * (1 + 4 * self.error_rate + 8 * self.block_rate) * (1 + self.in_flight)
+
+    def record(self, latency: float, error: bool = False, blocked: bool = False, bytes_downloaded: int = 0):
+        """
+        Update statistics by result of the request. Proxy is quarantined after QUARANTINE_FAILURES failures in row
+        :param latency: time of the request in seconds
+        :param error: network error or unexpected response
+        :param blocked: the site refused to serve the page, e.g. 403, 429 or captcha
+        :param bytes_downloaded:
+        :return:
+        """
+        now = time.monotonic()
+        self.stats["requests"] += 1
+        self.stats["errors"] += error
+        self.stats["blocks"] += blocked
+        self.stats["bytes_downloaded"] += bytes_downloaded
+        self._recent_requests.append(now)
+        while self._recent_requests and self._recent_requests[0] < now - THROUGHPUT_WINDOW:
+            self._recent_requests.popleft()
+
+        self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * (error - self.error_rate)
+        self.block_rate += EWMA_ALPHA * (blocked - self.block_rate)
+
+        if not error and not blocked:
+            self.failures_in_row = 0
+            self.quarantine_count = 0
+            return
+        self.failures_in_row += 1
+        if self.failures_in_row >= QUARANTINE_FAILURES:
+            quarantine_time = min(get_settings().proxy_quarantine_time * 2 ** self.quarantine_count,
+                                  MAX_QUARANTINE_TIME)
+            self.quarantined_until = now + quarantine_time
+            self.quarantine_count += 1
+            self.failures_in_row = 0
+
+    def get_metrics(self) -> dict:
+        """
+        Returns health and throughput of the proxy
+        :return:
+        """
+        now = time.monotonic()
+        return {
+            "proxy": self.name,
+            **self.stats,
+            "requests_per_minute": sum(1 for t in self._recent_requests if t >= now - THROUGHPUT_WINDOW),
+            "latency": round(self.latency, 4),
+            "error_rate": round(self.error_rate, 4),
+            "block_rate": round(self.block_rate, 4),
+            "in_flight": self.in_flight,
+            "quarantined_for": round(max(0.0, self.quarantined_until - now), 1),
+        }
+
+
+class ProxyPool:
+    """
+    Pool of proxies for requests of the search engine. Each request is routed to the healthiest proxy,
+    proxies with repeated errors or blocks are quarantined
+    """
+
+    def __init__(self, proxies: list[Optional[str]] = None,
+                 client_factory: Callable[[Optional[str]], httpx.AsyncClient] = create_client):
+        self.client_factory = client_factory
+        self.proxies: list[Proxy] = []
+        self._config = None
+        self.configure(proxies or [None])
+
+    @staticmethod
+    def parse_proxies(value: str) -> list[Optional[str]]:
+        """
+        Parse comma separated list of proxy urls. Empty list or "direct" means connection without proxy
+        :param value:
+        :return:
+        """
+        proxies = [proxy.strip() for proxy in value.split(",") if proxy.strip()]
+        return [None if proxy == DIRECT else proxy for proxy in proxies] or [None]
+
+    def configure(self, proxies: list[Optional[str]]):
+        """
+        Set list of proxies. Statistics and clients of remaining proxies are kept, clients of removed ones are closed
+        :param proxies:
+        :return:
+        """
+        if proxies == self._config:
+            return
+        self._config = list(proxies)
+        current = {proxy.url: proxy for proxy in self.proxies}
+        self.proxies = [current.pop(url, None) or Proxy(url, self.client_factory(url)) for url in dict.fromkeys(proxies)]
+        for proxy in current.values():
+            self._close_client(proxy.client)
+
+    @staticmethod
+    def _close_client(client: httpx.AsyncClient):
+        """
+        Close client of removed proxy in background. Requests in progress are finished by the client
+        :param client:
+        :return:
+        """
+        try:
+            asyncio.get_running_loop().create_task(client.aclose())
+        except RuntimeError:
+            pass
+
+    def acquire(self) -> Proxy:
+        """
+        Returns proxy with the best score for the next request. Must be released by release().
+        If all proxies are quarantined, the proxy with the nearest end of quarantine is used
+        :return:
+        """
+        available = [proxy for proxy in self.proxies if not proxy.is_quarantined]
+        if available:
+            proxy = min(available, key=lambda p: p.score)
+        else:
+            proxy = min(self.proxies, key=lambda p: p.quarantined_until)
+        proxy.in_flight += 1
+        return proxy
+
+    def release(self, proxy: Proxy, latency: float, error: bool = False, blocked: bool = False,
+                bytes_downloaded: int = 0):
+        """
+        Record result of the request and return proxy to the pool
+        :param proxy:
+        :param latency:
+        :param error:
+        :param blocked:
+        :param bytes_downloaded:
+        :return:
+        """
+        proxy.in_flight -= 1
+        proxy.record(latency, error=error, blocked=blocked, bytes_downloaded=bytes_downloaded)
+
+    async def close(self):
+        """
+        Close clients of all proxies
+        :return:
+        """
+        for proxy in self.proxies:
+            await proxy.client.aclose()
+
+    def get_metrics(self) -> list[dict]:
+        """
+        Returns metrics of all proxies
+        :return:
+        """
+        return [proxy.get_metrics() for proxy in self.proxies]
+
+
+proxy_pool = ProxyPool(ProxyPool.parse_proxies(get_settings().proxies))
+
+
+def get_proxy_pool() -> ProxyPool:
+    """
+    Returns process-wide proxy pool with proxies from current settings
+    :return:
+    """
+    proxy_pool.configure(ProxyPool.parse_proxies(get_settings().proxies))
+    return proxy_pool
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket shared by concurrent searches: requests to the website are spread
+    to `rate` requests per second on average with bursts up to `burst` requests
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: requests per second, 0 for no limit
+        :param burst:
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.stats = {
+            "requests": 0,
+            "wait_time": 0.0,
+        }
+
+    async def acquire(self):
+        """
+        Wait until the next request is allowed. Waiting requests are served in order of arrival
+        :return:
+        """
+        self.stats["requests"] += 1
+        if self.rate <= 0:
+            return
+        started_at = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        self.stats["wait_time"] += time.monotonic() - started_at
+
+    def get_metrics(self) -> dict:
+        return {
+            "rate": self.rate,
+            "requests": self.stats["requests"],
+            "wait_time": round(self.stats["wait_time"], 3),
+        }
@@ -0,0 +1,81 @@
+from typing import Optional
+
+import httpx
+
+# Classes of responses of the website
+OK = "ok"
+EMPTY = "empty"
+CAPTCHA = "captcha"
+BLOCKED = "blocked"
+LOGIN = "login"
+SERVER_ERROR = "server_error"
+LAYOUT_CHANGED = "layout_changed"
+UNEXPECTED = "unexpected"
+NETWORK_ERROR = "network_error"
+
+# Number of characters at the beginning of the body which are checked by classifier
+HEAD_SIZE = 1024
+# Markers of captcha or punish page in redirect location or at the beginning of the body
+CAPTCHA_MARKERS = ("_____tmd_____", "punish", "x5secdata", "captcha", "baxia")
+# Markers of redirect to login page
+LOGIN_MARKERS = ("login.", "/login", "passport.")
+
+# Handling of response classes:
+# back off - pause before next request, rotate session - replace session of the request,
+# treat as empty - page without results, alert - retrying is useless, the search is stopped
+BACK_OFF_CLASSES = (BLOCKED, CAPTCHA, SERVER_ERROR)
+ROTATE_SESSION_CLASSES = (CAPTCHA, LOGIN)
+ALERT_CLASSES = (LAYOUT_CHANGED,)
+
+
+def _has_marker(text: str, markers: tuple) -> bool:
+    text = text.lower()
+    return any(marker in text for marker in markers)
+
+
+def classify_response(status_code: int, headers: httpx.Headers, head: str = "") -> Optional[str]:
+    """
+    Cheap classification of the response by status, headers and the first HEAD_SIZE characters of the body.
+    Returns None if the response looks like normal page, so the page must be downloaded and parsed
+
+    :param status_code:
+    :param headers:
+    :param head: beginning of the body
+    :return:
+    """
+    if status_code in (403, 429):
+        return BLOCKED
+    if 300 <= status_code < 400:
+        location = headers.get("location", "")
+        if _has_marker(location, CAPTCHA_MARKERS):
+            return CAPTCHA
+        if _has_marker(location, LOGIN_MARKERS):
+            return LOGIN
+        return UNEXPECTED
+    if status_code == 404:
+        return EMPTY
+    if status_code >= 500:
+        return SERVER_ERROR
+    if status_code >= 400:
+        return UNEXPECTED
+    if _has_marker(head[:HEAD_SIZE], CAPTCHA_MARKERS):
+        return CAPTCHA
+    return None
+
+
+class ResponseClassifierStats:
+    """
+    Counters of classified responses
+    """
+
+    def __init__(self):
+        self.counts: dict[str, int] = {}
+
+    def record(self, response_class: str):
+        self.counts[response_class] = self.counts.get(response_class, 0) + 1
+
+    def get_metrics(self) -> dict:
+        return dict(self.counts)
+
+
+classifier_stats = ResponseClassifierStats()
@@ -1,118 +1,182 @@
+import base64
+import binascii
 import json
 import math
+from datetime import datetime
 from re import search
 from time import strftime
-from typing import Optional
+from typing import Literal, Optional
 
 from fastapi import Request, APIRouter, Depends, HTTPException, Security
 from psycopg2.extras import DictCursor
 from psycopg2.extensions import connection
-from sqlalchemy import func, text
-from sqlalchemy.orm import Session
+from redis.asyncio import Redis
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
 from starlette.responses import HTMLResponse
 
 from app.auth import get_current_user
 from app.models.models import User, Search
 from app.resources import templates
-from app.dependecies import get_db
+from app.dependecies import get_db, get_redis
+from app.services.search_results import (
+    find_searches_by_store,
+    find_lowest_price,
+    decompress_json,
+)
 
+# Prefix of Redis key with cached number of saved searches of the user
+HISTORY_COUNT_KEY = "history_count"
+HISTORY_COUNT_CACHE_TIME = 300
 router = APIRouter()
 
 
 @router.get("/history", response_class=HTMLResponse)
-@router.get("/history/{page}", response_class=HTMLResponse)
 async def history_endpoint(request: Request,
-                           page: Optional[int] = 1,
+                           cursor: Optional[str] = None,
+                           direction: Literal["next", "prev"] = "next",
                            limit: Optional[int] = 5,
-                           db: Session = Depends(get_db),
+                           db: AsyncSession = Depends(get_db),
+                           redis: Redis = Depends(get_redis),
                            current_user: User = Depends(get_current_user)):
     """
-        History page.
+        History page. Uses keyset pagination by (created_at, id) of the searches.
+        Cursor "next" returns older searches than cursor, "prev" returns newer searches than cursor.
+        Direction "prev" without cursor returns the last page with the oldest searches
     :param current_user:
     :param request:
-    :param page:
+    :param cursor:
+    :param direction:
     :param limit:
     :param db:
+    :param redis:
     :return:
     """
 
-    total_records = db.query(func.count(Search.id)).filter(Search.user_id == current_user.id).scalar()
+    total_records = await get_history_count(db, redis, current_user.id)
 
     if total_records == 0:
         return templates.TemplateResponse(request, "history.j2", {
             "searches": [],
             "pagination": {},
-            "current_page": 1,
             "total_pages": 1,
             "total_records": total_records,
         })
 
+    limit = max(1, limit)
     total_pages = math.ceil(total_records / limit)
 
-    if page < 1:
-        page = 1
-    elif page > total_pages:
-        page = total_pages
-
-    offset = (page - 1) * limit
-
-    query = text("""
-        SELECT
-            uuid AS uuid,
-            created_at AS created_at,
-            names_list1 AS names_list1,
-            names_list2 AS names_list2,
-            (SELECT COUNT(*)
-                FROM json_object_keys(results) AS keys) AS results_number
-        FROM searches
-        WHERE user_id = :user_id
-        ORDER BY created_at DESC
-        LIMIT :limit
-        OFFSET :offset;
-    """)
-
-    result = db.execute(query, {"user_id": current_user.id,"limit": limit, "offset": offset}).mappings().fetchall()
+    query = (
+        select(Search.id,
+               Search.uuid,
+               Search.created_at,
+               Search.names_list1,
+               Search.names_list2,
+               Search.results_count)
+        .filter(Search.user_id == current_user.id)
+    )
+    if cursor:
+        try:
+            cursor_created_at, cursor_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if direction == "next":
+            query = query.filter(tuple_(Search.created_at, Search.id) < tuple_(cursor_created_at, cursor_id))
+        else:
+            query = query.filter(tuple_(Search.created_at, Search.id) > tuple_(cursor_created_at, cursor_id))
+    if direction == "next":
+        query = query.order_by(Search.created_at.desc(), Search.id.desc())
+    else:
+        query = query.order_by(Search.created_at.asc(), Search.id.asc())
+    # One extra row shows that there is one more page in this direction
+    query = query.limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows = list(reversed(rows))
+    has_newer = has_more if direction == "prev" else cursor is not None
+    has_older = has_more if direction == "next" else cursor is not None
 
     searches = []
-    for row in result:
+    for row in rows:
         searches.append({
             "uuid": row["uuid"],
             "created_at": row["created_at"].astimezone().strftime("%Y-%m-%d %H:%M:%S"),
             "names_list1": row["names_list1"],
             "names_list2": row["names_list2"],
-            "results_number": row["results_number"]
+            "results_number": row["results_count"]
         })
 
     pagination = {}
-    if total_pages > 1:
-        pagination["current_page"] = page
-        if page > 1:
-            pagination["first"] = 1
-        if page > 2:
-            pagination["prev"] = page - 1
-        if page < total_pages - 1:
-            pagination["next"] = page + 1
-        if page < total_pages:
-            pagination["last"] = total_pages
+    if rows and (has_newer or has_older):
+        if has_newer:
+            pagination["first"] = "/history"
+            pagination["prev"] = f"/history?cursor={encode_cursor(rows[0])}&direction=prev"
+        if has_older:
+            pagination["next"] = f"/history?cursor={encode_cursor(rows[-1])}&direction=next"
+            pagination["last"] = "/history?direction=prev"
 
     # Возврат шаблона с данными
     return templates.TemplateResponse(request, "history.j2", {
         "searches": searches,
         "pagination": pagination,
-        "current_page": page,
         "total_pages": total_pages,
         "total_records": total_records,
     })
 
 
+def encode_cursor(row) -> str:
+    """
+    Encodes position of the search in history as url-safe string
+    :param row:
+    :return:
+    """
+    value = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Decodes cursor into created_at and id of the search
+    :param cursor:
+    :return:
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, search_id = value.split("|")
+        return datetime.fromisoformat(created_at), int(search_id)
+    except (UnicodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+async def get_history_count(db: AsyncSession, redis: Redis, user_id: int) -> int:
+    """
+    Returns number of saved searches of the user. Value is cached in Redis and reset when new search is saved
+    :param db:
+    :param redis:
+    :param user_id:
+    :return:
+    """
+    cached = await redis.get(f"{HISTORY_COUNT_KEY}:{user_id}")
+    if cached is not None:
+        return int(cached)
+    total_records = await db.scalar(select(func.count(Search.id)).filter(Search.user_id == user_id))
+    await redis.set(f"{HISTORY_COUNT_KEY}:{user_id}", total_records, ex=HISTORY_COUNT_CACHE_TIME)
+    return total_records
+
 
 @router.get("/history/search/{search_uuid}", response_class=HTMLResponse)
 async def get_saved_search_by_id_endpoint(request: Request,
                                           search_uuid: str,
-                                          db: Session = Depends(get_db),
+                                          db: AsyncSession = Depends(get_db),
                                           current_user: User = Depends(get_current_user)
                                           ):
     """
+    Saved search page. Messages and results are not embedded into the page,
+    they are loaded by the page from paginated API on demand. Results are served by /search/{uuid}/results
 
     :param request:
     :param search_uuid:
@@ -121,14 +185,113 @@ async def get_saved_search_by_id_endpoint(request: Request,
     :return:
     """
 
-    search = db.query(Search).filter(Search.uuid == search_uuid, Search.user_id == current_user.id).first()
-
-    if not search:
-        raise HTTPException(status_code=404, detail="Search not found")
+    search = await get_saved_search(db, search_uuid, current_user.id)
 
     return templates.TemplateResponse(request, "search.j2", {
-        "messages": json.dumps(search.messages),
-        "results": json.dumps(search.results),
         "names_list1": search.names_list1,
-        "names_list2": search.names_list2
+        "names_list2": search.names_list2,
+        "saved_search_uuid": search.uuid,
+        "results_count": search.results_count,
     })
+
+
+@router.get("/history/search/{search_uuid}/messages")
+async def get_saved_search_messages_endpoint(search_uuid: str,
+                                             offset: int = 0,
+                                             limit: int = 500,
+                                             db: AsyncSession = Depends(get_db),
+                                             current_user: User = Depends(get_current_user)):
+    """
+    Returns page of the message log of saved search
+
+    :param search_uuid:
+    :param offset:
+    :param limit:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    search = await get_saved_search(db, search_uuid, current_user.id,
+                                    undefer(Search.messages_compressed), undefer(Search.messages))
+    # Searches saved by previous versions have uncompressed messages
+    messages = decompress_json(search.messages_compressed) or search.messages or []
+    offset = max(0, offset)
+    return {
+        "messages": messages[offset:offset + limit],
+        "offset": offset,
+        "total": len(messages),
+    }
+
+
+async def get_saved_search(db: AsyncSession, search_uuid: str, user_id: int, *options) -> Search:
+    """
+    Returns saved search of the user. Large columns are loaded only if they are requested in options
+    :param db:
+    :param search_uuid:
+    :param user_id:
+    :param options: loader options, e.g. undefer(Search.messages_compressed)
+    :return:
+    """
+    result = await db.execute(
+        select(Search)
+        .filter(Search.uuid == search_uuid, Search.user_id == user_id)
+        .options(*options)
+    )
+    search = result.scalars().first()
+    if not search:
+        raise HTTPException(status_code=404, detail="Search not found")
+    return search
+
+
+@router.get("/history/stores/{store_id}")
+async def get_searches_by_store_endpoint(store_id: int,
+                                         db: AsyncSession = Depends(get_db),
+                                         current_user: User = Depends(get_current_user)):
+    """
+    Returns saved searches which found the store
+
+    :param store_id:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    searches = await find_searches_by_store(db, current_user.id, store_id)
+    return {
+        "store_id": store_id,
+        "searches": [
+            {
+                "uuid": search.uuid,
+                "created_at": search.created_at.astimezone().strftime("%Y-%m-%d %H:%M:%S"),
+                "names_list1": search.names_list1,
+                "names_list2": search.names_list2,
+            }
+            for search in searches
+        ],
+    }
+
+
+@router.get("/history/products/{product_id}/lowest-price")
+async def get_product_lowest_price_endpoint(product_id: int,
+                                            db: AsyncSession = Depends(get_db),
+                                            current_user: User = Depends(get_current_user)):
+    """
+    Returns lowest recorded price of the product in saved searches
+
+    :param product_id:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    row = await find_lowest_price(db, current_user.id, product_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Product not found in saved searches")
+    product, store, search = row
+    return {
+        "product_id": product_id,
+        "title": product.title,
+        "currency": product.currency,
+        "sale_price": product.sale_price,
+        "store_link": store.store_link,
+        "search_uuid": search.uuid,
+        "created_at": search.created_at.astimezone().strftime("%Y-%m-%d %H:%M:%S"),
+    }
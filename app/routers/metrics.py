@@ -0,0 +1,26 @@
+import os
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from app.metrics import REGISTRY, StatusCollector, is_metrics_request_allowed
+from app.routers.status import get_status
+
+# Bearer token of Prometheus scrapes. Without token metrics are served only to clients on the same host
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+router = APIRouter()
+REGISTRY.register(StatusCollector(get_status))
+
+
+@router.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """
+    Returns metrics of this worker in Prometheus text format
+
+    :param request:
+    :return:
+    """
+    if not is_metrics_request_allowed(request, METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="Metrics token is required")
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -1,26 +1,57 @@
 import asyncio
 import json
+import os
+import socket
 import uuid
 from datetime import datetime
 from re import search
+from typing import Literal, Optional
 
 import psycopg2
 
-from fastapi import Request, APIRouter, Depends, HTTPException, Security
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi import Request, APIRouter, Depends, HTTPException, Query, Security
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
 from psycopg2.extras import DictCursor
 from psycopg2.extensions import connection
 from redis.asyncio import Redis
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
 
 from app.auth import get_current_user
 from app.dependecies import get_db, get_redis
 from app.models.models import User, Search
+from app.routers.history import HISTORY_COUNT_KEY, get_saved_search
 from app.schemas.search_form import SearchForm, SearchFormSave
-from app.search_engine import SearchEngine
+from app.services.search_results import (
+    save_search_stores,
+    build_results_index,
+    compress_json,
+    decompress_json,
+    load_live_results_page,
+    load_saved_results_page,
+    encode_results_cursor,
+    decode_results_cursor,
+    iter_live_products,
+    iter_saved_products,
+)
+from app.services.database import SessionLocal
+from app.services.export import export_chunks, EXPORT_MEDIA_TYPES
+from app.core.settings import get_settings
+from app.search_engine import SearchEngine, CHECKPOINTS_KEY
 from app.resources import templates
 
 MAX_SEARCH_COUNT = 2
+# Time in seconds while the worker owns the search. Lease is renewed by resume_searches_task
+CHECKPOINT_LEASE_TIME = 60
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Prefix of Redis keys with running search key and finished results for fingerprint of query lists
+FINGERPRINTS_KEY = "search_fingerprint"
+# Time in seconds while data of finished search is kept in Redis and can be saved
+FINISHED_SEARCH_TTL = 3600
+# Number of stores inserted into DB in one statement
+SAVE_BATCH_SIZE = 500
+# Max number of stores in one page of results API
+MAX_RESULTS_PAGE_SIZE = 200
 router = APIRouter()
 
 @router.post("/search/start", response_model=None)
@@ -41,16 +72,61 @@ async def search_start_endpoint(page_data: SearchForm,
     user_id = current_user.id
     search_uuid = str(uuid.uuid4())
     search_key = f"{user_id}:{search_uuid}"
+    fingerprint = page_data.fingerprint
+    if await reuse_finished_search(redis, fingerprint, user_id, search_uuid):
+        await redis.set(f"{search_key}:page_data", page_data.model_dump_json())
+        return RedirectResponse(f"/search/{search_uuid}", status_code=303)
     if search_key in active_searches:
         return {"error": True, "messages": "Search is already running"}
     if sum(1 for key in active_searches.keys() if key.startswith(f"{user_id}:")) >= MAX_SEARCH_COUNT:
         return {"error": True, "messages": "Too many searches running"}
-    await create_search_task(active_searches, redis, page_data.queries_list, user_id, search_uuid)
+    running_key = await redis.get(f"{FINGERPRINTS_KEY}:{fingerprint}:running")
+    if running_key and running_key.decode('utf-8') in active_searches:
+        # Identical search is running in this worker. Subscribe to its progress instead of new scraping
+        se = active_searches[running_key.decode('utf-8')]
+        await se.subscribe(user_id, search_uuid)
+        await se.add_message(f"Identical search {search_uuid} is attached to this search")
+        active_searches[search_key] = se
+    else:
+        await create_search_task(active_searches, redis, page_data.queries_list, user_id, search_uuid,
+                                 fingerprint=fingerprint)
     await redis.set(f"{search_key}:page_data", page_data.model_dump_json())
     return RedirectResponse(f"/search/{search_uuid}", status_code=303)
 
 
-async def create_search_task(active_searches, redis, queries_list: list[tuple], user_id, search_uuid):
+async def reuse_finished_search(redis, fingerprint: str, user_id, search_uuid) -> bool:
+    """
+    Copies results of identical search finished less than result_reuse_max_age seconds ago
+    to the new search and marks it as finished
+
+    :param redis:
+    :param fingerprint:
+    :param user_id:
+    :param search_uuid:
+    :return: True if results were reused
+    """
+    if not get_settings().result_reuse_max_age:
+        return False
+    entry = await redis.get(f"{FINGERPRINTS_KEY}:{fingerprint}:result")
+    if not entry:
+        return False
+    entry = json.loads(entry)
+    search_key = f"{user_id}:{search_uuid}"
+    time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    await redis.rpush(f"{search_key}:messages",
+                      f"{time_str} - Results of identical search finished at {entry['finished_at']} are reused",
+                      f"{time_str} - Total stores - {len(entry['results'])}",
+                      f"{time_str} - Search finished")
+    if entry['results']:
+        await redis.hset(f"{search_key}:results",
+                         mapping={store: json.dumps(products) for store, products in entry['results'].items()})
+        await redis.hset(f"{search_key}:results_index", mapping=build_results_index(entry['results']))
+    await redis.set(f"{search_key}:is_finished", 1)
+    return True
+
+
+async def create_search_task(active_searches, redis, queries_list: list[tuple], user_id, search_uuid,
+                             resume: bool = False, active_search_count: int = None, fingerprint: str = None):
     """
     Creates async background task with search process
 
@@ -59,32 +135,104 @@ async def create_search_task(active_searches, redis, queries_list: list[tuple],
     :param queries_list:
     :param user_id:
     :param search_uuid:
+    :param resume: continue search from checkpoint saved in Redis
+    :param active_search_count:
+    :param fingerprint: fingerprint of query lists for reusing results by identical searches
     :return:
     """
 
-    se = SearchEngine(user_id, search_uuid, redis, len(active_searches))
-    search_task = asyncio.create_task(se.intersection_in_global_search(queries_list))
-    se.task = search_task
+    if active_search_count is None:
+        # Subscribed identical searches share one engine
+        active_search_count = len({id(se) for se in active_searches.values()})
+    se = SearchEngine(user_id, search_uuid, redis, active_search_count)
+    se.fingerprint = fingerprint
     search_key = f"{user_id}:{search_uuid}"
+    await redis.set(f"{search_key}:lock", WORKER_ID, ex=CHECKPOINT_LEASE_TIME)
+    if fingerprint:
+        await redis.set(f"{FINGERPRINTS_KEY}:{fingerprint}:running", search_key)
+    search_task = asyncio.create_task(se.intersection_in_global_search(queries_list, resume=resume))
+    se.task = search_task
     active_searches[search_key] = se
 
-    async def on_finish():
-        await redis.set(f"{user_id}:{search_uuid}:is_finished", 1)
-        active_searches.pop(search_key, None)
-
-    def callback(_: asyncio.Task):
+    async def on_finish(task: asyncio.Task):
+        error = None if task.cancelled() else task.exception()
+        if error is not None:
+            # Failed search is not resumed, otherwise resume_searches would repeat it without limit
+            await se.add_message(f"Search failed: {error}")
+            await se.delete_checkpoint()
+        await se.flush_messages()
+        await se.save_trace()
+        if fingerprint:
+            await redis.delete(f"{FINGERPRINTS_KEY}:{fingerprint}:running")
+            result_reuse_max_age = get_settings().result_reuse_max_age
+            # Partial results of failed search are not reused, identical searches repeat it
+            if (result_reuse_max_age and not task.cancelled() and error is None
+                    and se.has_complete_results):
+                entry = {"finished_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "results": task.result()}
+                await redis.set(f"{FINGERPRINTS_KEY}:{fingerprint}:result", json.dumps(entry),
+                                ex=result_reuse_max_age)
+        for key in se.search_keys:
+            await redis.set(f"{key}:is_finished", 1)
+            active_searches.pop(key, None)
+        await redis.delete(f"{search_key}:lock")
+
+    def callback(task: asyncio.Task):
+        # Search cancelled not by user (e.g. server shutdown) keeps checkpoint and will be resumed
+        if task.cancelled() and not se.stopped_by_user:
+            for key in se.search_keys:
+                active_searches.pop(key, None)
+            return
         # wrapper for async on_finish function
-        asyncio.create_task(on_finish())
+        asyncio.create_task(on_finish(task))
 
     search_task.add_done_callback(callback)
 
 
+async def resume_searches(active_searches, redis):
+    """
+    Resumes searches that have checkpoint in Redis but are not running in any worker and are not finished.
+    The worker owns the search while it holds the lock, so the lease for own searches is renewed here.
+
+    :param active_searches:
+    :param redis:
+    :return:
+    """
+    for entry in await redis.smembers(CHECKPOINTS_KEY):
+        search_key = entry.decode('utf-8')
+        if search_key in active_searches:
+            await redis.set(f"{search_key}:lock", WORKER_ID, ex=CHECKPOINT_LEASE_TIME)
+            continue
+        checkpoint = await redis.get(f"{search_key}:checkpoint")
+        if not checkpoint or await redis.get(f"{search_key}:is_finished"):
+            # Checkpoint of finished search is left if the worker stopped before it was deleted
+            await redis.delete(f"{search_key}:checkpoint")
+            await redis.srem(CHECKPOINTS_KEY, search_key)
+            continue
+        if not await redis.set(f"{search_key}:lock", WORKER_ID, ex=CHECKPOINT_LEASE_TIME, nx=True):
+            # Search is running in another worker
+            continue
+        checkpoint = json.loads(checkpoint)
+        await create_search_task(active_searches,
+                                 redis,
+                                 checkpoint['queries_list'],
+                                 checkpoint['user_id'],
+                                 checkpoint['search_uuid'],
+                                 resume=True,
+                                 active_search_count=checkpoint.get('active_search_count', 1),
+                                 fingerprint=checkpoint.get('fingerprint'),
+                                 )
+
+
 @router.post("/search/{search_uuid}/stop")
-async def search_stop_endpoint(request: Request, search_uuid: str, current_user: User = Depends(get_current_user)):
+async def search_stop_endpoint(request: Request,
+                               search_uuid: str,
+                               redis: Redis = Depends(get_redis),
+                               current_user: User = Depends(get_current_user)):
     """
     Stop the search process
 
     :param current_user:
+    :param redis:
     :param search_uuid:
     :param request:
     :return:
@@ -95,57 +243,125 @@ async def search_stop_endpoint(request: Request, search_uuid: str, current_user:
     if search_key not in active_searches:
         return {"error": True, "messages": "Search not found"}
     se: SearchEngine = active_searches[search_key]
+    if search_key in se.subscribers:
+        # Identical search started by another request continues, only this subscription is stopped
+        se.unsubscribe(user_id, search_uuid)
+        active_searches.pop(search_key, None)
+        await redis.rpush(f"{search_key}:messages",
+                          f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Search stopped by user")
+        await redis.set(f"{search_key}:is_finished", 1)
+        return {"messages": "Search stopped by user"}
     await se.add_message("Search stopped by user")
+    await se.flush_messages()
+    se.stopped_by_user = True
     se.task.cancel()
+    await se.delete_checkpoint()
     return {"messages": "Search stopped by user"}
 
 
 @router.post("/search/{search_uuid}/save")
-async def search_save_endpoint(page_data: SearchFormSave,
-                               search_uuid: str,
-                               db: Session = Depends(get_db),
+async def search_save_endpoint(search_uuid: str,
+                               page_data: Optional[SearchFormSave] = None,
+                               db: AsyncSession = Depends(get_db),
+                               redis: Redis = Depends(get_redis),
                                current_user: User = Depends(get_current_user)):
     """
-    Save search result into DB
+    Save search result into DB.
+    If request has no results, names lists, messages and results are moved from Redis by the server
 
     :param current_user:
     :param search_uuid:
     :param page_data:
     :param db:
+    :param redis:
     :return:
     """
 
+    if page_data is None or page_data.results is None:
+        return await save_search_from_redis(db, redis, current_user.id, search_uuid)
+
     if not page_data.names_list1 or not page_data.names_list2:
         return {"error": True, "messages": "Names Lists are empty"}
 
-    new_search: Search = Search(**page_data.model_dump())
+    new_search: Search = Search(**page_data.model_dump(exclude={"messages", "results"}))
+    new_search.messages_compressed = compress_json(page_data.messages or [])
     new_search.uuid = search_uuid
     new_search.user_id = current_user.id
+    new_search.results_count = len(page_data.results or {})
+    new_search.trace_compressed = await redis.get(f"{current_user.id}:{search_uuid}:trace")
     try:
         db.add(new_search)
-        db.commit()
-        db.refresh(new_search)
+        await db.flush()
+        await save_search_stores(db, new_search.id, list((page_data.results or {}).items()))
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return {"error": True, "messages": str(e)}
+    await redis.delete(f"{HISTORY_COUNT_KEY}:{current_user.id}")
 
     return {"messages": "Saved successfully"}
 
 
-async def clear_redis_data(redis, user_id, search_uuid):
+async def save_search_from_redis(db: AsyncSession, redis: Redis, user_id, search_uuid):
     """
-    Clear Redis data after search is finished and client received all messages, results and is_finished flag
+    Save search stored in Redis into DB in one transaction. Results are read from Redis and inserted in batches,
+    so the whole result is never loaded into memory
+
+    :param db:
+    :param redis:
+    :param user_id:
+    :param search_uuid:
+    :return:
+    """
+    search_key = f"{user_id}:{search_uuid}"
+    page_data = await redis.get(f"{search_key}:page_data")
+    if not page_data:
+        return {"error": True, "messages": "Search data is not found in storage"}
+    if not await check_finished(redis, user_id, search_uuid):
+        return {"error": True, "messages": "Search is not finished yet"}
+    page_data = SearchForm.model_validate_json(page_data)
+    messages = [entry.decode('utf-8') for entry in await redis.lrange(f"{search_key}:messages", 0, -1)]
+
+    new_search = Search(names_list1=page_data.names_list1,
+                        names_list2=page_data.names_list2,
+                        messages_compressed=compress_json(messages),
+                        trace_compressed=await redis.get(f"{search_key}:trace"),
+                        uuid=search_uuid,
+                        user_id=user_id)
+    try:
+        db.add(new_search)
+        await db.flush()
+        results_count = 0
+        batch = []
+        async for store_link, products in redis.hscan_iter(f"{search_key}:results", count=SAVE_BATCH_SIZE):
+            batch.append((store_link.decode('utf-8'), json.loads(products)))
+            if len(batch) == SAVE_BATCH_SIZE:
+                await save_search_stores(db, new_search.id, batch)
+                results_count += len(batch)
+                batch = []
+        await save_search_stores(db, new_search.id, batch)
+        new_search.results_count = results_count + len(batch)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        return {"error": True, "messages": str(e)}
+    await redis.delete(f"{HISTORY_COUNT_KEY}:{user_id}")
+
+    return {"messages": "Saved successfully"}
+
+
+async def expire_redis_data(redis, user_id, search_uuid):
+    """
+    Set expiration time for Redis data after search is finished and client received all messages,
+    results and is_finished flag. Data is kept for some time to allow saving the search from Redis
     Initiated only after AJAX request for search messages
     :param redis:
     :param user_id:
     :param search_uuid:
     :return:
     """
-    await redis.delete(
-        f"{user_id}:{search_uuid}:messages",
-        f"{user_id}:{search_uuid}:results",
-        f"{user_id}:{search_uuid}:is_finished"
-    )
+    for key in ("messages", "results", "results_index", "is_finished", "read_messages_count", "page_data", "trace"):
+        await redis.expire(f"{user_id}:{search_uuid}:{key}", FINISHED_SEARCH_TTL)
 
 
 @router.get("/search/{search_uuid}/messages")
@@ -154,7 +370,7 @@ async def get_search_messages_endpoint(request: Request,
                                        redis: Redis = Depends(get_redis),
                                        current_user: User = Depends(get_current_user)):
     """
-    Return messages as answer for AJAX request for certain search
+    Return new messages and number of found stores as answer for AJAX request for certain search
 
     :param current_user:
     :param redis:
@@ -167,18 +383,135 @@ async def get_search_messages_endpoint(request: Request,
     search_key = f"{current_user.id}:{search_uuid}"
     messages = await get_messages(redis, user_id, search_uuid)
     response = {"messages": messages}
-    results = await get_results(redis, user_id, search_uuid)
-    if results:
-        response["results"] = results
+    # Results are loaded by the client page by page from results API
+    results_count = await redis.hlen(f"{search_key}:results")
+    if results_count:
+        response["results_count"] = results_count
     if await check_finished(redis, user_id, search_uuid):
         response["search_finished"] = True
-        await clear_redis_data(redis, user_id, search_uuid)
-    if not messages and not results and search_key not in active_searches:
+        await expire_redis_data(redis, user_id, search_uuid)
+    if not messages and not results_count and search_key not in active_searches:
         response["error"] = True
         response["messages"] = "Search not found"
     return response
 
 
+@router.get("/search/{search_uuid}/results")
+async def get_search_results_endpoint(search_uuid: str,
+                                      sort: Literal["store", "price", "products"] = "store",
+                                      order: Literal["asc", "desc"] = "asc",
+                                      store: Optional[str] = None,
+                                      offset: int = 0,
+                                      limit: int = 50,
+                                      cursor: Optional[str] = None,
+                                      db: AsyncSession = Depends(get_db),
+                                      redis: Redis = Depends(get_redis),
+                                      current_user: User = Depends(get_current_user)):
+    """
+    Returns page of the stores found by the search. Results of active or recently finished search
+    are read from Redis, otherwise from saved search in DB.
+    Next page is requested by next_cursor from response, offset is used only without cursor
+
+    :param search_uuid:
+    :param sort: "store" - by store link, "price" - by the lowest price of store products,
+                 "products" - by number of products in store
+    :param order:
+    :param store: filter by store link, title or id
+    :param offset: number of stores to skip
+    :param limit: max number of stores
+    :param cursor:
+    :param db:
+    :param redis:
+    :param current_user:
+    :return:
+    """
+    offset = max(0, offset)
+    limit = min(max(1, limit), MAX_RESULTS_PAGE_SIZE)
+    try:
+        cursor_key = decode_results_cursor(cursor, sort) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    search_key = f"{current_user.id}:{search_uuid}"
+    page_params = {
+        "sort": sort,
+        "descending": order == "desc",
+        "store": store,
+        "offset": offset,
+        "limit": limit,
+        "cursor": cursor_key,
+    }
+    if await redis.exists(f"{search_key}:page_data"):
+        results, total, next_key = await load_live_results_page(redis, search_key, **page_params)
+    else:
+        search = await get_saved_search(db, search_uuid, current_user.id)
+        results, total, next_key = await load_saved_results_page(db, search, **page_params)
+    return {
+        "results": results,
+        "offset": offset,
+        "total": total,
+        "next_cursor": encode_results_cursor(next_key) if next_key else None,
+    }
+
+
+@router.get("/search/{search_uuid}/trace")
+async def get_search_trace_endpoint(search_uuid: str,
+                                    db: AsyncSession = Depends(get_db),
+                                    redis: Redis = Depends(get_redis),
+                                    current_user: User = Depends(get_current_user)):
+    """
+    Returns timeline of the finished search for waterfall on the search page, see SearchTrace.to_compact.
+    Trace of recently finished search is read from Redis, otherwise from saved search in DB
+
+    :param search_uuid:
+    :param db:
+    :param redis:
+    :param current_user:
+    :return:
+    """
+    data = await redis.get(f"{current_user.id}:{search_uuid}:trace")
+    if data is None and not await redis.exists(f"{current_user.id}:{search_uuid}:page_data"):
+        search = await get_saved_search(db, search_uuid, current_user.id, undefer(Search.trace_compressed))
+        data = search.trace_compressed
+    if data is None:
+        return {"error": True, "messages": "Trace of the search is not found"}
+    return {"trace": decompress_json(data)}
+
+
+@router.get("/search/{search_uuid}/export")
+async def export_search_results_endpoint(search_uuid: str,
+                                         export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+                                         gzip: bool = False,
+                                         db: AsyncSession = Depends(get_db),
+                                         redis: Redis = Depends(get_redis),
+                                         current_user: User = Depends(get_current_user)):
+    """
+    Streams products found by the search as NDJSON or CSV file, one product per row.
+    Rows are generated one by one from Redis for active or recently finished search, otherwise from saved search in DB
+
+    :param search_uuid:
+    :param export_format: "ndjson" or "csv"
+    :param gzip: compress file with gzip
+    :param db:
+    :param redis:
+    :param current_user:
+    :return:
+    """
+    search_key = f"{current_user.id}:{search_uuid}"
+    if await redis.exists(f"{search_key}:page_data"):
+        products = iter_live_products(redis, search_key)
+    else:
+        search = await get_saved_search(db, search_uuid, current_user.id)
+        products = iter_saved_products(SessionLocal, search.id)
+    filename = f"search_{search_uuid}.{export_format}"
+    media_type = EXPORT_MEDIA_TYPES[export_format]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(export_chunks(products, export_format, compress=gzip),
+                             media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 @router.get("/search/{search_uuid}", response_class=HTMLResponse)
 async def get_active_search_by_id_endpoint(request: Request,
                                            search_uuid: str,
@@ -240,17 +573,3 @@ async def check_finished(redis, user_id, search_uuid):
     entry = await redis.get(f"{user_id}:{search_uuid}:is_finished")
     is_finished = bool(int(entry)) if entry else False
     return is_finished
-
-
-async def get_results(redis, user_id, search_uuid):
-    """
-    Get search results from Redis
-
-    :param redis:
-    :param user_id:
-    :param search_uuid:
-    :return:
-    """
-    results_entries = await redis.hgetall(f"{user_id}:{search_uuid}:results")
-    results = {key.decode('utf-8'): json.loads(value.decode('utf-8')) for key, value in results_entries.items()}
-    return results
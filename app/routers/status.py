@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+
+from app.auth import get_current_user
+from app.core.security import password_hasher
+from app.memory_budget import memory_stats
+from app.models.models import User
+from app.proxy_pool import get_proxy_pool
+from app.response_classifier import classifier_stats
+from app.session_pool import session_pool
+from app.tracing import otlp_exporter
+from app.services.database import get_pool_metrics
+from app.services.user_cache import user_cache
+from app.watchlist_scheduler import watchlist_scheduler
+
+router = APIRouter()
+
+
+def get_status() -> dict:
+    """
+    Returns runtime metrics of the application services
+    :return:
+    """
+    return {
+        "db_pool": get_pool_metrics(),
+        "user_cache": user_cache.get_metrics(),
+        "password_hasher": password_hasher.get_metrics(),
+        "proxy_pool": get_proxy_pool().get_metrics(),
+        "session_pool": session_pool.get_metrics(),
+        "response_classes": classifier_stats.get_metrics(),
+        "parse_memory": memory_stats.get_metrics(),
+        "watchlist": watchlist_scheduler.get_metrics(),
+        "trace_export": otlp_exporter.get_metrics(),
+    }
+
+
+@router.get("/status")
+async def status_endpoint(current_user: User = Depends(get_current_user)):
+    """
+    Returns runtime metrics of the application services
+
+    :param current_user:
+    :return:
+    """
+    return get_status()
@@ -2,15 +2,15 @@ from fastapi import Request, APIRouter, Depends, HTTPException
 from typing import Annotated, Optional
 from datetime import timedelta
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.responses import RedirectResponse
 
 from app.auth import (
     authenticate_user,
     get_current_user,
-    get_password_hash,
 )
+from app.core.security import password_hasher
 from app.core.jwt_config import REFRESH_TOKEN_EXPIRE_MINUTES, ACCESS_TOKEN_EXPIRE_MINUTES
 from app.core.jwt import create_refresh_token, create_access_token
 from app.resources import templates
@@ -29,30 +29,30 @@ async def get_register_page_endpoint(request: Request):
 
 @router.post("/users/register", status_code=201)
 async def create_user_endpoint(request: Request, registration_form: UserCreate = Depends(UserCreate.as_form),
-                               db: Session = Depends(get_db),
+                               db: AsyncSession = Depends(get_db),
                                ):
-    user: Optional[User] = (
-        db.query(User)
+    result = await db.execute(
+        select(User)
         .filter(
             or_(
                 User.username == registration_form.username,
                 User.email == registration_form.username,
             )
         )
-        .first()
     )
+    user: Optional[User] = result.scalars().first()
     if user:
         raise HTTPException(
             status_code=400, detail="Username or email already exists"
         )
     new_user: User = User(**registration_form.model_dump(exclude={"confirm_password"}))
-    new_user.password = get_password_hash(registration_form.password)
+    new_user.password = await password_hasher.hash(registration_form.password)
     try:
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     return templates.TemplateResponse(
         request,
@@ -71,8 +71,8 @@ async def get_login_page_endpoint(request: Request):
 @router.post("/users/login")
 async def login_endpoint(request: Request,
                          form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-                         db: Session = Depends(get_db)):
-    user = authenticate_user(form_data.username, form_data.password, db)
+                         db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
@@ -100,8 +100,8 @@ async def login_endpoint(request: Request,
 @router.post("/users/token")
 async def access_token_endpoint(request: Request,
                                 form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-                                db: Session = Depends(get_db)) -> Token:
-    user = authenticate_user(form_data.username, form_data.password, db)
+                                db: AsyncSession = Depends(get_db)) -> Token:
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
@@ -0,0 +1,172 @@
+import json
+
+from fastapi import APIRouter, Depends, HTTPException
+from redis.asyncio import Redis
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+
+from app.auth import get_current_user
+from app.core.settings import get_settings
+from app.dependecies import get_db, get_redis
+from app.models.models import User, Watch, WatchDiff
+from app.routers.history import get_saved_search
+from app.services.search_results import decompress_json
+from app.services.watchlist import create_watch, list_watches, parse_hours
+from app.watchlist_scheduler import WATCH_NOTIFICATIONS_KEY
+
+# Min interval in hours between runs of the watch
+MIN_WATCH_INTERVAL = 6
+router = APIRouter()
+
+
+def _format_time(value) -> str:
+    return value.astimezone().strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+
+@router.post("/watchlist/{search_uuid}")
+async def create_watch_endpoint(search_uuid: str,
+                                interval_hours: int = 24,
+                                db: AsyncSession = Depends(get_db),
+                                current_user: User = Depends(get_current_user)):
+    """
+    Add saved search to the watchlist. The search is repeated every interval_hours,
+    changes of the results are saved and pushed to the user
+
+    :param search_uuid:
+    :param interval_hours:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    if interval_hours < MIN_WATCH_INTERVAL:
+        return {"error": True, "messages": f"Min interval is {MIN_WATCH_INTERVAL} hours"}
+    search = await get_saved_search(db, search_uuid, current_user.id)
+    if await db.scalar(select(Watch.id).filter(Watch.search_id == search.id)):
+        return {"error": True, "messages": "Search is already in the watchlist"}
+    try:
+        watch = await create_watch(db, search, current_user.id, interval_hours,
+                                   parse_hours(get_settings().off_peak_hours))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        return {"error": True, "messages": str(e)}
+    return {
+        "messages": "Search is added to the watchlist",
+        "watch_id": watch.id,
+        "next_run_at": _format_time(watch.next_run_at),
+    }
+
+
+@router.get("/watchlist")
+async def watchlist_endpoint(db: AsyncSession = Depends(get_db),
+                             current_user: User = Depends(get_current_user)):
+    """
+    Returns watched searches of the user with numbers of unseen changes
+
+    :param db:
+    :param current_user:
+    :return:
+    """
+    return {
+        "watches": [
+            {
+                "watch_id": watch.id,
+                "search_uuid": search.uuid,
+                "names_list1": search.names_list1,
+                "names_list2": search.names_list2,
+                "interval_hours": watch.interval_hours,
+                "enabled": watch.enabled,
+                "last_run_at": _format_time(watch.last_run_at),
+                "next_run_at": _format_time(watch.next_run_at),
+                "unseen_changes": unseen,
+            }
+            for watch, search, unseen in await list_watches(db, current_user.id)
+        ],
+    }
+
+
+@router.get("/watchlist/notifications")
+async def watch_notifications_endpoint(redis: Redis = Depends(get_redis),
+                                       current_user: User = Depends(get_current_user)):
+    """
+    Returns and clears notifications about new changes of watched searches
+
+    :param redis:
+    :param current_user:
+    :return:
+    """
+    key = f"{WATCH_NOTIFICATIONS_KEY}:{current_user.id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        entries, _ = await pipe.lrange(key, 0, -1).delete(key).execute()
+    return {"notifications": [json.loads(entry) for entry in entries]}
+
+
+@router.get("/watchlist/{watch_id}/changes")
+async def watch_changes_endpoint(watch_id: int,
+                                 offset: int = 0,
+                                 limit: int = 10,
+                                 db: AsyncSession = Depends(get_db),
+                                 current_user: User = Depends(get_current_user)):
+    """
+    Returns changes of the results found by runs of the watch, the newest first. Returned changes are marked as seen
+
+    :param watch_id:
+    :param offset:
+    :param limit:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    watch = await _get_watch(db, watch_id, current_user.id)
+    query = (
+        select(WatchDiff)
+        .filter(WatchDiff.watch_id == watch.id)
+        .order_by(WatchDiff.created_at.desc(), WatchDiff.id.desc())
+        .offset(max(0, offset))
+        .limit(max(1, limit))
+        .options(undefer(WatchDiff.diff))
+    )
+    diffs = list((await db.scalars(query)).all())
+    changes = [
+        {
+            "id": diff.id,
+            "created_at": _format_time(diff.created_at),
+            "seen": diff.seen,
+            "added_stores": diff.added_stores,
+            "removed_stores": diff.removed_stores,
+            "changed_products": diff.changed_products,
+            "changes": decompress_json(diff.diff),
+        }
+        for diff in diffs
+    ]
+    unseen_ids = [diff.id for diff in diffs if not diff.seen]
+    if unseen_ids:
+        await db.execute(update(WatchDiff).filter(WatchDiff.id.in_(unseen_ids)).values(seen=True))
+        await db.commit()
+    return {"changes": changes, "offset": max(0, offset)}
+
+
+@router.delete("/watchlist/{watch_id}")
+async def delete_watch_endpoint(watch_id: int,
+                                db: AsyncSession = Depends(get_db),
+                                current_user: User = Depends(get_current_user)):
+    """
+    Remove search from the watchlist with its saved changes
+
+    :param watch_id:
+    :param db:
+    :param current_user:
+    :return:
+    """
+    watch = await _get_watch(db, watch_id, current_user.id)
+    await db.delete(watch)
+    await db.commit()
+    return {"messages": "Search is removed from the watchlist"}
+
+
+async def _get_watch(db: AsyncSession, watch_id: int, user_id: int) -> Watch:
+    watch = await db.scalar(select(Watch).filter(Watch.id == watch_id, Watch.user_id == user_id))
+    if not watch:
+        raise HTTPException(status_code=404, detail="Watch not found")
+    return watch
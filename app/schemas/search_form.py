@@ -1,3 +1,5 @@
+import hashlib
+import json
 from typing import Optional, Any
 from pydantic import BaseModel, ConfigDict
 
@@ -13,6 +15,18 @@ class SearchForm(BaseModel):
     def queries_list(self):
         return [tuple(self.names_list1), tuple(self.names_list2)]
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        Canonical hash of query lists. Order of queries, order of lists, letter case and extra spaces
+        don't change the search result, so they don't change the fingerprint
+        """
+        lists = sorted(
+            sorted({" ".join(name.lower().split()) for name in names_list})
+            for names_list in (self.names_list1, self.names_list2)
+        )
+        return hashlib.sha256(json.dumps(lists).encode('utf-8')).hexdigest()
+
 
 class SearchFormSave(SearchForm):
     # search_uuid: Optional[str] = None
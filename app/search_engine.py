@@ -1,19 +1,66 @@
-import configparser
 import os
 import asyncio
 import json
 import random
 import re
+import time
 from datetime import datetime
 from typing import Optional
 
 import httpx
-from httpx import HTTPStatusError, RequestError
+from httpx import RequestError
 from bs4 import BeautifulSoup
 from calmjs.parse import es5
 from calmjs.parse.unparsers.extractor import ast_to_dict
 from redis.asyncio import Redis
 
+from app.core.settings import get_settings
+from app.memory_budget import MemoryBudget
+from app.metrics import (
+    page_fetch_seconds, parse_stage_seconds, parse_errors, products_per_page, relevance_ratio, page_retries,
+    pause_seconds,
+)
+from app.page_extractor import PageExtractor
+from app.proxy_pool import ProxyPool, get_proxy_pool
+from app.rate_limiter import RateLimiter
+from app.search_log import USER, DEBUG, MessageBuffer, logger
+from app.services.search_results import build_results_index, compress_json
+from app.session_pool import session_pool
+from app.tracing import SearchTrace, otlp_exporter, traced
+from app.response_classifier import (
+    OK, EMPTY, CAPTCHA, BLOCKED, LOGIN, LAYOUT_CHANGED, NETWORK_ERROR, HEAD_SIZE,
+    BACK_OFF_CLASSES, ROTATE_SESSION_CLASSES, ALERT_CLASSES,
+    classify_response, classifier_stats,
+)
+
+try:
+    import brotli  # noqa: F401 httpx decodes br responses only if brotli is installed
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Redis set with keys "user_id:search_uuid" of searches which have saved checkpoint
+CHECKPOINTS_KEY = "search_checkpoints"
+# Time in seconds while the timeline of the search is kept in Redis if the search is not saved
+TRACE_TTL = 86400
+# Base and max pause in seconds after block, captcha or server error. Pause doubles for each such response in row
+BACK_OFF_TIME = 5
+MAX_BACK_OFF_TIME = 120
+
+
+class _Setting:
+    """
+    Engine setting which is read from current process-wide settings on each access,
+    so running searches pick up reloaded settings. Assignment overrides the value for one engine
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(get_settings(), self.name)
 
 
 class SearchEngine:
@@ -21,52 +68,60 @@ class SearchEngine:
     Main class for searching products on Aliexpress
     """
 
-    def __init__(self, user_id: str, search_uuid: str, redis: Redis, active_search_count: int=1):
+    base_url = _Setting()
+    max_page = _Setting()
+    max_zero_pages = _Setting()
+    filter_result = _Setting()
+    enable_pause = _Setting()
+    max_pause_time = _Setting()
+    enable_save_to_json = _Setting()
+    adaptive_depth = _Setting()
+    adaptive_min_pages = _Setting()
+    min_page_yield = _Setting()
+    max_duplicate_rate = _Setting()
+    store_search_url = _Setting()
+    store_verification_max_candidates = _Setting()
+    search_memory_budget = _Setting()
 
-        self.enable_save_to_json = None
-        self.max_pause_time = None
+    def __init__(self, user_id: str, search_uuid: str, redis: Redis, active_search_count: int=1):
 
-        self.enable_pause = None
-        self.filter_result = None
-        self.max_zero_pages = None
-        self.max_page = None
-        self.base_url = None
         self.user_id = user_id
         self.search_uuid = search_uuid
         self.redis = redis
         self.task: Optional[asyncio.Task] = None  # Link to background task
+        self.stopped_by_user = False
+        # Keys "user_id:search_uuid" of identical searches which receive messages and results of this search
+        self.subscribers: list[str] = []
+        # User events which are pushed to Redis in batches
+        self.messages = MessageBuffer(redis, lambda: self.search_keys)
+        # Fingerprint of query lists, used for reusing results of identical searches
+        self.fingerprint: Optional[str] = None
+        # Proxy pool for requests, process-wide pool from settings is used if not set
+        self.proxy_pool: Optional[ProxyPool] = None
+        # Rate limiter shared by concurrent searches, e.g. in batch runs. Requests are not limited if not set
+        self.rate_limiter: Optional[RateLimiter] = None
+        # Class of the last response of the website and number of back offs in row
+        self.last_response_class: Optional[str] = None
+        # Queries which failed, results of the search are incomplete if it is not empty
+        self.failed_queries: list[str] = []
+        self._back_off_count = 0
+        # Peak memory of page parsing, the search is stopped when it exceeds search_memory_budget
+        self.memory_budget = MemoryBudget()
+        # Timeline of the search stages, saved to Redis and exported when the search is finished
+        self.trace = SearchTrace(search_uuid)
+
+        # Search progress, saved to Redis after each page for resuming after restart
+        self.checkpoint_key = f"{user_id}:{search_uuid}:checkpoint"
+        # Redis set with searches which are resumed by web workers
+        self.checkpoints_key = CHECKPOINTS_KEY
+        self._checkpoint: dict = {}
 
         # need to set min and max time for pause
         self.active_search_count = active_search_count if active_search_count > 0 else 1
-        # Load configuration from file
-        self.load_config('config.ini')
 
         # Use fake html from previously saved txt files
         self._use_fake_html = False
 
-    def load_config(self, config_file: str):
-        """
-        Load configuration from file
-        """
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        config = configparser.ConfigParser()
-        config.read(os.path.join(BASE_DIR, config_file))
-
-        self.base_url = config.get('settings', 'base_url', fallback='https://www.aliexpress.com/w/wholesale')
-        # Max number of result pages for parsing. After 8 pages results are often  not relevant
-        self.max_page = config.getint('settings', 'max_page', fallback=6)
-        # Max number of pages without new products in search result
-        self.max_zero_pages = config.getint('settings', 'max_zero_pages', fallback=2)
-        # Rechecking the product name for compliance with the search query
-        self.filter_result = config.getboolean('settings', 'filter_result', fallback=True)
-        # Enable pause between requests
-        self.enable_pause = config.getboolean('settings', 'enable_pause', fallback=True)
-        # Max pause time in seconds
-        self.max_pause_time = config.getint('settings', 'max_pause_time', fallback=5)
-
-        # Enable save results to JSON file
-        self.enable_save_to_json = config.getboolean('settings', 'enable_save_to_json', fallback=False)
-
     @staticmethod
     def _get_fake_html(search: str, page_number: int = None) -> str:
         """
@@ -91,15 +146,18 @@ class SearchEngine:
             html = ''
         return html
 
+    @traced()
     async def _get_html(self,
                         search: str,
                         page_number: int = None,
+                        store_id: str = None,
                         ) -> str:
         """
-        Gets HTML from page with global search results
+        Gets HTML from page with global search results or with search results in one store
     
         :param search:
         :param page_number:
+        :param store_id: id of the store for search in the store
         :return:
         """
 
@@ -107,44 +165,22 @@ class SearchEngine:
             self.max_page = 3
             return self._get_fake_html(search, page_number)
 
-        url = f"{self.base_url}-{search.replace(" ", "-").lower()}.html"
-        params = {
-            'spm': 'a2g0o.home.search.0',
-        }
+        if store_id:
+            url = self.store_search_url.format(store_id=store_id)
+            params = {
+                'SearchText': search,
+            }
+        else:
+            url = f"{self.base_url}-{search.replace(" ", "-").lower()}.html"
+            params = {
+                'spm': 'a2g0o.home.search.0',
+            }
         if page_number and page_number > 1:
             params["page"] = page_number
 
-        cookies = {
-            'ali_apache_id': '33.27.108.54.1723404130100.617835.3',
-            'intl_locale': 'en_US',
-            'xman_f': 'ucThPsuv3+lC89SvCHwqTCdL854B5E1ieBG6oDTwRN1ceTUmueNrMPrfSwJYhGjbvzMaI9sluzkkDaTzIF0xZqLCXPSV0qkaX6A7hFpatjtli/o1Id9yKg==',
-            'acs_usuc_t': 'x_csrf=yxmcfi63yjf1&acs_rt=980b8afaffed4b7a8af98bddbc0c6534',
-            'xman_t': 'LOFMSOzP81IKtPmbTj/In3BvOpim9o1qNNWptfPVjOFU0aNnOVPVYxZWlMN8pBij',
-            'AKA_A2': 'A',
-            'lwrid': 'AgGRQuQZqUXxbWOCpdUOX39uI6%2FK',
-            'join_status': '',
-            '_m_h5_tk': 'adccd53ae28e949142bcc05be23a18e8_1723406473036',
-            '_m_h5_tk_enc': 'e31ce6ca50be394561ec69ea5ffd8b80',
-            'ali_apache_track': '',
-            'ali_apache_tracktmp': '',
-            'e_id': 'pt70',
-            'lwrtk': 'AAEEZrl/44/jQR/CXe1j+RZXlsIMqnIlxU3OyqGYxfSazrgSka0MGOo=',
-            'cna': 'Zf0/H6rCtw4CAVqDLRHkBLc2',
-            'AB_DATA_TRACK': '472051_617391',
-            'AB_ALG': '',
-            'AB_STG': 'st_StrategyExp_1694492533501%23stg_687',
-            'aep_usuc_f': 'site=glo&c_tp=EUR&ups_d=1|1|1|1&ups_u_t=1738956388717&region=LT&b_locale=en_US&ae_u_p_s=2',
-            '_gcl_au': '1.1.1586149601.1723404389',
-            '_ga': 'GA1.1.1250008122.1723404382',
-            '_ga_VED1YSGNC7': 'GS1.1.1723404381.1.1.1723404440.8.0.0',
-            'isg': 'BLi4xkcMKqI-70YmrXroA-VxiWZKIRyrValO5PIpDvPSDVn3nTO1O-kvxR29XdSD',
-            'xman_us_f': 'x_locale=en_US&x_l=0&x_c_chg=1&acs_rt=980b8afaffed4b7a8af98bddbc0c6534',
-            'intl_common_forever': 'jRbrMvYq77NoV8HmjpgCftGx9o3O/i6FaGGXkjksqo3nRBX+l/vEqQ==',
-            'epssw': '5*mmLjaRkX5AhOAWhKR9WnA4YaZOfnnXoUNWmK0CSzHmYsp1eCLKpRh32I0VMRVCW2N5H_1xxlHhxmmhHvCnhwSheoZV8Rh32IGzNRVCWFEBMt_HSfprCRbFl8x58aaGCRGLrq_HGjjLSdt23Uu2KBozfgFWE18FDSvS5m9LZYm38hI9QnNEmNayKNWgL6acYtv_pmrr_djW8dsRQms2Ux0RIHMBbK035iM5mj0C7X7YFGzJYlNnVwzFzr8J0EGPV17GhdsRem8QQ3fbVJb8gfP_Wv8ZF6lW3lMqnfPhLIfpmhyWQhrHrzrtvmmX8IUrgDzuz89_XPcJ6FmXN_xTNy4SsyiPLMkBQJ5LlDA7dw7WcommmmmUwebREsfViZmheNo1PzVVh.',
-        }
-
         headers = {
             'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+            'accept-encoding': ACCEPT_ENCODING,
             'accept-language': 'ru-RU,ru;q=0.9',
             'cache-control': 'no-cache',
             'pragma': 'no-cache',
@@ -161,42 +197,172 @@ class SearchEngine:
             'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
         }
 
+        if self.rate_limiter:
+            with self.trace.span("rate_limit"):
+                await self.rate_limiter.acquire()
+
+        # Client of the proxy is shared by concurrent searches, so cookies of the session are sent in header
+        with self.trace.span("session_lease"):
+            session = await session_pool.lease(self.redis)
+        headers['cookie'] = session.cookie_header()
+
+        # Page is parsed while it is downloaded. Connection is closed when the data script and pagination are captured
+        # or when the beginning of the response shows that it is not a search results page
+        extractor = PageExtractor()
+        proxy_pool = self.proxy_pool or get_proxy_pool()
+        proxy = proxy_pool.acquire()
+        started_at = time.perf_counter()
+        response = None
+        response_class = None
         try:
-            async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=10.0)) as client:
-                client.cookies = cookies
-                response = await client.get(
-                    url,
-                    params=params,
-                    headers=headers,
-                )
-                response.raise_for_status()  # Raises an exception for 4xx/5xx responses
-        except HTTPStatusError as e:
-            msg = f"HTTP Error: {e.response.status_code}"
+            try:
+                async with proxy.client.stream("GET", url, params=params, headers=headers) as response:
+                    response_class = classify_response(response.status_code, response.headers)
+                    if response_class is None:
+                        head = []
+                        async for chunk in response.aiter_text():
+                            if head is not None:
+                                head.append(chunk)
+                                if sum(len(part) for part in head) < HEAD_SIZE:
+                                    continue
+                                chunk = "".join(head)
+                                head = None
+                                response_class = classify_response(response.status_code, response.headers, chunk)
+                                if response_class:
+                                    break
+                            extractor.feed(chunk)
+                            if extractor.is_complete:
+                                break
+                        if head:
+                            # Body is shorter than HEAD_SIZE
+                            chunk = "".join(head)
+                            response_class = classify_response(response.status_code, response.headers, chunk)
+                            extractor.feed(chunk)
+            except RequestError as e:
+                response_class = NETWORK_ERROR
+                msg = f"Request Error: {str(e)}"
+                await self.add_message(msg, DEBUG)
+            if response_class is None:
+                response_class = OK if "script" in extractor.parts else LAYOUT_CHANGED
+        finally:
+            # Proxy and session are returned to the pools also when the request is cancelled or fails unexpectedly,
+            # such request has no response class and is not counted as an error of the proxy
+            fetch_time = time.perf_counter() - started_at
+            challenged = response_class in (BLOCKED, CAPTCHA, LOGIN)
+            proxy_pool.release(proxy, fetch_time,
+                               error=response_class not in (OK, EMPTY, None) and not challenged,
+                               blocked=challenged,
+                               bytes_downloaded=response.num_bytes_downloaded if response else 0)
+            if response_class in ROTATE_SESSION_CLASSES:
+                await session_pool.retire(self.redis, session)
+            else:
+                await session_pool.release(self.redis, session,
+                                           response if response_class in (OK, EMPTY) else None,
+                                           challenged=response_class == BLOCKED)
+        self.last_response_class = response_class
+        classifier_stats.record(response_class)
+
+        page_fetch_seconds.labels(response_class).observe(fetch_time)
+        self.trace.annotate(response_class=response_class, proxy=proxy.name,
+                            downloaded=response.num_bytes_downloaded if response else 0)
+
+        if response_class == OK:
+            self._back_off_count = 0
+            msg = f"Processing {response.url} via {proxy.name}, downloaded {response.num_bytes_downloaded // 1024} KB"
+            await self.add_message(msg, DEBUG)
+            return extractor.get_html()
+        if response_class == EMPTY:
+            msg = f"Page {response.url} is not found, it is treated as page without products"
             await self.add_message(msg)
-            return 'error'
-        except RequestError as e:
-            msg = f"Request Error: {str(e)}"
+            return 'empty'
+        if response_class in ALERT_CLASSES:
+            msg = f"ALERT: {response.url} is not a search results page ({response_class}). Parser must be updated"
             await self.add_message(msg)
             return 'error'
+        if response_class != NETWORK_ERROR:
+            msg = f"Response is classified as {response_class} (HTTP {response.status_code}) via {proxy.name}"
+            await self.add_message(msg, DEBUG)
+        if response_class in BACK_OFF_CLASSES:
+            await self.back_off()
+        return 'error'
+
+    @property
+    def has_complete_results(self) -> bool:
+        """
+        All queries of the search were processed: no query failed and the memory budget was not exceeded
+        :return:
+        """
+        return not self.failed_queries and not self.memory_budget.exceeded
 
-        msg = f"Processing {response.url}"
-        await self.add_message(msg)
-        return response.text
+    @property
+    def search_keys(self) -> list[str]:
+        """
+        Keys "user_id:search_uuid" of this search and all its subscribers
+        :return:
+        """
+        return [f"{self.user_id}:{self.search_uuid}", *self.subscribers]
 
-    async def add_message(self, message: str):
+    async def subscribe(self, user_id, search_uuid):
+        """
+        Attach identical search to this one. Messages received so far are copied to the subscriber
+        :param user_id:
+        :param search_uuid:
+        :return:
+        """
+        subscriber_key = f"{user_id}:{search_uuid}"
+        await self.flush_messages()
+        messages = await self.redis.lrange(f"{self.user_id}:{self.search_uuid}:messages", 0, -1)
+        if messages:
+            await self.redis.rpush(f"{subscriber_key}:messages", *messages)
+        self.subscribers.append(subscriber_key)
+
+    def unsubscribe(self, user_id, search_uuid):
         """
-        Add message to message queue about search status
+        Detach identical search from this one
+        :param user_id:
+        :param search_uuid:
+        :return:
+        """
+        subscriber_key = f"{user_id}:{search_uuid}"
+        if subscriber_key in self.subscribers:
+            self.subscribers.remove(subscriber_key)
+
+    async def add_message(self, message: str, level: int = USER):
+        """
+        Add event about search status. User events are shown on the search page, debug events are written
+        only to the log. Doesn't wait for log output or Redis: user events are pushed to message queue in batches
         :param message:
+        :param level: USER or DEBUG
         :return:
         """
+        logger.log(level, message, extra={"search": self.search_uuid[-4:]})
+        if level >= USER:
+            time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self.messages.add(f"{time_str} - {message}")
 
-        time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        await self.redis.rpush(f"{self.user_id}:{self.search_uuid}:messages", f"{time_str} - {message}")
-        print(f"{time_str} - {self.search_uuid[-4:]} - {message}")
+    @traced()
+    async def flush_messages(self):
+        """
+        Push buffered user events to message queue
+        :return:
+        """
+        await self.messages.flush()
 
-    async def _get_next_page_number(self, soup: BeautifulSoup) -> int | str:
+    async def save_trace(self):
         """
-        Returns number of next page
+        Save timeline of the search to Redis for the search page and export it to collector
+        :return:
+        """
+        trace = self.trace.to_compact()
+        data = compress_json(trace)
+        for search_key in self.search_keys:
+            await self.redis.set(f"{search_key}:trace", data, ex=TRACE_TTL)
+        await otlp_exporter.export(trace, {"search.uuid": self.search_uuid, "user.id": str(self.user_id)})
+
+    @staticmethod
+    def _find_next_page_number(soup: BeautifulSoup) -> Optional[int]:
+        """
+        Returns number of next page, 0 for the last page or None if pagination is not found
     
         :param soup:
         :return:
@@ -204,25 +370,22 @@ class SearchEngine:
         try:
             active_page = int(soup.find("li", class_="comet-pagination-item-active").text.strip())
             page_count = int(soup.find_all("li", class_="comet-pagination-item")[-1].text.strip())
-        except (AttributeError, ValueError):
-            msg = "Can't find next page number"
-            await self.add_message(msg)
-            return 'error'
+        except (AttributeError, IndexError, ValueError):
+            return None
 
         return active_page + 1 if active_page < page_count else 0
 
-    async def _get_page_count(self, soup: BeautifulSoup) -> int | str:
+    @staticmethod
+    def _find_page_count(soup: BeautifulSoup) -> Optional[int]:
         """
-        Returns the number of pages in the search results
+        Returns the number of pages in the search results or None if pagination is not found
         :param soup:
         :return:
         """
         try:
             page_count = int(soup.find_all("li", class_="comet-pagination-item")[-1].text.strip())
-        except (AttributeError, ValueError):
-            msg = "Failed search numbers of page"
-            await self.add_message(msg)
-            return 'error'
+        except (IndexError, ValueError):
+            return None
 
         return page_count
 
@@ -280,9 +443,11 @@ class SearchEngine:
                 return True
         return False
 
-    async def _get_script_items(self, script: str) -> dict | str:
+    @traced()
+    def _get_script_items(self, script: str, messages: list[str]) -> dict | str:
         """
         Function searches in JSON array with products. Returns dictionary with product_info
+        or error message if products can't be found
         {
             "product_id": {
                     "product_id": product_id,
@@ -292,38 +457,41 @@ class SearchEngine:
         }
     
         :param script:
+        :param messages: list for messages about parsing
         :return:
     
-        First try to find part of string  and load it to JSON
+        First try to decode JSON from the script in place, without copying part of the script
         If it doesn't work, we use parsing the AST tree of the js script to access the variables
         """
 
-        #  First try to find part of string  and load it to JSON
+        #  First try to decode JSON from the position of the data object
 
-        pos_start = script.find('{"hierarchy"')
-        json_str = script[pos_start:-1]
         item_list = {}
-        products = {}
-        try:
-            json_list = json.loads(json_str)
-            item_list = json_list["data"]["root"]["fields"]["mods"]["itemList"]["content"]
-        except (json.JSONDecodeError, KeyError):
-            msg = "Failed to get JSON from javascript with string methods"
-            await self.add_message(msg)
+        pos_start = script.find('{"hierarchy"')
+        if pos_start != -1:
+            try:
+                json_list, _ = json.JSONDecoder().raw_decode(script, pos_start)
+                item_list = json_list["data"]["root"]["fields"]["mods"]["itemList"]["content"]
+                del json_list
+            except (json.JSONDecodeError, KeyError, TypeError):
+                pass
 
         # If it doesn't work, we use parsing the AST tree of the js script to access the variables
 
         if not item_list:
-            tree = es5(script)
-            script_data = ast_to_dict(tree)
+            messages.append("Failed to get JSON from javascript with string methods")
+            script_data = ast_to_dict(es5(script))
+            del script
             try:
                 item_list = script_data["window._dida_config_._init_data_"][
                     "data"]["data"]["root"]["fields"]["mods"]["itemList"]["content"]
             except KeyError:
-                msg = "Failed to parse javascript with calmjs methods"
-                await self.add_message(msg)
-                return 'error'
+                return "Failed to parse javascript with calmjs methods"
+            del script_data
+        else:
+            del script
 
+        products = {}
         for item in item_list:
             try:
                 product_id: int = int(self._get_nested_dict_item(item, "productId"))
@@ -345,20 +513,17 @@ class SearchEngine:
                     "store_link": f"https:{self._get_nested_dict_item(item, 'store', 'storeUrl')}",
                 }
             except KeyError as e:
-                msg = f"Can't find key {e} in JSON"
-                await self.add_message(msg)
-                return 'error'
+                return f"Can't find key {e} in JSON"
             except ValueError as e:
-                msg = f"Can't convert into int {e} in JSON"
                 # Save error item to file
                 with open('.errors.txt', 'a') as file:
                     # noinspection PyTypeChecker
                     json.dump(item, file, ensure_ascii=False, indent=4)
-                await self.add_message(msg)
-                return 'error'
+                return f"Can't convert into int {e} in JSON"
         return products
 
-    async def _parse_global_search_page(self, search: str, page: int = None, ) -> dict | str:
+    @traced()
+    async def _parse_global_search_page(self, search: str, page: int = None, store_id: str = None) -> dict | str:
         """
         The function parses the page with the global search results and returns a dictionary with products,
         the number of the next page and the total number of pages in the search results
@@ -372,47 +537,83 @@ class SearchEngine:
             'next_page': next_page,
             'page_count':page_count,
         }
+        Search page of the store has the same format, it is used with store_id
+
         :param search:
         :param page:
+        :param store_id: id of the store for search in the store
         :return:
         """
 
-        html = await self._get_html(search, page)
+        html = await self._get_html(search, page, store_id=store_id)
         if html == 'error':
             msg = "Failed to get HTML"
             await self.add_message(msg)
             return 'error'
-        soup = BeautifulSoup(html, features="lxml")
-        try:
-            script = soup.find("script",
-                               string=re.compile("window._dida_config_ =")
-                               ).text
-            # save_script(soup=soup, script_file= 'script.js')
-        except AttributeError:
+        if html == 'empty':
+            return {'products': {}, 'next_page': 0, 'page_count': page}
+        # Each stage releases its input before the next one starts, so the full page, the parsed tree,
+        # the script and the decoded JSON are not kept in memory at the same time
+        self.memory_budget.start(self.search_memory_budget * 1024 ** 2)
+        with self.trace.span("extract"), parse_stage_seconds.labels("extract").time():
+            extractor = PageExtractor()
+            extractor.feed(html)
+            del html
+        if "script" not in extractor.parts:
+            self.memory_budget.stop()
+            parse_errors.labels("no_script").inc()
             msg = "Failed to get JavaScript"
             await self.add_message(msg)
             return 'error'
-        products = {}
-        if script:
-            products = await self._get_script_items(script)
-        if products == 'error':
+        with self.trace.span("pagination"), parse_stage_seconds.labels("pagination").time():
+            soup = BeautifulSoup(extractor.parts.pop("pagination", ""), features="lxml")
+            next_page = self._find_next_page_number(soup)
+            page_count = self._find_page_count(soup)
+            soup.decompose()
+            del soup
+        script = extractor.parts.pop("script")[:-len("</script>")]
+        del extractor
+        messages = []
+        with parse_stage_seconds.labels("script").time():
+            products = self._get_script_items(script, messages)
+        peak = self.memory_budget.stop()
+        for msg in messages:
+            await self.add_message(msg, DEBUG)
+
+        if self.memory_budget.exceeded:
+            parse_errors.labels("memory_budget").inc()
+            msg = (f"Parsing of the page took {peak // 1024 ** 2} MB, memory budget "
+                   f"{self.search_memory_budget} MB is exceeded. Search is stopped")
+            await self.add_message(msg)
             return 'error'
-
-        next_page = await self._get_next_page_number(soup)
-        page_count = await self._get_page_count(soup)
-
-        if next_page == 'error' or page_count == 'error':
+        if isinstance(products, str):
+            parse_errors.labels("script").inc()
+            await self.add_message(products)
+            return 'error'
+        if next_page is None:
+            parse_errors.labels("next_page").inc()
+            msg = "Can't find next page number"
+            await self.add_message(msg)
+            return 'error'
+        if page_count is None:
+            parse_errors.labels("page_count").inc()
+            msg = "Failed search numbers of page"
+            await self.add_message(msg)
             return 'error'
 
+        products_per_page.observe(len(products))
         # filter product names for relevance to the request
         if self.filter_result:
-            start_len = len(products)
-            filtered_products = dict(filter(
-                lambda p: self._is_relevant(p[1]['title'], search=search),
-                products.items()))
-            products = filtered_products
+            with self.trace.span("filter"), parse_stage_seconds.labels("filter").time():
+                start_len = len(products)
+                filtered_products = dict(filter(
+                    lambda p: self._is_relevant(p[1]['title'], search=search),
+                    products.items()))
+                products = filtered_products
+            if start_len:
+                relevance_ratio.observe(len(products) / start_len)
             msg = f"Filtered {len(products)} from {start_len} products"
-            await self.add_message(msg)
+            await self.add_message(msg, DEBUG)
 
         sorted_products = dict(sorted(products.items(),
                                       key=lambda item: item[1]['sale_price']))
@@ -423,6 +624,7 @@ class SearchEngine:
                 'page_count': page_count,
                 }
 
+    @traced()
     async def _collect_product_stores(self, search: str) -> dict | str:
         """
         Returns a dictionary with the results of a global search for a single query,
@@ -439,10 +641,20 @@ class SearchEngine:
         :return:
         """
 
-        products = {}
-        next_page = 1
+        progress = self._checkpoint.get('query') or {}
+        if progress.get('search') != search:
+            progress = {
+                'search': search,
+                'products': {},
+                'next_page': 1,
+                'zero_pages_count': 0,
+            }
+        self._checkpoint['query'] = progress
+
+        products = progress['products']
+        next_page = progress['next_page']
         retry = 5
-        zero_pages_count = 0
+        zero_pages_count = progress['zero_pages_count']
         while next_page:
 
             if next_page > self.max_page:
@@ -456,8 +668,11 @@ class SearchEngine:
 
             page_data = await self._parse_global_search_page(search=search, page=next_page)
 
-            while page_data == 'error' and retry:
+            # Retrying is useless if the page can't be parsed
+            while (page_data == 'error' and retry and self.last_response_class not in ALERT_CLASSES
+                   and not self.memory_budget.exceeded):
                 await self.pause()
+                page_retries.inc()
                 page_data = await self._parse_global_search_page(search=search, page=next_page)
                 retry -= 1
 
@@ -466,18 +681,33 @@ class SearchEngine:
                 await self.add_message(msg)
                 return 'error'
 
+            new_count = 0
             for product_id, product in page_data['products'].items():
                 if product_id not in products:
                     products[product_id] = product
+                    new_count += 1
 
             page_count = page_data.get('page_count', None)
             msg = f'Processed {next_page}/{page_count} pages'
             await self.add_message(msg)
+            self._checkpoint.setdefault('completed_pages', []).append([search, next_page])
+            processed_page = next_page
             next_page = page_data.get('next_page', None)
 
             if len(page_data['products']) == 0:
                 zero_pages_count += 1
 
+            if next_page and self._is_low_yield_page(processed_page, new_count, len(page_data['products'])):
+                duplicate_rate = self._get_duplicate_rate(new_count, len(page_data['products']))
+                msg = (f'Low yield on page {processed_page} for "{search}": {new_count} new relevant products, '
+                       f'{duplicate_rate:.0%} already found. Skip remaining pages')
+                await self.add_message(msg)
+                next_page = None
+
+            progress['next_page'] = next_page
+            progress['zero_pages_count'] = zero_pages_count
+            await self.save_checkpoint()
+
             await self.pause()
 
         stores = {}
@@ -495,16 +725,111 @@ class SearchEngine:
 
         return stores
 
+    @staticmethod
+    def _get_duplicate_rate(new_count: int, page_products_count: int) -> float:
+        """
+        Returns share of relevant products on the page which were already found on previous pages
+        :param new_count:
+        :param page_products_count:
+        :return:
+        """
+        if not page_products_count:
+            return 0.0
+        return (page_products_count - new_count) / page_products_count
+
+    def _is_low_yield_page(self, page: int, new_count: int, page_products_count: int) -> bool:
+        """
+        Checks that next pages are not worth requesting: the page gave less than min_page_yield new relevant products
+        or more than max_duplicate_rate of its relevant products were already found.
+        First adaptive_min_pages pages are always processed
+
+        :param page: number of processed page
+        :param new_count: number of new relevant products on the page
+        :param page_products_count: number of relevant products on the page
+        :return:
+        """
+        if not self.adaptive_depth or page < self.adaptive_min_pages:
+            return False
+        return (new_count < self.min_page_yield
+                or self._get_duplicate_rate(new_count, page_products_count) > self.max_duplicate_rate)
+
+    @staticmethod
+    def _get_candidate_stores(all_stores: list[dict]) -> dict[str, str]:
+        """
+        Returns stores which were found by all processed product lists {store_link: store_id}
+        :param all_stores:
+        :return:
+        """
+        store_links = set.intersection(*(set(stores) for stores in all_stores))
+        return {store_link: next(iter(all_stores[0][store_link].values())).get('store_id')
+                for store_link in store_links}
+
+    def _use_store_verification(self, candidates: dict[str, str]) -> bool:
+        """
+        Chooses search in candidate stores instead of global search for remaining product lists.
+        Store search takes one request per candidate store and query, global search takes up to max_page requests
+        per query, so store search is used only for a small number of candidates
+
+        :param candidates: {store_link: store_id}
+        :return:
+        """
+        if not candidates or not all(candidates.values()):
+            return False
+        return len(candidates) <= self.store_verification_max_candidates and len(candidates) < self.max_page
+
+    @traced()
+    async def _verify_candidate_stores(self, search: str, candidates: dict[str, str]) -> dict | str:
+        """
+        Returns candidate stores which have products for the query, in the same format as _collect_product_stores.
+        Each store is checked by the first page of search results in the store
+
+        :param search:
+        :param candidates: {store_link: store_id}
+        :return:
+        """
+        stores = {}
+        for store_link, store_id in candidates.items():
+            page_data = await self._parse_global_search_page(search=search, page=1, store_id=store_id)
+            if page_data == 'error':
+                return 'error'
+            products = {product_id: product for product_id, product in page_data['products'].items()
+                        if str(product.get('store_id')) == str(store_id)}
+            if products:
+                stores[store_link] = products
+            await self.pause()
+
+        msg = f'Stores with products for request "{search}": {len(stores)} of {len(candidates)} candidates'
+        await self.add_message(msg)
+        return stores
+
+    @traced()
+    async def back_off(self):
+        """
+        Pause after block, captcha or server error. Pause grows exponentially while such responses repeat
+        :return:
+        """
+        if not self.enable_pause:
+            return
+        pause = min(BACK_OFF_TIME * 2 ** self._back_off_count, MAX_BACK_OFF_TIME)
+        self._back_off_count += 1
+        msg = f"Back off for {pause} seconds"
+        await self.add_message(msg)
+        pause_seconds.labels("back_off").inc(pause)
+        await asyncio.sleep(pause)
+
+    @traced()
     async def pause(self):
         if self.enable_pause:
             min_value = self.active_search_count - 1
             max_value = min_value + self.max_pause_time
             pause = random.randint(min_value, max_value)
             msg = f"Pause for {pause} second"
-            await self.add_message(msg)
+            await self.add_message(msg, DEBUG)
+            pause_seconds.labels("pause").inc(pause)
             await asyncio.sleep(pause)
 
-    async def intersection_in_global_search(self, queries_list: list):
+    @traced()
+    async def intersection_in_global_search(self, queries_list: list, resume: bool = False):
         """
         The function searches for products in the global search in turn.
         Returns a dictionary with stores that were found by different queries, where the keys are a link to the store,
@@ -517,23 +842,71 @@ class SearchEngine:
                 },
             },
         }
+        Progress is saved to Redis after each page. With resume=True the search continues from the saved checkpoint
 
         :param queries_list:
+        :param resume:
         :return:
         """
         # self.is_running = True
-        msg = "Start searching"
+        if resume and await self.load_checkpoint():
+            queries_list = self._checkpoint['queries_list']
+            msg = (f"Resume searching from checkpoint: "
+                   f"{len(self._checkpoint.get('completed_pages', []))} pages already processed")
+        else:
+            self._checkpoint = {
+                'user_id': self.user_id,
+                'search_uuid': self.search_uuid,
+                'active_search_count': self.active_search_count,
+                'fingerprint': self.fingerprint,
+                'queries_list': [list(search_list) for search_list in queries_list],
+                'all_stores': [],
+                'one_product_stores': {},
+                'completed_queries': [],
+                'completed_pages': [],
+                'query': None,
+            }
+            msg = "Start searching"
+        self._checkpoint['plan'] = self._get_remaining_plan()
+        await self.save_checkpoint()
         await self.add_message(msg)
 
         result_dict = {}
-        all_stores: list[dict] = []
-        for search_list in queries_list:
-            one_product_stores: dict = {}
+        all_stores: list[dict] = self._checkpoint['all_stores']
+        for list_index, search_list in enumerate(queries_list):
+            if list_index < len(all_stores):
+                # Results for this product are restored from checkpoint
+                continue
+            one_product_stores: dict = self._checkpoint['one_product_stores']
+            candidates = self._get_candidate_stores(all_stores) if all_stores else None
+            if candidates is not None and not candidates:
+                msg = 'No stores were found by all previous requests. Remaining requests are skipped'
+                await self.add_message(msg)
+                break
+            store_verification = candidates is not None and self._use_store_verification(candidates)
+            if store_verification:
+                msg = (f'{len(candidates)} candidate stores. '
+                       f'Requests "{" and ".join(search_list)}" are checked by search in the stores')
+                await self.add_message(msg)
+            self._checkpoint['verification'] = 'store' if store_verification else 'global'
             for search in search_list:
-                temp_stores = await self._collect_product_stores(search=search)
+                if search in self._checkpoint['completed_queries']:
+                    continue
+                temp_stores = None
+                if store_verification:
+                    temp_stores = await self._verify_candidate_stores(search=search, candidates=candidates)
+                    if temp_stores == 'error':
+                        msg = 'Failed to search in the stores. Global search is used'
+                        await self.add_message(msg)
+                        store_verification = False
+                        self._checkpoint['verification'] = 'global'
+                        temp_stores = None
+                if temp_stores is None:
+                    temp_stores = await self._collect_product_stores(search=search)
                 if temp_stores == 'error':
                     msg = 'Failed to parse page'
                     await self.add_message(msg)
+                    self.failed_queries.append(search)
                     break
                 # Results for different queries for one product save to one dictionary
                 for store, products in temp_stores.items():
@@ -541,7 +914,13 @@ class SearchEngine:
                         one_product_stores[store] = one_product_stores[store] | products
                     else:
                         one_product_stores[store] = products
+                self._checkpoint['completed_queries'].append(search)
+                self._checkpoint['query'] = None
+                self._checkpoint['plan'] = self._get_remaining_plan()
+                await self.save_checkpoint()
                 await self.pause()
+            if self.memory_budget.exceeded:
+                break
             # Save results for one product
             msg = f'Total stores by requests "{" and ".join(search_list)}" - {len(one_product_stores)}'
             await self.add_message(msg)
@@ -550,10 +929,17 @@ class SearchEngine:
                 self._save_report_as_json(one_product_stores, report_name)
 
             all_stores.append(one_product_stores)
+            self._checkpoint['one_product_stores'] = {}
+            self._checkpoint['completed_queries'] = []
+            self._checkpoint['plan'] = self._get_remaining_plan()
+            await self.save_checkpoint()
 
         # Get intersection of stores in results
         # intersection_stores = set.intersection(*map(set, (d.keys() for d in all_stores)))
-        intersection_stores = set.intersection(*(map(lambda d: set(d.keys()), all_stores)))
+        if all_stores and not self.memory_budget.exceeded:
+            intersection_stores = set.intersection(*(map(lambda d: set(d.keys()), all_stores)))
+        else:
+            intersection_stores = set()
 
         for store in intersection_stores:
             result_dict[store]: dict = {}
@@ -571,11 +957,74 @@ class SearchEngine:
         await self.add_message(msg)
         # self.is_running = False
         await self.save_search_results_to_redis(result_dict)
+        await self.delete_checkpoint()
+        await self.flush_messages()
         return result_dict
 
+    def _get_remaining_plan(self) -> list[list]:
+        """
+        Returns list of [list_index, search] pairs which are not processed yet
+        :return:
+        """
+        plan = []
+        done_lists = len(self._checkpoint['all_stores'])
+        for list_index, search_list in enumerate(self._checkpoint['queries_list']):
+            if list_index < done_lists:
+                continue
+            for search in search_list:
+                if list_index == done_lists and search in self._checkpoint['completed_queries']:
+                    continue
+                plan.append([list_index, search])
+        return plan
+
+    @traced()
+    async def save_checkpoint(self):
+        """
+        Save search progress into Redis: completed (query, page) pairs, collected stores and products,
+        and remaining plan
+        :return:
+        """
+        if not self._checkpoint:
+            return
+        await self.redis.set(self.checkpoint_key, json.dumps(self._checkpoint))
+        await self.redis.sadd(self.checkpoints_key, f"{self.user_id}:{self.search_uuid}")
+
+    async def load_checkpoint(self) -> bool:
+        """
+        Load search progress from Redis. Product ids are converted back to int after JSON
+        :return: True if checkpoint was found
+        """
+        data = await self.redis.get(self.checkpoint_key)
+        if not data:
+            return False
+        checkpoint = json.loads(data)
+
+        def restore_ids(stores: dict) -> dict:
+            return {store: {int(product_id): product for product_id, product in products.items()}
+                    for store, products in stores.items()}
+
+        checkpoint['all_stores'] = [restore_ids(stores) for stores in checkpoint['all_stores']]
+        checkpoint['one_product_stores'] = restore_ids(checkpoint['one_product_stores'])
+        if checkpoint.get('query'):
+            checkpoint['query']['products'] = {
+                int(product_id): product for product_id, product in checkpoint['query']['products'].items()
+            }
+        self._checkpoint = checkpoint
+        return True
+
+    async def delete_checkpoint(self):
+        """
+        Delete search progress from Redis when search is finished or stopped by user
+        :return:
+        """
+        self._checkpoint = {}
+        await self.redis.delete(self.checkpoint_key)
+        await self.redis.srem(self.checkpoints_key, f"{self.user_id}:{self.search_uuid}")
+
+    @traced()
     async def save_search_results_to_redis(self, results: dict):
         """
-        Save search result into Redis. All nested dictionaries are converted to JSON strings
+        Save search result and its index for pagination into Redis. Nested dictionaries are converted to JSON strings
         :param results:
         :return:
         """
@@ -590,4 +1039,8 @@ class SearchEngine:
             for key, value in serialized_results.items()
         }
 
-        await self.redis.hset(f"{self.user_id}:{self.search_uuid}:results", mapping=sanitized_results)
+        if not sanitized_results:
+            return
+        for search_key in self.search_keys:
+            await self.redis.hset(f"{search_key}:results", mapping=sanitized_results)
+            await self.redis.hset(f"{search_key}:results_index", mapping=build_results_index(results))
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Optional
+
+from redis.asyncio import Redis
+
+from app.core.settings import get_settings
+
+# Levels of search events. User events are shown on the search page, debug events are written only to the log
+USER = logging.INFO
+DEBUG = logging.DEBUG
+# Max delay in seconds and max number of buffered user events before they are pushed to Redis
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 50
+
+logger = logging.getLogger("search")
+_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging():
+    """
+    Attach non-blocking handler to the search logger. Records are put into queue by the event loop
+    and written to console by the listener thread. Level is taken from log_level setting
+    :return:
+    """
+    global _handler, _listener
+    logger.setLevel(get_settings().log_level.upper())
+    if _listener:
+        return
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(search)s - %(message)s",
+                                           defaults={"search": "-"}))
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, console)
+    _listener.start()
+    _handler = QueueHandler(log_queue)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+
+def stop_logging():
+    """
+    Write records which are left in the queue and detach the handler
+    :return:
+    """
+    global _handler, _listener
+    if not _listener:
+        return
+    logger.removeHandler(_handler)
+    _listener.stop()
+    _handler = None
+    _listener = None
+
+
+class MessageBuffer:
+    """
+    User events of the search which are pushed to Redis lists of the search and its subscribers in batches.
+    Events are pushed FLUSH_INTERVAL seconds after the first buffered event or when FLUSH_SIZE events are buffered,
+    so the search doesn't wait for Redis on each event
+    """
+
+    def __init__(self, redis: Redis, get_keys: Callable[[], list[str]]):
+        """
+        :param redis:
+        :param get_keys: returns current keys "user_id:search_uuid" which receive the events
+        """
+        self.redis = redis
+        self.get_keys = get_keys
+        self._entries: list[str] = []
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def add(self, entry: str):
+        """
+        Buffer the event and schedule flushing
+        :param entry:
+        :return:
+        """
+        self._entries.append(entry)
+        if len(self._entries) >= FLUSH_SIZE:
+            self._full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"Failed to push search messages: {e}")
+
+    async def flush(self):
+        """
+        Push buffered events to Redis
+        :return:
+        """
+        async with self._lock:
+            self._full.clear()
+            while self._entries:
+                entries, self._entries = self._entries, []
+                for key in self.get_keys():
+                    await self.redis.rpush(f"{key}:messages", *entries)
@@ -0,0 +1,93 @@
+import csv
+import io
+import json
+import zlib
+from typing import AsyncIterable, AsyncIterator
+
+# Columns of exported products, also order of columns in CSV
+EXPORT_FIELDS = (
+    "store_link",
+    "store_id",
+    "store_title",
+    "product_id",
+    "title",
+    "link",
+    "image",
+    "currency",
+    "original_price",
+    "sale_price",
+    "shipping",
+)
+# Size in bytes of the chunk sent to client. Rows are buffered up to this size to avoid tiny writes
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+async def ndjson_chunks(products: AsyncIterable[dict]) -> AsyncIterator[bytes]:
+    """
+    Yields products as newline delimited JSON, one product per line
+    :param products:
+    :return:
+    """
+    buffer = []
+    size = 0
+    async for product in products:
+        line = json.dumps({field: product.get(field) for field in EXPORT_FIELDS},
+                          ensure_ascii=False, separators=(',', ':')) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode('utf-8')
+
+
+async def csv_chunks(products: AsyncIterable[dict]) -> AsyncIterator[bytes]:
+    """
+    Yields products as CSV with header row
+    :param products:
+    :return:
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    async for product in products:
+        writer.writerow([product.get(field) for field in EXPORT_FIELDS])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+async def gzip_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Compresses stream of chunks into gzip format
+    :param chunks:
+    :return:
+    """
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(products: AsyncIterable[dict], export_format: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Returns stream of exported products in requested format
+    :param products:
+    :param export_format: "ndjson" or "csv"
+    :param compress: compress stream with gzip
+    :return:
+    """
+    chunks = csv_chunks(products) if export_format == "csv" else ndjson_chunks(products)
+    return gzip_chunks(chunks) if compress else chunks
@@ -3,7 +3,8 @@ from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from app.services.base import Base
 from app.models.models import User
-from app.models.models import Search
+from app.models.models import Search, SearchStore, SearchProduct
+from app.services.search_results import compress_json
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -46,6 +47,89 @@ def create_tables():
         print(f"Error occurred during table creation: {e}")
 
 
+def migrate_tables():
+    """
+    Update tables created by previous versions of the application. create_all() doesn't change existing tables,
+    so new columns and indexes are added here. All statements are idempotent
+    """
+    engine = create_engine(
+        f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+        echo=True,
+    )
+    statements = [
+        "ALTER TABLE searches ADD COLUMN IF NOT EXISTS results_count INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE searches
+        SET results_count = (SELECT COUNT(*) FROM json_object_keys(results))
+        WHERE results_count = 0 AND results IS NOT NULL AND json_typeof(results) = 'object'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_searches_user_id_created_at_id
+        ON searches (user_id, created_at DESC, id DESC)
+        """,
+        # Copy results saved as JSON into normalized tables. JSON column is kept as is
+        """
+        INSERT INTO search_stores (search_id, store_link, store_id, store_title)
+        SELECT s.id,
+               st.key,
+               (SELECT CASE WHEN p.value->>'store_id' ~ '^[0-9]+$' THEN (p.value->>'store_id')::bigint END
+                FROM json_each(st.value) AS p LIMIT 1),
+               (SELECT p.value->>'store_title' FROM json_each(st.value) AS p LIMIT 1)
+        FROM searches s, json_each(s.results) AS st
+        WHERE s.results IS NOT NULL AND json_typeof(s.results) = 'object'
+          AND NOT EXISTS (SELECT 1 FROM search_stores ss WHERE ss.search_id = s.id)
+        """,
+        """
+        INSERT INTO search_products (search_id, store_pk, product_id, title, link, image, currency,
+                                     original_price, sale_price, shipping)
+        SELECT ss.search_id,
+               ss.id,
+               p.key::bigint,
+               p.value->>'title',
+               p.value->>'link',
+               p.value->>'image',
+               p.value->>'currency',
+               CASE WHEN p.value->>'original_price' ~ '^[0-9]+(\\.[0-9]+)?$'
+                    THEN (p.value->>'original_price')::float END,
+               CASE WHEN p.value->>'sale_price' ~ '^[0-9]+(\\.[0-9]+)?$'
+                    THEN (p.value->>'sale_price')::float END,
+               p.value->>'shipping'
+        FROM search_stores ss
+        JOIN searches s ON s.id = ss.search_id,
+        json_each(s.results -> ss.store_link) AS p
+        WHERE p.key ~ '^[0-9]+$'
+          AND NOT EXISTS (SELECT 1 FROM search_products sp WHERE sp.store_pk = ss.id)
+        """,
+        "ALTER TABLE searches ADD COLUMN IF NOT EXISTS messages_compressed BYTEA",
+        "ALTER TABLE searches ADD COLUMN IF NOT EXISTS trace_compressed BYTEA",
+    ]
+    try:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+            compress_messages(connection)
+        print("Tables successfully migrated.")
+    except Exception as e:
+        print(f"Error occurred during table migration: {e}")
+
+
+def compress_messages(connection):
+    """
+    Move uncompressed message logs of saved searches into compressed column
+    :param connection:
+    :return:
+    """
+    rows = connection.execute(
+        text("SELECT id, messages FROM searches WHERE messages IS NOT NULL AND messages_compressed IS NULL")
+    )
+    for search_id, messages in rows.fetchall():
+        connection.execute(
+            text("UPDATE searches SET messages_compressed = :data, messages = NULL WHERE id = :id"),
+            {"data": compress_json(messages), "id": search_id},
+        )
+
+
 if __name__ == "__main__":
     create_database()
     create_tables()
+    migrate_tables()
@@ -1,7 +1,24 @@
 import os
+import time
 from typing import Optional
 import redis.asyncio as redis
 
+from app.metrics import redis_call_seconds
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Redis client which records time of each command. Commands of pipelines are sent by pipeline
+    and are not recorded
+    """
+
+    async def execute_command(self, *args, **options):
+        started_at = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_call_seconds.labels(str(args[0]).lower()).observe(time.perf_counter() - started_at)
+
 
 class RedisClient:
     """
@@ -27,7 +44,7 @@ class RedisClient:
                 redis_url = f"redis://:{redis_password}@{redis_host}:{redis_port}"
             else:
                 redis_url = f"redis://{redis_host}:{redis_port}"
-            self._redis = redis.from_url(redis_url)
+            self._redis = InstrumentedRedis.from_url(redis_url)
 
     def get_redis(self):
         if not self._redis:
@@ -53,5 +70,9 @@ class RedisClient:
                     await self._redis.delete(
                         f"{session_id}:{search_uuid}:messages",
                         f"{session_id}:{search_uuid}:results",
-                        f"{session_id}:{search_uuid}:is_finished"
+                        f"{session_id}:{search_uuid}:results_index",
+                        f"{session_id}:{search_uuid}:is_finished",
+                        f"{session_id}:{search_uuid}:checkpoint",
+                        f"{session_id}:{search_uuid}:lock",
+                        f"{session_id}:{search_uuid}:trace",
                     )
\ No newline at end of file
@@ -0,0 +1,497 @@
+import base64
+import binascii
+import json
+import zlib
+from typing import Optional
+
+from redis.asyncio import Redis
+from sqlalchemy import String, cast, func, insert, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.models import Search, SearchStore, SearchProduct
+
+# Sort fields of stores in paginated results. Stores with equal sort value are ordered by store link
+RESULTS_SORT_FIELDS = ("store", "price", "products")
+
+
+def _to_float(value) -> Optional[float]:
+    """
+    Convert price from search results into float. Empty and invalid values are saved as NULL
+    :param value:
+    :return:
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value) -> Optional[int]:
+    """
+    Convert id from search results into int. Empty and invalid values are saved as NULL
+    :param value:
+    :return:
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compress_json(data) -> bytes:
+    """
+    Serialize data to JSON and compress it
+    :param data:
+    :return:
+    """
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decompress_json(data: Optional[bytes]):
+    """
+    Decompress and deserialize data compressed by compress_json
+    :param data:
+    :return:
+    """
+    if data is None:
+        return None
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+async def save_search_stores(db: AsyncSession, search_id: int, stores: list[tuple[str, dict]]):
+    """
+    Insert stores and their products of the saved search with two bulk statements.
+    Transaction is not committed, so results can be saved in several batches
+
+    :param db:
+    :param search_id:
+    :param stores: list of (store_link, {product_id: product}) pairs
+    :return:
+    """
+    if not stores:
+        return
+    store_rows = []
+    for store_link, products in stores:
+        product = next(iter(products.values()), {})
+        store_rows.append({
+            "search_id": search_id,
+            "store_link": store_link,
+            "store_id": _to_int(product.get("store_id")),
+            "store_title": product.get("store_title"),
+        })
+    result = await db.execute(
+        insert(SearchStore).returning(SearchStore.id, SearchStore.store_link, sort_by_parameter_order=True),
+        store_rows,
+    )
+    store_pks = [row.id for row in result]
+
+    product_rows = []
+    for store_pk, (store_link, products) in zip(store_pks, stores):
+        for product_id, product in products.items():
+            product_rows.append({
+                "search_id": search_id,
+                "store_pk": store_pk,
+                "product_id": int(product_id),
+                "title": product.get("title"),
+                "link": product.get("link"),
+                "image": product.get("image"),
+                "currency": product.get("currency"),
+                "original_price": _to_float(product.get("original_price")),
+                "sale_price": _to_float(product.get("sale_price")),
+                "shipping": product.get("shipping"),
+            })
+    if product_rows:
+        await db.execute(insert(SearchProduct), product_rows)
+
+
+async def load_search_results(db: AsyncSession, search_id: int, offset: int = 0, limit: int = None) -> dict:
+    """
+    Returns results of saved search in the same format as search engine
+    {
+        store_link: {
+            product_id: {
+                title:  'product_title',
+                ...
+            },
+        },
+    }
+    :param db:
+    :param search_id:
+    :param offset: number of stores to skip
+    :param limit: max number of stores
+    :return:
+    """
+    stores_query = (
+        select(SearchStore.id)
+        .filter(SearchStore.search_id == search_id)
+        .order_by(SearchStore.id)
+        .offset(offset)
+        .limit(limit)
+    )
+    query = (
+        select(SearchStore, SearchProduct)
+        .outerjoin(SearchProduct, SearchProduct.store_pk == SearchStore.id)
+        .filter(SearchStore.id.in_(stores_query))
+        .order_by(SearchStore.id, SearchProduct.sale_price)
+    )
+    results = {}
+    for store, product in (await db.execute(query)).tuples():
+        store_products = results.setdefault(store.store_link, {})
+        if product is not None:
+            store_products[product.product_id] = product_to_dict(store, product)
+    return results
+
+
+async def _load_stores_products(db: AsyncSession, store_ids: list[int]) -> dict:
+    """
+    Returns products of the stores in the same format as search engine. Stores are in the order of store_ids
+    :param db:
+    :param store_ids:
+    :return:
+    """
+    if not store_ids:
+        return {}
+    query = (
+        select(SearchStore, SearchProduct)
+        .outerjoin(SearchProduct, SearchProduct.store_pk == SearchStore.id)
+        .filter(SearchStore.id.in_(store_ids))
+        .order_by(SearchProduct.sale_price)
+    )
+    stores = {}
+    for store, product in (await db.execute(query)).tuples():
+        store_link, store_products = stores.setdefault(store.id, (store.store_link, {}))
+        if product is not None:
+            store_products[product.product_id] = product_to_dict(store, product)
+    return dict(stores[store_id] for store_id in store_ids if store_id in stores)
+
+
+def encode_results_cursor(key: tuple) -> str:
+    """
+    Encodes (sort value, store link) of the last store on the page as url-safe string
+    :param key:
+    :return:
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def decode_results_cursor(cursor: str, sort: str) -> tuple:
+    """
+    Decodes cursor into (sort value, store link). Raises ValueError if cursor doesn't match the sort field
+    :param cursor:
+    :param sort:
+    :return:
+    """
+    try:
+        value, store_link = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (UnicodeError, binascii.Error, TypeError) as e:
+        raise ValueError(str(e))
+    value_types = (str,) if sort == "store" else (int, float)
+    if not isinstance(value, value_types) or isinstance(value, bool) or not isinstance(store_link, str):
+        raise ValueError("Cursor doesn't match sort field")
+    return value, store_link
+
+
+def summarize_store(products: dict) -> list:
+    """
+    Returns fields of the store which are needed to sort and filter stores without their products:
+    [lowest sale price, number of products, store title, store id]. Stores without prices have price 0
+    :param products:
+    :return:
+    """
+    prices = [price for price in (_to_float(product.get("sale_price")) for product in products.values())
+              if price is not None]
+    product = next(iter(products.values()), {})
+    return [min(prices, default=0.0), len(products), product.get("store_title"), product.get("store_id")]
+
+
+def build_results_index(results: dict) -> dict:
+    """
+    Returns index of live results {store_link: JSON of summarize_store()}. It is saved to Redis together with
+    the results, so pages of results are sorted and filtered without reading products of all stores
+    :param results:
+    :return:
+    """
+    return {store_link: json.dumps(summarize_store(products)) for store_link, products in results.items()
+            if isinstance(products, dict)}
+
+
+def summary_sort_key(store_link: str, summary: list, sort: str) -> tuple:
+    """
+    Returns sort key of the store by its summary: (sort value, store link)
+    :param store_link:
+    :param summary: result of summarize_store()
+    :param sort: one of RESULTS_SORT_FIELDS
+    :return:
+    """
+    if sort == "price":
+        return summary[0], store_link
+    if sort == "products":
+        return summary[1], store_link
+    return store_link, store_link
+
+
+def summary_matches(store_link: str, summary: list, store: str) -> bool:
+    """
+    Checks that store link or title contains filter string or store id is equal to it
+    :param store_link:
+    :param summary: result of summarize_store()
+    :param store:
+    :return:
+    """
+    store = store.lower()
+    return (store in store_link.lower()
+            or store in str(summary[2] or "").lower()
+            or store == str(summary[3]))
+
+
+def store_sort_key(store_link: str, products: dict, sort: str) -> tuple:
+    """
+    Returns sort key of the store: (sort value, store link)
+    :param store_link:
+    :param products:
+    :param sort: one of RESULTS_SORT_FIELDS
+    :return:
+    """
+    return summary_sort_key(store_link, summarize_store(products), sort)
+
+
+def store_matches(store_link: str, products: dict, store: str) -> bool:
+    """
+    Checks that store link or title contains filter string or store id is equal to it
+    :param store_link:
+    :param products:
+    :param store:
+    :return:
+    """
+    return summary_matches(store_link, summarize_store(products), store)
+
+
+def paginate_store_keys(keys: list[tuple], descending: bool, offset: int, limit: int,
+                        cursor: Optional[tuple] = None) -> tuple[list[tuple], Optional[tuple]]:
+    """
+    Sorts store keys and returns keys of one page and key of the last store if there are more pages.
+    Cursor has priority over offset
+    :param keys: list of (sort value, store link)
+    :param descending:
+    :param offset:
+    :param limit:
+    :param cursor: key of the last store of previous page
+    :return:
+    """
+    keys.sort(reverse=descending)
+    if cursor is not None:
+        keys = [key for key in keys if (key < cursor if descending else key > cursor)]
+    else:
+        keys = keys[offset:]
+    page = keys[:limit]
+    return page, page[-1] if len(keys) > limit else None
+
+
+async def load_live_results_page(redis: Redis, search_key: str, sort: str = "store", descending: bool = False,
+                                 store: str = None, offset: int = 0, limit: int = 50,
+                                 cursor: tuple = None) -> tuple[dict, int, Optional[tuple]]:
+    """
+    Returns page of the results of the search stored in Redis. Stores are sorted and filtered by the index
+    saved with the results (see build_results_index), products are read only for the stores of the page
+
+    :param redis:
+    :param search_key:
+    :param sort: one of RESULTS_SORT_FIELDS
+    :param descending:
+    :param store: filter by store link, title or id
+    :param offset:
+    :param limit:
+    :param cursor: key of the last store of previous page
+    :return: (results, total number of stores, key of the last store if there are more pages)
+    """
+    results_key = f"{search_key}:results"
+    keys = []
+    async for store_link, summary in redis.hscan_iter(f"{search_key}:results_index", count=500):
+        store_link = store_link.decode('utf-8')
+        summary = json.loads(summary)
+        if store and not summary_matches(store_link, summary, store):
+            continue
+        keys.append(summary_sort_key(store_link, summary, sort))
+    total = len(keys)
+    page, next_key = paginate_store_keys(keys, descending, offset, limit, cursor)
+    if not page:
+        return {}, total, None
+    values = await redis.hmget(results_key, [store_link for _, store_link in page])
+    results = {store_link: json.loads(value) for (_, store_link), value in zip(page, values) if value}
+    return results, total, next_key
+
+
+async def load_saved_results_page(db: AsyncSession, search: Search, sort: str = "store", descending: bool = False,
+                                  store: str = None, offset: int = 0, limit: int = 50,
+                                  cursor: tuple = None) -> tuple[dict, int, Optional[tuple]]:
+    """
+    Returns page of the results of saved search. Stores are sorted and paginated by DB,
+    cursor is used as keyset for (sort value, store link)
+
+    :param db:
+    :param search:
+    :param sort: one of RESULTS_SORT_FIELDS
+    :param descending:
+    :param store: filter by store link, title or id
+    :param offset:
+    :param limit:
+    :param cursor: key of the last store of previous page
+    :return: (results, total number of stores, key of the last store if there are more pages)
+    """
+    if search.results_count and not await db.scalar(select(SearchStore.id)
+                                                     .filter(SearchStore.search_id == search.id).limit(1)):
+        return await _load_legacy_results_page(db, search, sort, descending, store, offset, limit, cursor)
+
+    summary = (
+        select(SearchStore.id,
+               SearchStore.store_link,
+               func.coalesce(func.min(SearchProduct.sale_price), 0.0).label("price"),
+               func.count(SearchProduct.id).label("products"))
+        .outerjoin(SearchProduct, SearchProduct.store_pk == SearchStore.id)
+        .filter(SearchStore.search_id == search.id)
+        .group_by(SearchStore.id)
+    )
+    if store:
+        summary = summary.filter(or_(SearchStore.store_link.icontains(store, autoescape=True),
+                                     SearchStore.store_title.icontains(store, autoescape=True),
+                                     cast(SearchStore.store_id, String) == store))
+    summary = summary.subquery()
+    total = await db.scalar(select(func.count()).select_from(summary))
+
+    sort_column = {
+        "store": summary.c.store_link,
+        "price": summary.c.price,
+        "products": summary.c.products,
+    }[sort]
+    query = select(summary.c.id, sort_column, summary.c.store_link)
+    if cursor is not None:
+        key = tuple_(sort_column, summary.c.store_link)
+        query = query.filter(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+    else:
+        query = query.offset(offset)
+    if descending:
+        query = query.order_by(sort_column.desc(), summary.c.store_link.desc())
+    else:
+        query = query.order_by(sort_column.asc(), summary.c.store_link.asc())
+    # One extra row shows that there is one more page
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    next_key = tuple(rows[limit - 1][1:]) if len(rows) > limit else None
+    results = await _load_stores_products(db, [row[0] for row in rows[:limit]])
+    return results, total, next_key
+
+
+async def _load_legacy_results_page(db: AsyncSession, search: Search, sort: str, descending: bool, store: str,
+                                    offset: int, limit: int, cursor: tuple = None) -> tuple[dict, int, Optional[tuple]]:
+    """
+    Returns page of the results of search saved before normalized storage, results are only in JSON column
+    """
+    legacy_results = await db.scalar(select(Search.results).filter(Search.id == search.id)) or {}
+    keys = [store_sort_key(store_link, products, sort) for store_link, products in legacy_results.items()
+            if not store or store_matches(store_link, products, store)]
+    page, next_key = paginate_store_keys(keys, descending, offset, limit, cursor)
+    return {store_link: legacy_results[store_link] for _, store_link in page}, len(keys), next_key
+
+
+async def iter_live_products(redis: Redis, search_key: str, batch_size: int = 500):
+    """
+    Yields products of the search stored in Redis one by one. Stores are read by HSCAN in batches,
+    so the whole result is never loaded into memory
+    :param redis:
+    :param search_key:
+    :param batch_size: number of stores read from Redis in one call
+    :return:
+    """
+    async for store_link, products in redis.hscan_iter(f"{search_key}:results", count=batch_size):
+        store_link = store_link.decode('utf-8')
+        for product_id, product in json.loads(products).items():
+            yield {**product, "product_id": product.get("product_id", product_id), "store_link": store_link}
+
+
+async def iter_saved_products(session_factory, search_id: int, batch_size: int = 500):
+    """
+    Yields products of saved search one by one. Rows are streamed from DB by server side cursor.
+    Own session is used because the response is streamed after request dependencies are closed
+    :param session_factory: async_sessionmaker, e.g. SessionLocal
+    :param search_id:
+    :param batch_size: number of rows fetched from DB in one round trip
+    :return:
+    """
+    async with session_factory() as db:
+        query = (
+            select(SearchStore, SearchProduct)
+            .join(SearchProduct, SearchProduct.store_pk == SearchStore.id)
+            .filter(SearchStore.search_id == search_id)
+            .order_by(SearchStore.id, SearchProduct.id)
+            .execution_options(yield_per=batch_size)
+        )
+        has_rows = False
+        async for store, product in (await db.stream(query)).tuples():
+            has_rows = True
+            yield product_to_dict(store, product)
+        if has_rows:
+            return
+        # Searches saved before normalized storage have results only in JSON column
+        legacy_results = await db.scalar(select(Search.results).filter(Search.id == search_id)) or {}
+        for store_link, products in legacy_results.items():
+            for product_id, product in products.items():
+                yield {**product, "product_id": product.get("product_id", product_id), "store_link": store_link}
+
+
+def product_to_dict(store: SearchStore, product: SearchProduct) -> dict:
+    """
+    Returns product in the format of search engine
+    :param store:
+    :param product:
+    :return:
+    """
+    return {
+        "product_id": product.product_id,
+        "link": product.link,
+        "image": product.image,
+        "title": product.title,
+        "currency": product.currency,
+        "original_price": product.original_price,
+        "sale_price": product.sale_price,
+        "shipping": product.shipping,
+        "store_title": store.store_title,
+        "store_id": store.store_id,
+        "store_link": store.store_link,
+    }
+
+
+async def find_searches_by_store(db: AsyncSession, user_id: int, store_id: int) -> list[Search]:
+    """
+    Returns saved searches of the user which found the store
+    :param db:
+    :param user_id:
+    :param store_id:
+    :return:
+    """
+    query = (
+        select(Search)
+        .filter(Search.user_id == user_id,
+                Search.id.in_(select(SearchStore.search_id).filter(SearchStore.store_id == store_id)))
+        .order_by(Search.created_at.desc())
+    )
+    return list((await db.execute(query)).scalars())
+
+
+async def find_lowest_price(db: AsyncSession, user_id: int, product_id: int) -> Optional[tuple]:
+    """
+    Returns lowest recorded price of the product in saved searches of the user
+    :param db:
+    :param user_id:
+    :param product_id:
+    :return: (product, store, search) or None
+    """
+    query = (
+        select(SearchProduct, SearchStore, Search)
+        .join(SearchStore, SearchStore.id == SearchProduct.store_pk)
+        .join(Search, Search.id == SearchProduct.search_id)
+        .filter(Search.user_id == user_id,
+                SearchProduct.product_id == product_id,
+                SearchProduct.sale_price.is_not(None))
+        .order_by(SearchProduct.sale_price)
+        .limit(1)
+    )
+    return (await db.execute(query)).tuples().first()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
+from redis.asyncio import Redis
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from app.models.models import User
+from app.services.redis_client import RedisClient
+
+# Prefix of Redis keys with cached users and channel for invalidation messages to all workers
+USER_CACHE_KEY = "user_principal"
+USER_CACHE_CHANNEL = "user_principal:invalidate"
+
+
+class UserCache:
+    """
+    Two-tier cache of authenticated users: in-process dictionary with short TTL and shared Redis tier.
+    Only fields required for authorization are cached, password hash is never stored in cache
+    """
+
+    def __init__(self, local_ttl: int = 30, redis_ttl: int = 300, max_local_size: int = 10000):
+        self.local_ttl = local_ttl
+        self.max_local_size = max_local_size
+        self.redis_ttl = redis_ttl
+        self._local: dict[str, tuple[float, dict]] = {}
+        self.stats = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def _to_user(principal: dict) -> User:
+        """
+        Returns transient User object which is not attached to DB session
+        :param principal:
+        :return:
+        """
+        return User(**principal)
+
+    async def get(self, redis: Redis, username: str) -> Optional[User]:
+        """
+        Returns cached user or None
+        :param redis:
+        :param username:
+        :return:
+        """
+        entry = self._local.get(username)
+        if entry and entry[0] > time.monotonic():
+            self.stats["local_hits"] += 1
+            return self._to_user(entry[1])
+
+        data = await redis.get(f"{USER_CACHE_KEY}:{username}")
+        if data:
+            principal = json.loads(data)
+            self._local[username] = (time.monotonic() + self.local_ttl, principal)
+            self.stats["redis_hits"] += 1
+            return self._to_user(principal)
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, redis: Redis, user: User):
+        """
+        Save user into both tiers of cache
+        :param redis:
+        :param user:
+        :return:
+        """
+        principal = {
+            "id": user.id,
+            "username": user.username,
+            "email": user.email,
+            "disabled": user.disabled,
+        }
+        if len(self._local) >= self.max_local_size:
+            now = time.monotonic()
+            self._local = {key: entry for key, entry in self._local.items() if entry[0] > now}
+        self._local[user.username] = (time.monotonic() + self.local_ttl, principal)
+        await redis.set(f"{USER_CACHE_KEY}:{user.username}", json.dumps(principal), ex=self.redis_ttl)
+
+    def invalidate_local(self, username: str):
+        """
+        Remove user from in-process cache
+        :param username:
+        :return:
+        """
+        self._local.pop(username, None)
+
+    async def invalidate(self, redis: Redis, username: str):
+        """
+        Remove user from cache of all workers. Must be called when user is disabled or changed
+        :param redis:
+        :param username:
+        :return:
+        """
+        self.stats["invalidations"] += 1
+        self.invalidate_local(username)
+        await redis.delete(f"{USER_CACHE_KEY}:{username}")
+        await redis.publish(USER_CACHE_CHANNEL, username)
+
+    def schedule_invalidation(self, redis: Redis, username: str):
+        """
+        Invalidate user from synchronous code, e.g. SQLAlchemy events.
+        Local cache is cleared immediately, Redis tier and other workers are cleared by background task
+        :param redis:
+        :param username:
+        :return:
+        """
+        self.invalidate_local(username)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self.invalidate(redis, username))
+
+    async def listen_invalidations(self, redis: Redis):
+        """
+        Clear in-process cache by invalidation messages from other workers. Starts as task in lifespan
+        :param redis:
+        :return:
+        """
+        pubsub = redis.pubsub()
+        await pubsub.subscribe(USER_CACHE_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.invalidate_local(message["data"].decode('utf-8'))
+        finally:
+            await pubsub.aclose()
+
+    def get_metrics(self) -> dict:
+        """
+        Returns counters and hit rate of the cache
+        :return:
+        """
+        hits = self.stats["local_hits"] + self.stats["redis_hits"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "local_size": len(self._local),
+        }
+
+
+user_cache = UserCache()
+
+
+# Key of Session.info with usernames of users changed in the transaction
+CHANGED_USERS_KEY = "changed_usernames"
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _collect_changed_user(mapper, connection, target: User):
+    """
+    Remember user changed or deleted through ORM, including old username if it was changed.
+    Changes are not visible to other sessions until commit, so cache is invalidated after commit,
+    otherwise concurrent request could cache the old row again
+    """
+    session = object_session(target)
+    if session is None:
+        return
+    usernames = {target.username, *inspect(target).attrs.username.history.deleted}
+    session.info.setdefault(CHANGED_USERS_KEY, set()).update(username for username in usernames if username)
+
+
+@event.listens_for(User.username, "set", active_history=True)
+def _load_old_username(target: User, value, oldvalue, initiator):
+    """
+    Old username is loaded before it is changed, so it is in the history of the attribute even if
+    the attribute was expired, e.g. after rollback
+    """
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session: Session):
+    usernames = session.info.pop(CHANGED_USERS_KEY, None)
+    if not usernames:
+        return
+    redis = RedisClient().get_redis()
+    for username in usernames:
+        user_cache.schedule_invalidation(redis, username)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_users(session: Session):
+    session.info.pop(CHANGED_USERS_KEY, None)
@@ -0,0 +1,224 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.models import Search, Watch, WatchDiff
+from app.services.search_results import compress_json, load_search_results
+
+# Max delay in minutes which spreads runs of watches with the same schedule, chosen by id of the watch
+SCHEDULE_SPREAD_MINUTES = 30
+# Watches with this or longer interval are moved into off-peak hours
+OFF_PEAK_MIN_INTERVAL = 24
+
+
+def _price(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_hours(value: str) -> Optional[tuple[int, int]]:
+    """
+    Parse window of local hours "start-end", e.g. "1-6". End hour is not included, window can pass midnight.
+    Returns None for empty or invalid value
+    :param value:
+    :return:
+    """
+    try:
+        start, end = (int(hour) % 24 for hour in value.split("-"))
+    except ValueError:
+        return None
+    return start, end
+
+
+def next_run_time(now: datetime, interval_hours: int, watch_id: int,
+                  off_peak: Optional[tuple[int, int]] = None) -> datetime:
+    """
+    Returns time of the next run of the watch. Runs of different watches are spread by their ids,
+    so watches with the same interval don't start at once. Daily and longer intervals are moved to the slot
+    of the watch in off-peak window which is nearest to the end of the interval
+
+    :param now: time of the current run, timezone aware
+    :param interval_hours:
+    :param watch_id:
+    :param off_peak: window of local hours (start, end)
+    :return:
+    """
+    due = now + timedelta(hours=interval_hours)
+    if not off_peak or interval_hours < OFF_PEAK_MIN_INTERVAL:
+        return due + timedelta(minutes=watch_id * 7 % SCHEDULE_SPREAD_MINUTES)
+    start, end = off_peak
+    window_minutes = ((end - start) % 24 or 24) * 60
+    slot = timedelta(minutes=watch_id * 37 % window_minutes)
+    local_due = due.astimezone()
+    window_start = local_due.replace(hour=start, minute=0, second=0, microsecond=0)
+    slots = [window_start + timedelta(days=days) + slot for days in (-1, 0, 1)]
+    return min((s for s in slots if s > now), key=lambda s: abs(s - local_due))
+
+
+def build_snapshot(results: dict) -> dict:
+    """
+    Returns prices of found products {store_link: {product_id: sale_price}}, which are compared with the next run
+    :param results: results of the search engine
+    :return:
+    """
+    return {
+        store_link: {str(product_id): _price(product.get("sale_price")) for product_id, product in products.items()}
+        for store_link, products in results.items()
+    }
+
+
+def diff_results(snapshot: dict, results: dict) -> dict:
+    """
+    Compare results of the run with snapshot of the previous run
+    {
+        "added_stores": {store_link: {product_id: product}},
+        "removed_stores": [store_link],
+        "added_products": {store_link: {product_id: product}},
+        "removed_products": {store_link: [product_id]},
+        "price_changes": {store_link: {product_id: [old_price, new_price]}},
+    }
+    :param snapshot: snapshot of the previous run
+    :param results: results of the search engine
+    :return:
+    """
+    diff = {
+        "added_stores": {},
+        "removed_stores": [store_link for store_link in snapshot if store_link not in results],
+        "added_products": {},
+        "removed_products": {},
+        "price_changes": {},
+    }
+    for store_link, products in results.items():
+        old_prices = snapshot.get(store_link)
+        if old_prices is None:
+            diff["added_stores"][store_link] = products
+            continue
+        new_ids = set()
+        for product_id, product in products.items():
+            product_id = str(product_id)
+            new_ids.add(product_id)
+            price = _price(product.get("sale_price"))
+            if product_id not in old_prices:
+                diff["added_products"].setdefault(store_link, {})[product_id] = product
+            elif old_prices[product_id] != price:
+                diff["price_changes"].setdefault(store_link, {})[product_id] = [old_prices[product_id], price]
+        removed = [product_id for product_id in old_prices if product_id not in new_ids]
+        if removed:
+            diff["removed_products"][store_link] = removed
+    return diff
+
+
+def count_changed_products(diff: dict) -> int:
+    """
+    Number of added, removed and repriced products in stores which were found by both runs
+    :param diff:
+    :return:
+    """
+    return sum(len(diff[key].get(store_link, ()))
+               for key in ("added_products", "removed_products", "price_changes")
+               for store_link in diff[key])
+
+
+async def create_watch(db: AsyncSession, search: Search, user_id: int, interval_hours: int,
+                       off_peak: Optional[tuple[int, int]] = None) -> Watch:
+    """
+    Creates watch of saved search. Results of the saved search are the first snapshot
+    :param db:
+    :param search:
+    :param user_id:
+    :param interval_hours:
+    :param off_peak:
+    :return:
+    """
+    now = datetime.now().astimezone()
+    snapshot = build_snapshot(await load_search_results(db, search.id))
+    watch = Watch(search_id=search.id, user_id=user_id, interval_hours=interval_hours, next_run_at=now,
+                  snapshot=compress_json(snapshot))
+    db.add(watch)
+    await db.flush()
+    watch.next_run_at = next_run_time(now, interval_hours, watch.id, off_peak)
+    return watch
+
+
+async def get_due_watches(db: AsyncSession, now: datetime, limit: int) -> list[int]:
+    """
+    Returns ids of enabled watches which are due, the most overdue first
+    :param db:
+    :param now:
+    :param limit:
+    :return:
+    """
+    query = (
+        select(Watch.id)
+        .filter(Watch.enabled.is_(True), Watch.next_run_at <= now)
+        .order_by(Watch.next_run_at)
+        .limit(limit)
+    )
+    return list((await db.scalars(query)).all())
+
+
+async def save_watch_run(db: AsyncSession, watch: Watch, diff: dict, snapshot: dict, now: datetime,
+                         off_peak: Optional[tuple[int, int]] = None) -> Optional[WatchDiff]:
+    """
+    Saves changes found by the run and schedules the next run. Nothing but the snapshot is saved if results
+    are not changed
+    :param db:
+    :param watch:
+    :param diff:
+    :param snapshot:
+    :param now:
+    :param off_peak:
+    :return: saved changes or None
+    """
+    watch.snapshot = compress_json(snapshot)
+    watch.last_run_at = now
+    watch.next_run_at = next_run_time(now, watch.interval_hours, watch.id, off_peak)
+    changed_products = count_changed_products(diff)
+    if not diff["added_stores"] and not diff["removed_stores"] and not changed_products:
+        return None
+    watch_diff = WatchDiff(watch_id=watch.id,
+                           added_stores=len(diff["added_stores"]),
+                           removed_stores=len(diff["removed_stores"]),
+                           changed_products=changed_products,
+                           diff=compress_json(diff))
+    db.add(watch_diff)
+    await db.flush()
+    return watch_diff
+
+
+async def postpone_watch(db: AsyncSession, watch_id: int, until: datetime):
+    """
+    Moves next run of the watch after failed run
+    :param db:
+    :param watch_id:
+    :param until:
+    :return:
+    """
+    await db.execute(update(Watch).filter(Watch.id == watch_id).values(next_run_at=until))
+
+
+async def list_watches(db: AsyncSession, user_id: int) -> list[tuple[Watch, Search, int]]:
+    """
+    Returns watches of the user with watched searches and numbers of unseen changes
+    :param db:
+    :param user_id:
+    :return:
+    """
+    unseen = (
+        select(WatchDiff.watch_id, func.count(WatchDiff.id).label("unseen"))
+        .filter(WatchDiff.seen.is_(False))
+        .group_by(WatchDiff.watch_id)
+        .subquery()
+    )
+    query = (
+        select(Watch, Search, func.coalesce(unseen.c.unseen, 0))
+        .join(Search, Search.id == Watch.search_id)
+        .outerjoin(unseen, unseen.c.watch_id == Watch.id)
+        .filter(Watch.user_id == user_id)
+        .order_by(Watch.id)
+    )
+    return list((await db.execute(query)).tuples())
@@ -0,0 +1,189 @@
+import json
+import time
+import uuid
+from typing import Optional
+
+import httpx
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from app.core.settings import get_settings
+
+# Redis hash with sessions of the search engine {session_id: session JSON} and counter for round-robin leasing
+SESSIONS_KEY = "search_sessions"
+SESSIONS_CURSOR_KEY = "search_sessions:cursor"
+
+# Cookies of the new session. The site replaces them by its own cookies in responses
+SEED_COOKIES = {
+    'ali_apache_id': '33.27.108.54.1723404130100.617835.3',
+    'intl_locale': 'en_US',
+    'xman_f': 'ucThPsuv3+lC89SvCHwqTCdL854B5E1ieBG6oDTwRN1ceTUmueNrMPrfSwJYhGjbvzMaI9sluzkkDaTzIF0xZqLCXPSV0qkaX6A7hFpatjtli/o1Id9yKg==',
+    'acs_usuc_t': 'x_csrf=yxmcfi63yjf1&acs_rt=980b8afaffed4b7a8af98bddbc0c6534',
+    'xman_t': 'LOFMSOzP81IKtPmbTj/In3BvOpim9o1qNNWptfPVjOFU0aNnOVPVYxZWlMN8pBij',
+    'AKA_A2': 'A',
+    'lwrid': 'AgGRQuQZqUXxbWOCpdUOX39uI6%2FK',
+    'join_status': '',
+    '_m_h5_tk': 'adccd53ae28e949142bcc05be23a18e8_1723406473036',
+    '_m_h5_tk_enc': 'e31ce6ca50be394561ec69ea5ffd8b80',
+    'ali_apache_track': '',
+    'ali_apache_tracktmp': '',
+    'e_id': 'pt70',
+    'lwrtk': 'AAEEZrl/44/jQR/CXe1j+RZXlsIMqnIlxU3OyqGYxfSazrgSka0MGOo=',
+    'cna': 'Zf0/H6rCtw4CAVqDLRHkBLc2',
+    'AB_DATA_TRACK': '472051_617391',
+    'AB_ALG': '',
+    'AB_STG': 'st_StrategyExp_1694492533501%23stg_687',
+    'aep_usuc_f': 'site=glo&c_tp=EUR&ups_d=1|1|1|1&ups_u_t=1738956388717&region=LT&b_locale=en_US&ae_u_p_s=2',
+    '_gcl_au': '1.1.1586149601.1723404389',
+    '_ga': 'GA1.1.1250008122.1723404382',
+    '_ga_VED1YSGNC7': 'GS1.1.1723404381.1.1.1723404440.8.0.0',
+    'isg': 'BLi4xkcMKqI-70YmrXroA-VxiWZKIRyrValO5PIpDvPSDVn3nTO1O-kvxR29XdSD',
+    'xman_us_f': 'x_locale=en_US&x_l=0&x_c_chg=1&acs_rt=980b8afaffed4b7a8af98bddbc0c6534',
+    'intl_common_forever': 'jRbrMvYq77NoV8HmjpgCftGx9o3O/i6FaGGXkjksqo3nRBX+l/vEqQ==',
+    'epssw': '5*mmLjaRkX5AhOAWhKR9WnA4YaZOfnnXoUNWmK0CSzHmYsp1eCLKpRh32I0VMRVCW2N5H_1xxlHhxmmhHvCnhwSheoZV8Rh32IGzNRVCWFEBMt_HSfprCRbFl8x58aaGCRGLrq_HGjjLSdt23Uu2KBozfgFWE18FDSvS5m9LZYm38hI9QnNEmNayKNWgL6acYtv_pmrr_djW8dsRQms2Ux0RIHMBbK035iM5mj0C7X7YFGzJYlNnVwzFzr8J0EGPV17GhdsRem8QQ3fbVJb8gfP_Wv8ZF6lW3lMqnfPhLIfpmhyWQhrHrzrtvmmX8IUrgDzuz89_XPcJ6FmXN_xTNy4SsyiPLMkBQJ5LlDA7dw7WcommmmmUwebREsfViZmheNo1PzVVh.',
+}
+
+
+class Session:
+    """
+    Browser-like session of the search engine with cookie jar, which is updated by cookies from responses
+    """
+
+    def __init__(self, session_id: str = None, cookies: dict = None, requests: int = 0,
+                 challenges_in_row: int = 0, created_at: float = None):
+        self.id = session_id or uuid.uuid4().hex
+        self.cookies = dict(SEED_COOKIES if cookies is None else cookies)
+        self.requests = requests
+        self.challenges_in_row = challenges_in_row
+        self.created_at = created_at or time.time()
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "Session":
+        return cls(**json.loads(data))
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "session_id": self.id,
+            "cookies": self.cookies,
+            "requests": self.requests,
+            "challenges_in_row": self.challenges_in_row,
+            "created_at": self.created_at,
+        })
+
+    def cookie_header(self) -> str:
+        """
+        Returns value of Cookie header of the request
+        :return:
+        """
+        return "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+
+    def update_cookies(self, response: httpx.Response):
+        """
+        Save cookies set by the response
+        :param response:
+        :return:
+        """
+        for cookie in response.cookies.jar:
+            self.cookies[cookie.name] = cookie.value
+
+
+class SessionPool:
+    """
+    Pool of sessions stored in Redis and shared by all workers. Sessions are leased to requests round-robin,
+    session is retired when it is challenged several times in row and replaced by new one
+    """
+
+    def __init__(self):
+        self.stats = {
+            "leases": 0,
+            "created": 0,
+            "retired": 0,
+            "challenges": 0,
+        }
+
+    async def _create(self, redis: Redis) -> Session:
+        """
+        Create new session and save it to Redis
+        :param redis:
+        :return:
+        """
+        session = Session()
+        await redis.hset(SESSIONS_KEY, session.id, session.to_json())
+        self.stats["created"] += 1
+        return session
+
+    async def lease(self, redis: Redis) -> Session:
+        """
+        Returns next session for the request. Pool is filled up to session_pool_size sessions
+        :param redis:
+        :return:
+        """
+        self.stats["leases"] += 1
+        session_ids = sorted(session_id.decode('utf-8') for session_id in await redis.hkeys(SESSIONS_KEY))
+        if len(session_ids) < get_settings().session_pool_size:
+            return await self._create(redis)
+        index = await redis.incr(SESSIONS_CURSOR_KEY)
+        data = await redis.hget(SESSIONS_KEY, session_ids[index % len(session_ids)])
+        if data is None:
+            # Session was retired by another request
+            return await self._create(redis)
+        return Session.from_json(data)
+
+    async def release(self, redis: Redis, session: Session, response: Optional[httpx.Response] = None,
+                      challenged: bool = False):
+        """
+        Save cookies from response into the session or retire the session if it is challenged too often.
+        The session is updated in a transaction watching the pool, so concurrent releases of the same session
+        don't overwrite each other and a session retired by another request is not saved again
+        :param redis:
+        :param session:
+        :param response: response of the request, cookies are not changed without response
+        :param challenged: the site answered with captcha or block instead of the page
+        :return:
+        """
+        if challenged:
+            self.stats["challenges"] += 1
+        elif response is None:
+            return
+
+        async def update(pipe: Pipeline) -> bool:
+            data = await pipe.hget(SESSIONS_KEY, session.id)
+            if data is None:
+                # Session was retired by another request
+                return False
+            stored = Session.from_json(data)
+            pipe.multi()
+            if challenged:
+                stored.challenges_in_row += 1
+                if stored.challenges_in_row >= get_settings().session_max_challenges:
+                    pipe.hdel(SESSIONS_KEY, session.id)
+                    return True
+            else:
+                stored.challenges_in_row = 0
+                stored.requests += 1
+                stored.update_cookies(response)
+            pipe.hset(SESSIONS_KEY, session.id, stored.to_json())
+            return False
+
+        if await redis.transaction(update, SESSIONS_KEY, value_from_callable=True):
+            self.stats["retired"] += 1
+
+    async def retire(self, redis: Redis, session: Session):
+        """
+        Remove session from the pool
+        :param redis:
+        :param session:
+        :return:
+        """
+        self.stats["retired"] += 1
+        await redis.hdel(SESSIONS_KEY, session.id)
+
+    def get_metrics(self) -> dict:
+        """
+        Returns counters of the pool in this worker
+        :return:
+        """
+        return dict(self.stats)
+
+
+session_pool = SessionPool()
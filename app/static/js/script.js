@@ -4,10 +4,37 @@ const LONG_PRESS_DURATION = 500;
 
 document.addEventListener("DOMContentLoaded", function () {
 
-  const resultsData = JSON.parse(document.getElementById("results-data").value || "{}");
-  const messagesList = JSON.parse(document.getElementById("messages-list").value || "[]");
-  loadMessages(messagesList);
-  loadResults(resultsData);
+  const savedSearchUuid = document.getElementById("saved-search-uuid").value;
+  if (savedSearchUuid) {
+    //saved search loads results page by page and messages only on demand
+    fetchResults(true);
+    fetchTrace();
+    document.getElementById("show-messages-button").addEventListener("click", function () {
+      fetchSavedMessages(savedSearchUuid);
+    });
+  } else {
+    const messagesList = JSON.parse(document.getElementById("messages-list").value || "[]");
+    loadMessages(messagesList);
+    loadResults({});
+  }
+
+  if (document.getElementById("export-links")) {
+    document.getElementById("export-ndjson").href = "/search/" + getSearchUuid() + "/export?format=ndjson";
+    document.getElementById("export-csv").href = "/search/" + getSearchUuid() + "/export?format=csv";
+  }
+
+  document.getElementById("more-results-button").addEventListener("click", function () {
+    fetchResults(false);
+  });
+  document.getElementById("results-sort").addEventListener("change", function () {
+    fetchResults(true);
+  });
+  document.getElementById("results-order").addEventListener("change", function () {
+    fetchResults(true);
+  });
+  document.getElementById("results-store").addEventListener("change", function () {
+    fetchResults(true);
+  });
 
   document.getElementById("add-to-list1").addEventListener("click", function () {
     addOption('namesList1', 'input1');
@@ -161,15 +188,14 @@ function fetchMessages() {
         messagesListField.value = JSON.stringify(messagesList); //save messages to hidden field
       }
 
-      //check if response has result block, timer should stop
-      if (data.results) {
-
-        loadResults(data.results);  //load results to results-container
-        const resultsListField = document.getElementById("results-data");
-        resultsListField.value = JSON.stringify(data.results); //save results to hidden field
+      //number of found stores changed, first page of results is reloaded
+      if (data.results_count && data.results_count !== resultsCount) {
+        resultsCount = data.results_count;
+        fetchResults(true);
       }
       if (data.search_finished ) {
         clearInterval(fetchInterval);
+        fetchTrace();
         document.getElementById("search-button").disabled = false;
         document.getElementById("save-button").disabled = false;
       }
@@ -217,27 +243,15 @@ function stopSearch() {
 }
 
 //function sends save command to server for save search
+//messages and results are moved to database from server storage, so only search uuid is sent
 function saveSearch() {
   document.getElementById("save-button").disabled = true;
-  let namesList1 = Array.from(document.getElementById("namesList1").options).map((option) => option.value);
-  let namesList2 = Array.from(document.getElementById("namesList2").options).map((option) => option.value);
-  const messagesList = JSON.parse(document.getElementById("messages-list").value || "[]");
-  const resultsData = JSON.parse(document.getElementById("results-data").value || "{}");
 
   const url = window.location.href;
   const uuid = url.split('/').pop();
 
   fetch("/search/" + uuid + "/save", {
     method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-    },
-    body: JSON.stringify({
-      names_list1: namesList1,
-      names_list2: namesList2,
-      messages: messagesList,
-      results: resultsData,
-    }),
   })
     .then((response) => {
       return response.json();
@@ -270,8 +284,16 @@ function loadResults(resultData) {
     return;
   }
 
+  appendResults(resultData, 1);
+  resultsContainer.scrollTop = resultsContainer.scrollHeight;
+}
+
+//function appends results from dictionary to results-container, numbering of stores begins from start
+function appendResults(resultData, start) {
+  const resultsContainer = document.getElementById("results-container");
   const ol = document.createElement("ol");
   ol.classList.add("list-decimal", "pl-6");
+  ol.start = start;
   const aClassNames = ["text-red-600", "hover:text-red-900", "hover:underline"];
 
   for (const [key, value] of Object.entries(resultData)) {
@@ -307,7 +329,67 @@ function loadResults(resultData) {
   }
 
   resultsContainer.appendChild(ol);
-  resultsContainer.scrollTop = resultsContainer.scrollHeight;
+}
+
+//function returns uuid of saved search or active search from page url
+function getSearchUuid() {
+  return document.getElementById("saved-search-uuid").value || window.location.href.split('/').pop();
+}
+
+//function loads page of results sorted and filtered on server, reset starts from the first page
+let resultsCursor = null;
+let resultsShown = 0;
+let resultsCount = 0;
+function fetchResults(reset) {
+  const moreButton = document.getElementById("more-results-button");
+  moreButton.disabled = true;
+  if (reset) {
+    resultsCursor = null;
+    resultsShown = 0;
+  }
+  const params = new URLSearchParams({
+    sort: document.getElementById("results-sort").value,
+    order: document.getElementById("results-order").value,
+  });
+  const store = document.getElementById("results-store").value.trim();
+  if (store) {
+    params.set("store", store);
+  }
+  if (resultsCursor) {
+    params.set("cursor", resultsCursor);
+  }
+  fetch("/search/" + getSearchUuid() + "/results?" + params.toString())
+    .then((response) => response.json())
+    .then((data) => {
+      if (resultsShown === 0) {
+        loadResults(data.results);
+      } else {
+        appendResults(data.results, resultsShown + 1);
+      }
+      resultsShown += Object.keys(data.results || {}).length;
+      resultsCursor = data.next_cursor;
+      moreButton.disabled = false;
+      moreButton.classList.toggle("hidden", !data.next_cursor);
+    })
+    .catch((error) => console.error("Error fetching results:", error));
+}
+
+//function loads next page of message log of saved search
+let savedMessagesOffset = 0;
+function fetchSavedMessages(uuid) {
+  const showButton = document.getElementById("show-messages-button");
+  showButton.disabled = true;
+  fetch("/history/search/" + uuid + "/messages?offset=" + savedMessagesOffset)
+    .then((response) => response.json())
+    .then((data) => {
+      const messages = data.messages || [];
+      loadMessages(messages);
+      savedMessagesOffset += messages.length;
+      showButton.disabled = false;
+      showButton.textContent = "Show more messages";
+      showButton.classList.toggle("hidden", savedMessagesOffset >= data.total);
+    })
+    .catch((error) => console.error("Error fetching messages:", error));
 }
 
 
@@ -321,3 +403,78 @@ function loadMessages(messagesList) {
   });
   messagesContainer.scrollTop = messagesContainer.scrollHeight;
 }
+
+//function loads timeline of finished search and shows it as waterfall
+const MAX_TRACE_ROWS = 1000;
+function fetchTrace() {
+  fetch("/search/" + getSearchUuid() + "/trace")
+    .then((response) => response.ok ? response.json() : {})
+    .then((data) => {
+      if (data.trace) {
+        loadTrace(data.trace);
+      }
+    })
+    .catch((error) => console.error("Error fetching trace:", error));
+}
+
+//function draws spans [name, parent, start, duration, attributes] as bars on common time scale
+//and sums time of each stage without time of its nested stages
+function loadTrace(trace) {
+  const spans = trace.spans;
+  if (!spans.length) {
+    return;
+  }
+  const total = Math.max(...spans.map((span) => span[2] + span[3]), 1);
+  const depths = [];
+  const selfTimes = {};
+  spans.forEach((span, index) => {
+    const [nameIndex, parent, , duration] = span;
+    depths[index] = parent >= 0 ? depths[parent] + 1 : 0;
+    const name = trace.names[nameIndex];
+    selfTimes[name] = (selfTimes[name] || 0) + duration;
+    if (parent >= 0) {
+      const parentName = trace.names[spans[parent][0]];
+      selfTimes[parentName] -= duration;
+    }
+  });
+
+  const summary = Object.entries(selfTimes)
+    .sort((a, b) => b[1] - a[1])
+    .slice(0, 5)
+    .map(([name, time]) => name + " " + (time / 1e6).toFixed(1) + " s");
+  document.getElementById("trace-summary").textContent =
+    "Total " + (total / 1e6).toFixed(1) + " s: " + summary.join(", ");
+
+  const container = document.getElementById("trace-container");
+  container.innerHTML = "";
+  spans.slice(0, MAX_TRACE_ROWS).forEach((span, index) => {
+    const [nameIndex, , start, duration, attributes] = span;
+    const row = document.createElement("div");
+    row.className = "flex flex-row items-center gap-2";
+    const label = document.createElement("div");
+    label.className = "w-1/3 truncate";
+    label.style.paddingLeft = depths[index] + "em";
+    const details = Object.entries(attributes || {}).map(([key, value]) => key + "=" + value).join(" ");
+    label.textContent = trace.names[nameIndex] + " " + (duration / 1000).toFixed(1) + " ms";
+    label.title = details;
+    const lane = document.createElement("div");
+    lane.className = "w-2/3 relative h-3";
+    const bar = document.createElement("div");
+    bar.className = "absolute h-3 rounded " + (attributes && attributes.error ? "bg-red-800" : "bg-red-400");
+    bar.style.left = (start / total * 100) + "%";
+    bar.style.width = Math.max(duration / total * 100, 0.2) + "%";
+    bar.title = details;
+    lane.appendChild(bar);
+    row.appendChild(label);
+    row.appendChild(lane);
+    container.appendChild(row);
+  });
+  if (spans.length > MAX_TRACE_ROWS || trace.dropped) {
+    const note = document.createElement("p");
+    note.textContent = (spans.length - Math.min(spans.length, MAX_TRACE_ROWS) + trace.dropped) + " more stages are not shown";
+    container.appendChild(note);
+  }
+  const section = document.getElementById("trace-section");
+  section.classList.remove("hidden");
+  section.classList.add("flex");
+}
@@ -0,0 +1,237 @@
+import contextvars
+import functools
+import inspect
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+
+from app.core.settings import get_settings
+from app.search_log import logger
+
+# Max number of spans kept for one search, further spans are counted as dropped
+MAX_SPANS = 5000
+# Arguments of traced methods which are recorded as attributes of the span
+TRACED_ARGUMENTS = ("search", "page", "page_number", "store_id")
+# Name of the service in exported traces
+SERVICE_NAME = "alisearch"
+# Timeout in seconds of export request to the collector
+EXPORT_TIMEOUT = 5
+
+# Trace and index of the open span in the current task
+_current_span: contextvars.ContextVar[Optional[tuple["SearchTrace", int]]] = contextvars.ContextVar(
+    "current_span", default=None)
+
+
+class SearchTrace:
+    """
+    Timeline of one search. Spans are kept as compact rows [name, parent, start, duration, attributes],
+    times in microseconds from the start of the trace. Parent of a new span is the open span of the trace
+    in the same task, so calls from other tasks, e.g. flushing of messages by request handler, are root spans
+    """
+
+    def __init__(self, search_uuid: str):
+        # Trace id is the uuid of the search, so the trace in collector is found by the search
+        try:
+            self.trace_id = uuid.UUID(search_uuid).hex
+        except ValueError:
+            self.trace_id = uuid.uuid5(uuid.NAMESPACE_OID, search_uuid).hex
+        self.start_time = time.time_ns() // 1000
+        self._started_at = time.perf_counter_ns()
+        self.spans: list[list] = []
+        self.dropped = 0
+
+    def _now(self) -> int:
+        return (time.perf_counter_ns() - self._started_at) // 1000
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Record time of the block as span. Exception raised in the block is recorded in "error" attribute
+        :param name:
+        :param attributes:
+        :return:
+        """
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            yield
+            return
+        current = _current_span.get()
+        parent = current[1] if current and current[0] is self else -1
+        row = [name, parent, self._now(), 0, {k: v for k, v in attributes.items() if v is not None} or None]
+        token = _current_span.set((self, len(self.spans)))
+        self.spans.append(row)
+        try:
+            yield
+        except BaseException as e:
+            row[4] = (row[4] or {}) | {"error": type(e).__name__}
+            raise
+        finally:
+            row[3] = self._now() - row[2]
+            _current_span.reset(token)
+
+    def annotate(self, **attributes):
+        """
+        Add attributes to the open span of the trace in the current task, e.g. results of the traced call
+        :param attributes:
+        :return:
+        """
+        current = _current_span.get()
+        if current and current[0] is self:
+            row = self.spans[current[1]]
+            row[4] = (row[4] or {}) | attributes
+
+    def to_compact(self) -> dict:
+        """
+        Returns the trace with span names replaced by indexes in the list of names
+        {
+            "trace_id": trace_id,
+            "start": start_time,
+            "names": [name],
+            "spans": [[name_index, parent, start, duration, attributes]],
+            "dropped": dropped,
+        }
+        :return:
+        """
+        names = {}
+        spans = [[names.setdefault(name, len(names)), parent, start, duration, attributes]
+                 for name, parent, start, duration, attributes in self.spans]
+        return {
+            "trace_id": self.trace_id,
+            "start": self.start_time,
+            "names": list(names),
+            "spans": spans,
+            "dropped": self.dropped,
+        }
+
+
+def traced(name: str = None):
+    """
+    Decorator for sync and async methods of the search engine, which records the call as span
+    of engine's trace. Arguments from TRACED_ARGUMENTS are recorded as attributes
+    :param name: name of the span, name of the method by default
+    :return:
+    """
+
+    def decorator(method):
+        span_name = name or method.__name__.lstrip("_")
+        signature = inspect.signature(method)
+        traced_arguments = [argument for argument in TRACED_ARGUMENTS if argument in signature.parameters]
+
+        def get_attributes(args, kwargs) -> dict:
+            if not traced_arguments:
+                return {}
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            return {argument: bound.get(argument) for argument in traced_arguments}
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                with self.trace.span(span_name, **get_attributes((self, *args), kwargs)):
+                    return await method(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.trace.span(span_name, **get_attributes((self, *args), kwargs)):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(trace: dict, attributes: dict = None) -> dict:
+    """
+    Convert compact trace into OTLP/HTTP JSON request
+    :param trace: trace from SearchTrace.to_compact
+    :param attributes: attributes of the resource, e.g. user id
+    :return:
+    """
+    spans = []
+    for index, (name_index, parent, start, duration, span_attributes) in enumerate(trace["spans"]):
+        start_time = (trace["start"] + start) * 1000
+        span = {
+            "traceId": trace["trace_id"],
+            "spanId": f"{index + 1:016x}",
+            "name": trace["names"][name_index],
+            # Internal span
+            "kind": 1,
+            "startTimeUnixNano": str(start_time),
+            "endTimeUnixNano": str(start_time + duration * 1000),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in (span_attributes or {}).items()],
+        }
+        if parent >= 0:
+            span["parentSpanId"] = f"{parent + 1:016x}"
+        if span_attributes and "error" in span_attributes:
+            span["status"] = {"code": 2, "message": span_attributes["error"]}
+        spans.append(span)
+    resource_attributes = {"service.name": SERVICE_NAME, **(attributes or {})}
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": key, "value": _otlp_value(value)}
+                                        for key, value in resource_attributes.items()]},
+            "scopeSpans": [{"scope": {"name": "app.search_engine"}, "spans": spans}],
+        }],
+    }
+
+
+class OtlpExporter:
+    """
+    Sends traces of finished searches to OpenTelemetry collector by OTLP/HTTP with JSON encoding.
+    Traces are not exported if otlp_endpoint setting is empty
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = {
+            "exported": 0,
+            "failed": 0,
+        }
+
+    async def export(self, trace: dict, attributes: dict = None) -> bool:
+        """
+        Export the trace. Errors of the collector are logged, the search is not affected
+        :param trace: trace from SearchTrace.to_compact
+        :param attributes: attributes of the resource
+        :return: True if the trace is accepted by the collector
+        """
+        endpoint = get_settings().otlp_endpoint
+        if not endpoint:
+            return False
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=EXPORT_TIMEOUT)
+        try:
+            response = await self._client.post(endpoint, json=to_otlp(trace, attributes))
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.stats["failed"] += 1
+            logger.warning(f"Failed to export trace {trace['trace_id']}: {e}")
+            return False
+        self.stats["exported"] += 1
+        return True
+
+    async def close(self):
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    def get_metrics(self) -> dict:
+        return dict(self.stats)
+
+
+otlp_exporter = OtlpExporter()
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+
+from redis.asyncio import Redis
+from sqlalchemy.orm import joinedload, undefer
+
+from app.core.settings import get_settings
+from app.models.models import Watch
+from app.rate_limiter import RateLimiter
+from app.search_engine import SearchEngine
+from app.search_log import logger
+from app.services.search_results import decompress_json
+from app.services.watchlist import (
+    build_snapshot,
+    diff_results,
+    get_due_watches,
+    parse_hours,
+    postpone_watch,
+    save_watch_run,
+)
+
+# Prefix of Redis list with notifications about changes of watched searches of the user
+WATCH_NOTIFICATIONS_KEY = "watch_notifications"
+MAX_NOTIFICATIONS = 100
+# Lock of the watch while it runs, so the watch is run by one worker. Expires if the worker is stopped
+WATCH_LOCK_TIME = 3600
+# Delay in seconds before repeating failed run of the watch
+WATCH_RETRY_TIME = 3600
+# Redis set with checkpoints of watch runs. They are kept apart from checkpoints of user searches, so web workers
+# don't resume them. Interrupted run is repeated by the scheduler and its checkpoint is deleted
+WATCH_CHECKPOINTS_KEY = "watch_search_checkpoints"
+# Lock of the scheduler which runs due watches. Only one worker runs watches at a time, so the rate limit
+# is shared by all workers. Lease is renewed while watches run and expires if the worker is stopped
+SCHEDULER_LOCK_KEY = "watch_scheduler:lock"
+SCHEDULER_LOCK_TIME = 60
+
+
+class WatchlistScheduler:
+    """
+    Runs due watches of saved searches. Watches are run by one worker at a time and all watch runs share one
+    rate limiter, so scheduled searches don't take more than watchlist_rate requests per second.
+    Changes of the results are saved and pushed to the user
+    """
+
+    def __init__(self):
+        self.rate_limiter = RateLimiter(get_settings().watchlist_rate)
+        self.id = str(uuid.uuid4())
+        self.stats = {
+            "skipped": 0,
+            "runs": 0,
+            "failed": 0,
+            "diffs": 0,
+        }
+
+    async def run_due(self, redis: Redis, session_factory, active_search_count: int = 1):
+        """
+        Run watches which are due, at most watchlist_concurrency at once.
+        Watches are not run if the scheduler of another worker holds the lock
+        :param redis:
+        :param session_factory: factory of database sessions, sessions are not kept open while searches run
+        :param active_search_count: number of running user searches, pauses of watch searches grow with it
+        :return:
+        """
+        if not await redis.set(SCHEDULER_LOCK_KEY, self.id, ex=SCHEDULER_LOCK_TIME, nx=True):
+            self.stats["skipped"] += 1
+            return
+        renew_task = asyncio.create_task(self._renew_lock(redis))
+        try:
+            await self._delete_checkpoints(redis)
+            settings = get_settings()
+            self.rate_limiter.rate = settings.watchlist_rate
+            async with session_factory() as db:
+                watch_ids = await get_due_watches(db, datetime.now().astimezone(), settings.watchlist_concurrency)
+            await asyncio.gather(*(self.run_watch(redis, session_factory, watch_id, active_search_count)
+                                   for watch_id in watch_ids))
+        finally:
+            renew_task.cancel()
+            lock_owner = await redis.get(SCHEDULER_LOCK_KEY)
+            if lock_owner and lock_owner.decode('utf-8') == self.id:
+                await redis.delete(SCHEDULER_LOCK_KEY)
+
+    async def _renew_lock(self, redis: Redis):
+        """
+        Extend lease of the scheduler lock while watches run
+        :param redis:
+        :return:
+        """
+        while True:
+            await asyncio.sleep(SCHEDULER_LOCK_TIME / 3)
+            await redis.expire(SCHEDULER_LOCK_KEY, SCHEDULER_LOCK_TIME)
+
+    @staticmethod
+    async def _delete_checkpoints(redis: Redis):
+        """
+        Delete checkpoints of watch runs which were interrupted by stop of the worker.
+        Watches run only under the scheduler lock, so no run is in progress when the lock is taken
+        :param redis:
+        :return:
+        """
+        for entry in await redis.smembers(WATCH_CHECKPOINTS_KEY):
+            await redis.delete(f"{entry.decode('utf-8')}:checkpoint")
+        await redis.delete(WATCH_CHECKPOINTS_KEY)
+
+    async def run_watch(self, redis: Redis, session_factory, watch_id: int, active_search_count: int = 1):
+        """
+        Repeat watched search, save changes of the results and notify the user
+        :param redis:
+        :param session_factory:
+        :param watch_id:
+        :param active_search_count:
+        :return:
+        """
+        lock_key = f"watch:{watch_id}:lock"
+        if not await redis.set(lock_key, 1, ex=WATCH_LOCK_TIME, nx=True):
+            return
+        search_uuid = str(uuid.uuid4())
+        user_id = None
+        failed = False
+        try:
+            async with session_factory() as db:
+                watch = await db.get(Watch, watch_id, options=[undefer(Watch.snapshot), joinedload(Watch.search)])
+                if watch is None:
+                    return
+                user_id = watch.user_id
+                queries_list = [tuple(watch.search.names_list1), tuple(watch.search.names_list2)]
+                saved_search_uuid = watch.search.uuid
+                snapshot = decompress_json(watch.snapshot) or {}
+
+            engine = SearchEngine(user_id, search_uuid, redis, active_search_count + 1)
+            engine.checkpoints_key = WATCH_CHECKPOINTS_KEY
+            engine.rate_limiter = self.rate_limiter
+            results = await engine.intersection_in_global_search(queries_list)
+            self.stats["runs"] += 1
+            if engine.failed_queries:
+                # Incomplete results would look like removed stores, so they are not compared
+                failed = True
+                logger.warning(f"Watch {watch_id} failed for queries {engine.failed_queries}")
+                return
+
+            diff = diff_results(snapshot, results)
+            now = datetime.now().astimezone()
+            async with session_factory() as db:
+                watch = await db.get(Watch, watch_id)
+                if watch is None:
+                    return
+                watch_diff = await save_watch_run(db, watch, diff, build_snapshot(results), now,
+                                                  parse_hours(get_settings().off_peak_hours))
+                await db.commit()
+            if watch_diff:
+                self.stats["diffs"] += 1
+                await self.notify(redis, user_id, {
+                    "watch_id": watch_id,
+                    "diff_id": watch_diff.id,
+                    "search_uuid": saved_search_uuid,
+                    "created_at": now.strftime('%Y-%m-%d %H:%M:%S'),
+                    "added_stores": watch_diff.added_stores,
+                    "removed_stores": watch_diff.removed_stores,
+                    "changed_products": watch_diff.changed_products,
+                })
+        except Exception as e:
+            failed = True
+            logger.warning(f"Watch {watch_id} failed: {e}")
+        finally:
+            if failed:
+                self.stats["failed"] += 1
+                retry_at = datetime.now().astimezone() + timedelta(seconds=WATCH_RETRY_TIME)
+                async with session_factory() as db:
+                    await postpone_watch(db, watch_id, retry_at)
+                    await db.commit()
+            search_key = f"{user_id}:{search_uuid}"
+            await redis.srem(WATCH_CHECKPOINTS_KEY, search_key)
+            await redis.delete(lock_key, f"{search_key}:checkpoint", f"{search_key}:messages", f"{search_key}:results",
+                               f"{search_key}:results_index")
+
+    @staticmethod
+    async def notify(redis: Redis, user_id: int, notification: dict):
+        """
+        Push notification about changes to the user. Only the last MAX_NOTIFICATIONS are kept
+        :param redis:
+        :param user_id:
+        :param notification:
+        :return:
+        """
+        key = f"{WATCH_NOTIFICATIONS_KEY}:{user_id}"
+        await redis.rpush(key, json.dumps(notification))
+        await redis.ltrim(key, -MAX_NOTIFICATIONS, -1)
+
+    def get_metrics(self) -> dict:
+        return {**self.stats, "rate_limiter": self.rate_limiter.get_metrics()}
+
+
+watchlist_scheduler = WatchlistScheduler()
@@ -0,0 +1,97 @@
+"""
+Benchmark of per-request overhead of authentication middleware.
+
+Compares application without middleware, the previous pair of BaseHTTPMiddleware functions
+with JWT decoded in middleware and again in dependency, and pure ASGI AuthMiddleware.
+
+Run from the project root:
+    python benchmarks/auth_middleware.py [requests]
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import timedelta
+
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI, Request
+
+from app.core.jwt import create_access_token, verify_token
+from app.middleware import AuthMiddleware, decode_username
+
+
+def create_bare_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping(request: Request):
+        return {"user": decode_username(request.cookies["access_token"])}
+
+    return app
+
+
+def create_legacy_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping(request: Request):
+        token = request.headers["authorization"].removeprefix("Bearer ")
+        return {"user": decode_username(token)}
+
+    async def refresh_token_middleware(request: Request, call_next):
+        verify_token(request.cookies.get("access_token"))
+        return await call_next(request)
+
+    async def add_token_to_header_middleware(request: Request, call_next):
+        access_token = f"Bearer {request.cookies.get('access_token')}"
+        request.headers.__dict__["_list"].append((b"authorization", access_token.encode()))
+        return await call_next(request)
+
+    app.middleware('http')(refresh_token_middleware)
+    app.middleware('http')(add_token_to_header_middleware)
+    return app
+
+
+def create_asgi_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping(request: Request):
+        return {"user": request.state.principal}
+
+    app.add_middleware(AuthMiddleware)
+    return app
+
+
+async def measure(app: FastAPI, token: str, requests: int) -> float:
+    """
+    Returns mean time of request in microseconds
+    """
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test",
+                                 cookies={"access_token": token}) as client:
+        for _ in range(100):
+            await client.get("/ping")
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = await client.get("/ping")
+            assert response.status_code == 200
+        return (time.perf_counter() - start) / requests * 1_000_000
+
+
+async def main(requests: int):
+    token = create_access_token({"sub": "benchmark"}, timedelta(minutes=30))
+    bare = await measure(create_bare_app(), token, requests)
+    print(f"{'no middleware':<40}{bare:>10.1f} us/request")
+    for name, app in (("BaseHTTPMiddleware x2, decode x2", create_legacy_app()),
+                      ("AuthMiddleware, decode x1", create_asgi_app())):
+        mean = await measure(app, token, requests)
+        print(f"{name:<40}{mean:>10.1f} us/request, overhead {mean - bare:>8.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
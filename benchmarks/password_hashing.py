@@ -0,0 +1,62 @@
+"""
+Benchmark of event loop lag during login storm.
+
+Background coroutine imitates scraping task: it sleeps for short interval and measures how late it wakes up.
+Login storm runs concurrent bcrypt verifications synchronously in the event loop (previous behaviour)
+and in the bounded thread pool of PasswordHasher.
+
+Run from the project root:
+    python benchmarks/password_hashing.py [logins]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.security import PasswordHasher, get_password_hash, verify_password
+
+PROBE_INTERVAL = 0.005
+
+
+async def probe_loop_lag(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def run_storm(login, logins: int) -> tuple[float, float, float]:
+    lags = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    duration = time.perf_counter() - start
+    stop.set()
+    await probe
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    return duration, max(lags, default=0.0), p99
+
+
+async def main(logins: int):
+    hashed = get_password_hash("password")
+    hasher = PasswordHasher(queue_size=logins)
+
+    async def sync_login():
+        verify_password("password", hashed)
+
+    async def pool_login():
+        await hasher.verify("password", hashed)
+
+    for name, login in (("bcrypt in event loop", sync_login), ("PasswordHasher thread pool", pool_login)):
+        duration, max_lag, p99_lag = await run_storm(login, logins)
+        print(f"{name:<30} {logins} logins in {duration:6.2f} s, "
+              f"loop lag max {max_lag * 1000:8.1f} ms, p99 {p99_lag * 1000:8.1f} ms")
+    print(hasher.get_metrics())
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
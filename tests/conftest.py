@@ -5,7 +5,7 @@ import os
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from app.main import app
 from app.services.base import Base
 from app.dependecies import get_db
@@ -24,9 +24,14 @@ SQLALCHEMY_DATABASE_URL = (
     f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{TEST_DB_NAME}"
 )
 
-# Create the engine and session for the test database
+SQLALCHEMY_ASYNC_DATABASE_URL = (
+    f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{TEST_DB_NAME}"
+)
+
+# Create the engine for tables creation and async session for the test database
 engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=False)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, echo=False)
+TestingSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
 def create_database():
     engine_init = create_engine(
@@ -66,12 +71,9 @@ def drop_database():
         print(f"Database {TEST_DB_NAME} successfully dropped.")
 
 # Dependency override for the test database
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Apply the override to the FastAPI app
 app.dependency_overrides[get_db] = override_get_db
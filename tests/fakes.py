@@ -0,0 +1,205 @@
+"""
+Fakes and fixtures shared by tests. Modules of the application create clients of the database and read JWT
+settings on import, so default settings are set here and this module is imported before the application.
+Tests which use these fakes don't connect to the services
+"""
+import os
+
+for name, value in (("DB_USER", "user"), ("DB_PASSWORD", "password"), ("DB_HOST", "localhost"),
+                    ("DB_PORT", "5432"), ("DB_NAME", "alisearch"),
+                    ("JWT_SECRET_KEY", "test-secret"), ("JWT_ALGORITHM", "HS256")):
+    os.environ.setdefault(name, value)
+
+import asyncio  # noqa: E402
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+from redis.exceptions import WatchError  # noqa: E402
+
+from app.proxy_pool import ProxyPool  # noqa: E402
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture()
+def anyio_backend():
+    return "asyncio"
+
+
+def read_html_from_file(search: str, page_number: int):
+    file_name = f"{search}-{page_number}.txt"
+    file_path = os.path.join(BASE_DIR, "test_data", file_name)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        print(f"Read file {file_name}")
+        html = f.read()
+    return html
+
+
+async def mock_get_html(search: str, page_number: int, store_id: str = None) -> str:
+    try:
+        html = read_html_from_file(search, page_number)
+    except OSError as e:
+        print(e)
+        html = ''
+    return html
+
+
+def make_pool(handlers: dict):
+    """
+    Proxy pool with local stand-in proxies, each proxy answers by its own handler
+    :param handlers: {proxy_url: handler of httpx.MockTransport}
+    :return:
+    """
+    return ProxyPool(list(handlers),
+                     client_factory=lambda proxy: httpx.AsyncClient(transport=httpx.MockTransport(handlers[proxy])))
+
+
+class FakePipeline:
+    """
+    Transaction of FakeRedis. Reads are executed immediately and yield to other tasks, writes are queued
+    and fail with WatchError if watched keys were changed
+    """
+
+    def __init__(self, redis: "FakeRedis"):
+        self.redis = redis
+        self.watched = {}
+        self.commands = []
+
+    async def watch(self, *keys):
+        self.watched = {key: self.redis.versions.get(key, 0) for key in keys}
+
+    async def hget(self, key, field):
+        await asyncio.sleep(0)
+        return await self.redis.hget(key, field)
+
+    def multi(self):
+        self.commands = []
+
+    def hset(self, key, field, value):
+        self.commands.append(self.redis.hset(key, field, value))
+        return self
+
+    def hdel(self, key, field):
+        self.commands.append(self.redis.hdel(key, field))
+        return self
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        if any(self.redis.versions.get(key, 0) != version for key, version in self.watched.items()):
+            for command in commands:
+                command.close()
+            raise WatchError()
+        return [await command for command in commands]
+
+
+class FakeRedis:
+    """
+    Minimal in-memory Redis with strings, lists, hashes, sets and transactions.
+    Values are kept as strings in data and returned as bytes like by Redis
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.versions = {}
+        self.expires = {}
+        self.published = []
+
+    def _changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    @staticmethod
+    def _encode(value):
+        return value.encode() if isinstance(value, str) else value
+
+    @staticmethod
+    def _to_str(value):
+        if isinstance(value, bytes):
+            return value.decode()
+        return value if isinstance(value, str) else str(value)
+
+    async def get(self, key):
+        return self._encode(self.data.get(key))
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else self._to_str(value)
+        self._changed(key)
+        return True
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self._changed(key)
+
+    async def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    async def incr(self, key):
+        self.data[key] = self.data.get(key, 0) + 1
+        return self.data[key]
+
+    async def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(self._to_str(value) for value in values)
+        self._changed(key)
+
+    async def lrange(self, key, start, end):
+        values = self.data.get(key, [])
+        return [self._encode(value) for value in values[start:None if end == -1 else end + 1]]
+
+    async def ltrim(self, key, start, end):
+        if key in self.data:
+            self.data[key] = self.data[key][start:None if end == -1 else end + 1]
+            self._changed(key)
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        fields = dict(mapping or {})
+        if field is not None:
+            fields[field] = value
+        self.data.setdefault(key, {}).update({self._to_str(name): self._to_str(value)
+                                              for name, value in fields.items()})
+        self._changed(key)
+
+    async def hget(self, key, field):
+        return self._encode(self.data.get(key, {}).get(field))
+
+    async def hmget(self, key, fields):
+        return [await self.hget(key, field) for field in fields]
+
+    async def hkeys(self, key):
+        return [field.encode() for field in self.data.get(key, {})]
+
+    async def hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    async def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+        self._changed(key)
+
+    async def hscan_iter(self, key, count=None):
+        for field, value in list(self.data.get(key, {}).items()):
+            yield field.encode(), value.encode()
+
+    async def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(self._to_str(value) for value in values)
+
+    async def srem(self, key, *values):
+        self.data.get(key, set()).difference_update(self._to_str(value) for value in values)
+
+    async def smembers(self, key):
+        return {value.encode() for value in self.data.get(key, set())}
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    async def transaction(self, func, *watches, value_from_callable=False):
+        pipe = FakePipeline(self)
+        while True:
+            await pipe.watch(*watches)
+            value = await func(pipe)
+            try:
+                result = await pipe.execute()
+            except WatchError:
+                continue
+            return value if value_from_callable else result
@@ -0,0 +1,42 @@
+import io
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.cli import BatchRunner, parse_line, read_jobs
+from app.search_engine import SearchEngine
+from tests.fakes import anyio_backend, mock_get_html  # noqa: F401
+
+
+def test_parse_line():
+    assert parse_line("7260ac, 7260 ac | DW5823e").queries_list == [("7260ac", "7260 ac"), ("DW5823e",)]
+    assert parse_line('[["7260ac"], ["DW5823e"]]').queries_list == [("7260ac",), ("DW5823e",)]
+    assert parse_line("# comment") is None
+    with pytest.raises(ValueError):
+        parse_line("7260ac")
+
+
+@pytest.mark.anyio
+async def test_batch_is_resumed_from_checkpoint(monkeypatch):
+    get_html = AsyncMock(side_effect=mock_get_html)
+    monkeypatch.setattr(SearchEngine, "_get_html", lambda self, *args, **kwargs: get_html(*args, **kwargs))
+    monkeypatch.setattr(SearchEngine, "max_page", 3)
+    redis = AsyncMock()
+    redis.get.return_value = None
+    jobs = read_jobs(io.StringIO("7260ac | DW5823e\n\nDW5823e | 7260ac\n"))
+
+    output, checkpoint = io.StringIO(), io.StringIO()
+    runner = BatchRunner(redis, output, checkpoint, concurrency=2, rate=0, enable_pause=False)
+    stats = await runner.run(jobs[:1])
+    assert stats["completed"] == 1
+
+    runner = BatchRunner(redis, output, checkpoint, concurrency=2, rate=0, enable_pause=False)
+    requests_count = get_html.await_count
+    stats = await runner.run(jobs, completed=set(checkpoint.getvalue().split()))
+    assert stats["skipped"] == 1 and stats["completed"] == 1
+    assert {call.args[0] for call in get_html.await_args_list[requests_count:]} == {"DW5823e", "7260ac"}
+
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [record["line"] for record in records] == [1, 3]
+    assert records[0]["results"].keys() == records[1]["results"].keys()
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+# Imported before the application, sets default settings of the database
+import tests.fakes  # noqa: F401, I001
+from app.metrics import REGISTRY
+from app.services.database import DB_MAX_OVERFLOW, DB_POOL_SIZE, engine, get_pool_metrics
+
+
+def test_pool_metrics():
+    metrics = get_pool_metrics()
+    assert metrics["size"] == DB_POOL_SIZE
+    assert metrics["max_overflow"] == DB_MAX_OVERFLOW
+    assert (metrics["checked_out"], metrics["overflow"]) == (0, -DB_POOL_SIZE)
+
+
+def test_pool_events_are_counted():
+    before = get_pool_metrics()
+    # Connect event also runs initialization of asyncpg connection by the dialect, so it is not sent here
+    dispatch = engine.sync_engine.pool.dispatch
+    dispatch.checkout(None, None, None)
+    dispatch.checkin(None, None)
+    dispatch.invalidate(None, None, None)
+    after = get_pool_metrics()
+    for name in ("checkouts", "checkins", "invalidations"):
+        assert after[name] == before[name] + 1
+
+
+def test_query_time_is_observed():
+    before = REGISTRY.get_sample_value("alisearch_db_query_seconds_count") or 0
+    context = SimpleNamespace()
+    dispatch = engine.sync_engine.dispatch
+    dispatch.before_cursor_execute(None, None, "SELECT 1", (), context, False)
+    dispatch.after_cursor_execute(None, None, "SELECT 1", (), context, False)
+    assert REGISTRY.get_sample_value("alisearch_db_query_seconds_count") == before + 1
@@ -0,0 +1,146 @@
+import asyncio
+import re
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import postgresql
+
+# Imported before the application, sets default settings of the services
+from tests.fakes import FakeRedis  # noqa: I001
+from app.auth import get_current_user
+from app.dependecies import get_db, get_redis
+from app.models.models import Search, User
+from app.resources import static_files
+from app.routers.history import (
+    HISTORY_COUNT_KEY,
+    decode_cursor,
+    encode_cursor,
+    get_history_count,
+    router,
+)
+from app.services.search_results import compress_json, decompress_json
+
+CREATED_AT = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeDB:
+    """
+    Session which returns prepared rows of history page or saved search and records executed queries
+    """
+
+    def __init__(self, rows: list[dict] = (), count: int = 0, search: Search = None):
+        self.rows = list(rows)
+        self.count = count
+        self.search = search
+        self.queries = []
+
+    async def scalar(self, query):
+        self.queries.append(query)
+        return self.count
+
+    async def execute(self, query):
+        self.queries.append(query)
+        result = MagicMock()
+        result.mappings.return_value.fetchall.return_value = self.rows
+        result.scalars.return_value.first.return_value = self.search
+        return result
+
+
+def make_rows(number: int) -> list[dict]:
+    return [{"id": 10 - index, "uuid": f"uuid-{index}", "created_at": CREATED_AT - timedelta(minutes=index),
+             "names_list1": ["7260ac"], "names_list2": ["DW5823e"], "results_count": index + 1}
+            for index in range(number)]
+
+
+def make_client(db: FakeDB, redis: FakeRedis) -> TestClient:
+    app = FastAPI()
+    app.mount("/static", static_files, name="static")
+    app.include_router(router)
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_redis] = lambda: redis
+    app.dependency_overrides[get_current_user] = lambda: User(id=1, username="user")
+    return TestClient(app)
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect())).replace("\n", " ")
+
+
+def test_history_cursor():
+    row = make_rows(1)[0]
+    assert decode_cursor(encode_cursor(row)) == (row["created_at"], row["id"])
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+
+def test_history_count_is_cached():
+    db = FakeDB(count=3)
+    redis = FakeRedis()
+    assert asyncio.run(get_history_count(db, redis, 1)) == 3
+    db.count = 4
+    assert asyncio.run(get_history_count(db, redis, 1)) == 3
+    assert len(db.queries) == 1
+
+    # Saving of new search resets the cached value
+    asyncio.run(redis.delete(f"{HISTORY_COUNT_KEY}:1"))
+    assert asyncio.run(get_history_count(db, redis, 1)) == 4
+
+
+def test_history_pages_by_cursor():
+    rows = make_rows(3)
+    db = FakeDB(rows, count=5)
+    client = make_client(db, FakeRedis())
+
+    response = client.get("/history", params={"limit": 2})
+    assert response.status_code == 200
+    assert "Found stores: 2" in response.text and "Found stores: 3" not in response.text
+    assert f"/history?cursor={encode_cursor(rows[1])}&amp;direction=next" in response.text
+    query = compile_query(db.queries[-1])
+    assert "ORDER BY searches.created_at DESC, searches.id DESC" in query
+    assert "OFFSET" not in query and "json_object_keys" not in query
+
+    db.rows = rows[2:]
+    response = client.get("/history", params={"limit": 2, "cursor": encode_cursor(rows[1])})
+    assert f"/history?cursor={encode_cursor(rows[2])}&amp;direction=prev" in response.text
+    assert "direction=next" not in response.text
+    assert "(searches.created_at, searches.id) < (" in compile_query(db.queries[-1])
+
+    response = client.get("/history", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+
+
+def test_compress_json():
+    messages = ["Search started", "Найдено 2 магазина"]
+    assert decompress_json(compress_json(messages)) == messages
+    assert decompress_json(None) is None
+
+
+def test_saved_search_page_does_not_load_messages_and_results():
+    search = Search(id=1, uuid="uuid", names_list1=["7260ac"], names_list2=["DW5823e"], results_count=12)
+    db = FakeDB(search=search)
+    response = make_client(db, FakeRedis()).get("/history/search/uuid")
+    assert response.status_code == 200
+    assert response.context["saved_search_uuid"] == "uuid"
+    assert "messages" not in response.context and "results" not in response.context
+    columns = re.findall(r"searches\.(\w+)", compile_query(db.queries[-1]).split(" FROM ")[0])
+    assert not {"messages", "messages_compressed", "results"} & set(columns)
+
+    db.search = None
+    assert make_client(db, FakeRedis()).get("/history/search/other").status_code == 404
+
+
+def test_saved_search_messages_are_paginated():
+    messages = [f"Message {index}" for index in range(5)]
+    db = FakeDB(search=Search(uuid="uuid", messages_compressed=compress_json(messages)))
+    client = make_client(db, FakeRedis())
+    response = client.get("/history/search/uuid/messages", params={"offset": 3, "limit": 10})
+    assert response.json() == {"messages": messages[3:], "offset": 3, "total": 5}
+    assert "messages_compressed" in compile_query(db.queries[-1])
+
+    # Searches saved by previous versions have uncompressed messages
+    db.search = Search(uuid="uuid", messages=messages)
+    response = client.get("/history/search/uuid/messages", params={"limit": 2})
+    assert response.json() == {"messages": messages[:2], "offset": 0, "total": 5}
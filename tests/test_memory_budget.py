@@ -0,0 +1,71 @@
+import tracemalloc
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.memory_budget import MemoryBudget
+from app.search_engine import SearchEngine
+from tests.fakes import anyio_backend, read_html_from_file  # noqa: F401
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("search,page", [("7260ac", 1), ("7260ac", 2), ("DW5823e", 3)])
+async def test_peak_allocation_of_page_parsing(search, page):
+    html = read_html_from_file(search, page)
+    engine = SearchEngine("user", "uuid", AsyncMock())
+    engine._get_html = AsyncMock(return_value=html)
+    # Parser modules allocate their caches on the first use
+    warm_up_engine = SearchEngine("user", "uuid", AsyncMock())
+    warm_up_engine._get_html = AsyncMock(return_value=html)
+    await warm_up_engine._parse_global_search_page(search, page)
+
+    tracemalloc.start()
+    try:
+        page_data = await engine._parse_global_search_page(search, page)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert page_data != 'error'
+    # Page itself is allocated before parsing. Tree, script and JSON are not kept in memory at the same time
+    assert peak < 3 * len(html)
+    assert 0 < engine.memory_budget.peak <= peak
+
+
+@pytest.mark.anyio
+async def test_search_is_stopped_when_budget_is_exceeded():
+    engine = SearchEngine("user", "uuid", AsyncMock())
+    engine._get_html = AsyncMock(return_value=read_html_from_file("7260ac", 1))
+    engine.enable_pause = False
+    engine.search_memory_budget = 0.1
+
+    assert await engine._collect_product_stores("7260ac") == 'error'
+    assert engine.memory_budget.exceeded
+    # Retrying is useless
+    assert engine._get_html.await_count == 1
+
+
+def test_peak_of_outer_tracing_is_kept():
+    budget = MemoryBudget()
+    tracemalloc.start()
+    try:
+        outer = bytearray(1_000_000)
+        del outer
+        outer_peak = tracemalloc.get_traced_memory()[1]
+
+        budget.start(10_000_000)
+        section = bytearray(100_000)
+        assert 100_000 <= budget.stop() < 1_000_000
+        assert tracemalloc.get_traced_memory()[1] >= outer_peak
+        del section
+
+        # Section which raises the peak of the outer tracing is measured by the peak
+        budget._sections = 0
+        budget.start(1_000_000)
+        section = bytearray(2_000_000)
+        del section
+        assert budget.stop() >= 2_000_000
+        assert budget.exceeded
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
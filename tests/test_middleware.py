@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+# Imported before the application, sets default JWT settings
+import tests.fakes  # noqa: F401, I001
+from app.core.jwt import create_access_token, create_refresh_token
+from app.middleware import AuthMiddleware
+
+app = FastAPI()
+app.add_middleware(AuthMiddleware)
+
+
+@app.get("/whoami")
+async def whoami(request: Request):
+    return {
+        "principal": getattr(request.state, "principal", None),
+        "authorization": request.headers.get("authorization"),
+    }
+
+
+def test_valid_access_token():
+    token = create_access_token({"sub": "testuser"}, timedelta(minutes=5))
+    client = TestClient(app, cookies={"access_token": token})
+    response = client.get("/whoami")
+    assert response.json() == {"principal": "testuser", "authorization": f"Bearer {token}"}
+    assert "set-cookie" not in response.headers
+
+
+def test_expired_access_token_is_refreshed():
+    token = create_access_token({"sub": "testuser"}, timedelta(minutes=-1))
+    refresh_token = create_refresh_token({"sub": "testuser"})
+    client = TestClient(app, cookies={"access_token": token, "refresh_token": refresh_token})
+    response = client.get("/whoami")
+    assert response.json()["principal"] == "testuser"
+    assert response.json()["authorization"] != f"Bearer {token}"
+    assert "access_token=" in response.headers["set-cookie"]
+
+
+def test_invalid_token():
+    client = TestClient(app, cookies={"access_token": "invalid"})
+    response = client.get("/whoami")
+    assert response.json() == {"principal": None, "authorization": None}
@@ -0,0 +1,43 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.page_extractor import PageExtractor
+from app.search_engine import SearchEngine
+from tests.fakes import anyio_backend, read_html_from_file  # noqa: F401
+
+
+def extract(html: str, chunk_size: int) -> tuple[PageExtractor, int]:
+    extractor = PageExtractor()
+    position = 0
+    while position < len(html) and not extractor.is_complete:
+        extractor.feed(html[position:position + chunk_size])
+        position += chunk_size
+    return extractor, position
+
+
+@pytest.mark.parametrize("chunk_size", [7, 4096])
+def test_extractor_stops_after_script(chunk_size):
+    html = read_html_from_file("7260ac", 2)
+    extractor, position = extract(html, chunk_size)
+    assert extractor.is_complete
+    assert position < len(html)
+    assert extractor.parts["script"].startswith("window._dida_config_ =")
+    assert extractor.parts["pagination"].endswith("</ul>")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("search,page", [("7260ac", 1), ("DW5823e", 3)])
+async def test_extracted_page_gives_same_products(search, page):
+    html = read_html_from_file(search, page)
+    engine = SearchEngine("user", "uuid", AsyncMock())
+    engine.filter_result = False
+    engine._get_html = MagicMock()
+
+    engine._get_html.side_effect = AsyncMock(return_value=html)
+    full_page = await engine._parse_global_search_page(search, page)
+    engine._get_html.side_effect = AsyncMock(return_value=extract(html, 4096)[0].get_html())
+    extracted_page = await engine._parse_global_search_page(search, page)
+
+    assert full_page != 'error'
+    assert extracted_page == full_page
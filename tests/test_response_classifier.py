@@ -0,0 +1,57 @@
+import httpx
+import pytest
+
+from app.response_classifier import (
+    BLOCKED, CAPTCHA, EMPTY, LAYOUT_CHANGED, LOGIN, SERVER_ERROR, classify_response, classifier_stats,
+)
+from app.search_engine import SearchEngine
+from tests.fakes import FakeRedis, anyio_backend, make_pool  # noqa: F401
+
+
+@pytest.mark.parametrize("status_code,headers,head,expected", [
+    (200, {}, "<!DOCTYPE html><html><head>", None),
+    (200, {}, "<html><script>window.x5secdata = {}</script>", CAPTCHA),
+    (302, {"location": "https://www.aliexpress.com//_____tmd_____/punish?x5secdata=1"}, "", CAPTCHA),
+    (302, {"location": "https://login.aliexpress.com/"}, "", LOGIN),
+    (429, {}, "", BLOCKED),
+    (404, {}, "", EMPTY),
+    (503, {}, "", SERVER_ERROR),
+])
+def test_classify_response(status_code, headers, head, expected):
+    assert classify_response(status_code, httpx.Headers(headers), head) == expected
+
+
+def captcha_handler(request: httpx.Request) -> httpx.Response:
+    body = b"<html><head><script>var x5secdata = 'punish';</script></head>" + b" " * 1_000_000
+
+    async def stream():
+        for position in range(0, len(body), 4096):
+            yield body[position:position + 4096]
+
+    return httpx.Response(200, content=stream())
+
+
+@pytest.mark.anyio
+async def test_captcha_page_is_not_downloaded_and_session_is_rotated():
+    redis = FakeRedis()
+    engine = SearchEngine("user", "uuid", redis)
+    engine.enable_pause = False
+    engine.proxy_pool = make_pool({"http://proxy": captcha_handler})
+    captcha_count = classifier_stats.counts.get(CAPTCHA, 0)
+
+    assert await engine._get_html("7260ac", 1) == 'error'
+    assert engine.last_response_class == CAPTCHA
+    assert classifier_stats.counts[CAPTCHA] == captcha_count + 1
+    assert engine.proxy_pool.proxies[0].stats["bytes_downloaded"] < 100_000
+    # Session was retired, so the pool has no sessions
+    assert await redis.hkeys("search_sessions") == []
+
+
+@pytest.mark.anyio
+async def test_layout_change_is_not_retried():
+    engine = SearchEngine("user", "uuid", FakeRedis())
+    engine.enable_pause = False
+    engine.proxy_pool = make_pool({"http://proxy": lambda request: httpx.Response(200, text="<html>" + " " * 2048)})
+    assert await engine._collect_product_stores("7260ac") == 'error'
+    assert engine.last_response_class == LAYOUT_CHANGED
+    assert engine.proxy_pool.proxies[0].stats["requests"] == 1
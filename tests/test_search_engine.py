@@ -1,9 +1,10 @@
+import json
 from unittest.mock import MagicMock, AsyncMock
 
 import pytest
 import redis.asyncio as redis
 from app.search_engine import SearchEngine
-import os
+from tests.fakes import anyio_backend, mock_get_html, read_html_from_file  # noqa: F401
 
 session_id = "0fb9617a-1676-4f6e-8f2a-b908038fbf14"
 search_uuid = "ce4203b5-dfd7-492b-bf75-9248058537d5"
@@ -12,30 +13,6 @@ USE_REAL_REDIS = False
 # USE_REAL_REDIS = True
 
 
-@pytest.fixture()
-def anyio_backend():
-    return "asyncio"
-
-
-def read_html_from_file(search: str, page_number: int):
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    file_name = f"{search}-{page_number}.txt"
-    file_path = os.path.join(BASE_DIR, "test_data", file_name)
-    with open(file_path, 'r', encoding='utf-8') as f:
-        print(f"Read file {file_name}")
-        html = f.read()
-    return html
-
-
-async def mock_get_html(search: str, page_number: int) -> str:
-    try:
-        html = read_html_from_file(search, page_number)
-    except OSError as e:
-        print(e)
-        html = ''
-    return html
-
-
 @pytest.fixture()
 async def real_redis_client():
     redis_client = redis.from_url("redis://localhost:6379")
@@ -74,3 +51,86 @@ def search_engine(redis_client):
 async def test_intersection_in_global_search(search_engine):
     result = await search_engine.intersection_in_global_search([("7260ac",), ("DW5823e",)])
     assert isinstance(result, dict)
+
+
+@pytest.mark.anyio
+async def test_resume_from_checkpoint(search_engine, mock_redis_client):
+    queries_list = [("7260ac",), ("DW5823e",)]
+    result = await search_engine.intersection_in_global_search(queries_list)
+
+    # Take the checkpoint saved after the first product list was completed
+    checkpoints = [json.loads(call.args[1]) for call in mock_redis_client.set.call_args_list
+                   if call.args[0] == search_engine.checkpoint_key]
+    checkpoint = next(c for c in checkpoints if len(c['all_stores']) == 1)
+    assert checkpoint['plan'] == [[1, "DW5823e"]]
+    assert ["7260ac", 1] in checkpoint['completed_pages']
+
+    mock_redis_client.get.return_value = json.dumps(checkpoint)
+    engine = SearchEngine(session_id, search_uuid, mock_redis_client)
+    engine._get_html = MagicMock()
+    engine._get_html.side_effect = mock_get_html
+    engine.max_page = 3
+    engine.enable_pause = False
+    resumed_result = await engine.intersection_in_global_search([], resume=True)
+
+    assert {call.args[0] for call in engine._get_html.call_args_list} == {"DW5823e"}
+    assert resumed_result == result
+
+
+@pytest.mark.anyio
+async def test_adaptive_page_depth(search_engine, mock_redis_client):
+    search_engine.min_page_yield = 1000
+    await search_engine._collect_product_stores("7260ac")
+    assert [call.args[1] for call in search_engine._get_html.call_args_list] == [1, 2]
+    await search_engine.flush_messages()
+    messages = [message for call in mock_redis_client.rpush.call_args_list for message in call.args[1:]]
+    assert any("Low yield on page 2" in message for message in messages)
+
+    search_engine._get_html.reset_mock()
+    search_engine.adaptive_depth = False
+    await search_engine._collect_product_stores("DW5823e")
+    assert [call.args[1] for call in search_engine._get_html.call_args_list] == [1, 2, 3]
+
+
+@pytest.mark.anyio
+async def test_store_verification_of_candidates(search_engine):
+    page_data = await search_engine._parse_global_search_page("DW5823e", 1)
+    stores = {product['store_link']: product['store_id'] for product in page_data['products'].values()}
+    found = dict(list(stores.items())[:1])
+    candidates = found | {"https://www.aliexpress.com/store/1": "1"}
+    search_engine._get_html.reset_mock()
+    search_engine._collect_product_stores = AsyncMock(
+        return_value={link: {int(store_id): {"store_id": store_id}} for link, store_id in candidates.items()})
+
+    result = await search_engine.intersection_in_global_search([("first",), ("DW5823e",)])
+
+    assert set(result) == set(found)
+    search_engine._collect_product_stores.assert_awaited_once_with(search="first")
+    assert {str(call.kwargs['store_id']) for call in search_engine._get_html.call_args_list} == {
+        str(store_id) for store_id in candidates.values()}
+    assert search_engine._get_html.call_count == len(candidates)
+
+
+@pytest.mark.anyio
+async def test_user_messages_are_pushed_in_batches(search_engine, mock_redis_client):
+    await search_engine._collect_product_stores("7260ac")
+    mock_redis_client.rpush.assert_not_called()
+
+    await search_engine.flush_messages()
+    mock_redis_client.rpush.assert_called_once()
+    messages = mock_redis_client.rpush.call_args.args[1:]
+    assert any("Processed 1/" in message for message in messages)
+    # Debug events are written only to the log
+    assert not any("Filtered" in message or "Pause" in message for message in messages)
+
+
+def test_settings_reload_and_override(monkeypatch):
+    from app.core import settings
+    engine = SearchEngine(session_id, search_uuid, AsyncMock())
+    other_engine = SearchEngine(session_id, search_uuid, AsyncMock())
+    other_engine.max_page = 1
+    monkeypatch.setenv("SEARCH_MAX_PAGE", "9")
+    monkeypatch.setattr(settings, "_settings", settings.get_settings())
+    settings.reload_settings()
+    assert engine.max_page == 9
+    assert other_engine.max_page == 1
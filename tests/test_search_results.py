@@ -0,0 +1,130 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.models.models import SearchProduct, SearchStore
+from app.services.base import Base
+from app.services.export import export_chunks
+from app.services.search_results import (
+    build_results_index,
+    decode_results_cursor,
+    encode_results_cursor,
+    iter_live_products,
+    load_live_results_page,
+    load_search_results,
+    save_search_stores,
+)
+from tests.fakes import FakeRedis
+
+RESULTS = {
+    "https://store1.com": {"1": {"sale_price": "5.5", "store_title": "First", "store_id": 1}},
+    "https://store2.com": {"2": {"sale_price": "1.0", "store_title": "Second", "store_id": 2},
+                           "3": {"sale_price": "9.0", "store_title": "Second", "store_id": 2}},
+    "https://store3.com": {"4": {"sale_price": "3.0", "store_title": "Third", "store_id": 3}},
+}
+
+
+def make_redis() -> FakeRedis:
+    redis = FakeRedis()
+    redis.data["1:uuid:results"] = {store_link: json.dumps(products) for store_link, products in RESULTS.items()}
+    redis.data["1:uuid:results_index"] = build_results_index(RESULTS)
+    return redis
+
+
+def test_live_results_pages_by_cursor():
+    redis = make_redis()
+    results, total, next_key = asyncio.run(
+        load_live_results_page(redis, "1:uuid", sort="price", limit=2))
+    assert total == 3
+    assert list(results) == ["https://store2.com", "https://store3.com"]
+    cursor = decode_results_cursor(encode_results_cursor(next_key), "price")
+    results, total, next_key = asyncio.run(
+        load_live_results_page(redis, "1:uuid", sort="price", limit=2, cursor=cursor))
+    assert list(results) == ["https://store1.com"]
+    assert next_key is None
+
+
+def test_live_results_sort_and_filter():
+    redis = make_redis()
+    results, _, _ = asyncio.run(load_live_results_page(redis, "1:uuid", sort="products", descending=True))
+    assert list(results)[0] == "https://store2.com"
+    results, total, _ = asyncio.run(load_live_results_page(redis, "1:uuid", store="third"))
+    assert total == 1
+    assert list(results) == ["https://store3.com"]
+    results, total, _ = asyncio.run(load_live_results_page(redis, "1:uuid", store="2"))
+    assert list(results) == ["https://store2.com"]
+
+
+def test_live_results_page_reads_only_its_products():
+    redis = make_redis()
+    read_fields = []
+    hmget, hscan_iter = redis.hmget, redis.hscan_iter
+
+    async def recording_hmget(key, fields):
+        read_fields.extend(fields)
+        return await hmget(key, fields)
+
+    def index_hscan_iter(key, count=None):
+        # Products are not needed for sorting and filtering
+        assert key == "1:uuid:results_index"
+        return hscan_iter(key, count)
+
+    redis.hmget, redis.hscan_iter = recording_hmget, index_hscan_iter
+
+    results, total, _ = asyncio.run(load_live_results_page(redis, "1:uuid", sort="price", limit=1))
+    assert total == 3
+    assert results == {"https://store2.com": RESULTS["https://store2.com"]}
+    assert read_fields == ["https://store2.com"]
+
+
+async def _collect(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+def test_export_ndjson_and_csv():
+    redis = make_redis()
+    data = asyncio.run(_collect(export_chunks(iter_live_products(redis, "1:uuid"), "ndjson")))
+    rows = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+    assert len(rows) == 4
+    assert rows[0]["store_link"] == "https://store1.com"
+    assert rows[0]["product_id"] == "1"
+
+    data = asyncio.run(_collect(export_chunks(iter_live_products(redis, "1:uuid"), "csv", compress=True)))
+    rows = list(csv.DictReader(io.StringIO(gzip.decompress(data).decode('utf-8'))))
+    assert len(rows) == 4
+    assert rows[1]["sale_price"] == "1.0"
+
+
+async def _save_and_load(results: dict, **kwargs) -> dict:
+    # Normalized tables don't use PostgreSQL types, searches table is not needed without foreign key checks
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all, tables=[SearchStore.__table__, SearchProduct.__table__])
+    async with async_sessionmaker(engine)() as db:
+        await save_search_stores(db, 1, list(results.items()))
+        await save_search_stores(db, 2, [("https://other.com", {"5": {"sale_price": "1"}})])
+        await db.commit()
+        loaded = await load_search_results(db, 1, **kwargs)
+    await engine.dispose()
+    return loaded
+
+
+def test_saved_results_are_normalized():
+    results = {**RESULTS, "https://store4.com": {"6": {"sale_price": "", "store_id": "", "title": "No price"}}}
+    loaded = asyncio.run(_save_and_load(results))
+    assert list(loaded) == list(results)
+    # Products of the store are ordered by price
+    assert list(loaded["https://store2.com"]) == [2, 3]
+    assert loaded["https://store2.com"][3] == {
+        "product_id": 3, "link": None, "image": None, "title": None, "currency": None, "original_price": None,
+        "sale_price": 9.0, "shipping": None, "store_title": "Second", "store_id": 2,
+        "store_link": "https://store2.com"}
+    assert loaded["https://store4.com"][6]["sale_price"] is None
+    assert loaded["https://store4.com"][6]["store_id"] is None
+
+    loaded = asyncio.run(_save_and_load(results, offset=1, limit=2))
+    assert list(loaded) == ["https://store2.com", "https://store3.com"]
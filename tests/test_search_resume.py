@@ -0,0 +1,51 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+# Imported before the application, sets default settings of the services
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401, I001
+from app.routers.search import create_search_task, resume_searches
+from app.search_engine import CHECKPOINTS_KEY, SearchEngine
+
+
+@pytest.mark.anyio
+async def test_failed_search_is_not_resumed(monkeypatch):
+    async def intersection(self, queries_list, resume=False):
+        self._checkpoint = {"queries_list": queries_list}
+        await self.save_checkpoint()
+        raise RuntimeError("parser failed")
+
+    monkeypatch.setattr(SearchEngine, "intersection_in_global_search", intersection)
+    monkeypatch.setattr(SearchEngine, "save_trace", AsyncMock())
+    redis = FakeRedis()
+    active_searches = {}
+    await create_search_task(active_searches, redis, [("7260ac",), ("DW5823e",)], 1, "uuid")
+    with pytest.raises(RuntimeError):
+        await active_searches["1:uuid"].task
+    # on_finish runs in its own task after the search task
+    for _ in range(100):
+        if not active_searches:
+            break
+        await asyncio.sleep(0)
+
+    assert redis.data["1:uuid:is_finished"] == "1"
+    assert "1:uuid:checkpoint" not in redis.data
+    assert not redis.data[CHECKPOINTS_KEY]
+    assert any("Search failed: parser failed" in message for message in redis.data["1:uuid:messages"])
+    await resume_searches(active_searches, redis)
+    assert not active_searches
+
+
+@pytest.mark.anyio
+async def test_finished_search_is_not_resumed():
+    redis = FakeRedis()
+    redis.data["1:uuid:checkpoint"] = json.dumps({"queries_list": [["7260ac"]], "user_id": 1, "search_uuid": "uuid"})
+    redis.data["1:uuid:is_finished"] = "1"
+    await redis.sadd(CHECKPOINTS_KEY, "1:uuid")
+    active_searches = {}
+    await resume_searches(active_searches, redis)
+    assert not active_searches
+    assert "1:uuid:checkpoint" not in redis.data
+    assert not redis.data[CHECKPOINTS_KEY]
@@ -0,0 +1,75 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+# Imported before the application, sets default settings of the services
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401, I001
+from app.routers.search import FINGERPRINTS_KEY, create_search_task, reuse_finished_search
+from app.schemas.search_form import SearchForm
+from app.search_engine import SearchEngine
+
+
+def test_fingerprint_ignores_order_case_and_spaces():
+    form = SearchForm(names_list1=["7260ac", "7260 AC"], names_list2=["DW5823e"])
+    same = SearchForm(names_list1=[" dw5823E "], names_list2=["7260  ac", "7260AC"])
+    other = SearchForm(names_list1=["7260ac"], names_list2=["DW5823e"])
+    assert form.fingerprint == same.fingerprint
+    assert form.fingerprint != other.fingerprint
+
+
+@pytest.mark.anyio
+async def test_finished_search_is_reused():
+    redis = FakeRedis()
+    assert not await reuse_finished_search(redis, "fp", 1, "new")
+
+    results = {"https://store/1": {"1": {"title": "7260ac"}}}
+    redis.data[f"{FINGERPRINTS_KEY}:fp:result"] = json.dumps({"finished_at": "2024-01-01 10:00:00",
+                                                              "results": results})
+    assert await reuse_finished_search(redis, "fp", 1, "new")
+    assert redis.data["1:new:is_finished"] == "1"
+    assert json.loads(redis.data["1:new:results"]["https://store/1"]) == results["https://store/1"]
+    assert json.loads(redis.data["1:new:results_index"]["https://store/1"])[1] == 1
+    assert any("are reused" in message for message in redis.data["1:new:messages"])
+
+
+@pytest.mark.anyio
+async def test_subscriber_receives_messages_and_results():
+    redis = FakeRedis()
+    engine = SearchEngine(1, "first", redis)
+    await engine.add_message("Search started")
+    await engine.subscribe(2, "second")
+    await engine.add_message("Processed 1/1 pages")
+    await engine.flush_messages()
+    await engine.save_search_results_to_redis({"https://store/1": {"1": {}}})
+
+    assert engine.search_keys == ["1:first", "2:second"]
+    assert len(redis.data["2:second:messages"]) == 2
+    assert redis.data["2:second:results"] == redis.data["1:first:results"]
+    assert redis.data["2:second:results_index"] == redis.data["1:first:results_index"]
+    engine.unsubscribe(2, "second")
+    assert engine.search_keys == ["1:first"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("failed_queries,cached", [([], True), (["DW5823e"], False)])
+async def test_only_complete_results_are_reused(monkeypatch, failed_queries, cached):
+    async def intersection(self, queries_list, resume=False):
+        self.failed_queries = failed_queries
+        return {"https://store/1": {}}
+
+    monkeypatch.setattr(SearchEngine, "intersection_in_global_search", intersection)
+    monkeypatch.setattr(SearchEngine, "save_trace", AsyncMock())
+    redis = FakeRedis()
+    active_searches = {}
+    await create_search_task(active_searches, redis, [("7260ac",), ("DW5823e",)], 1, "uuid", fingerprint="fp")
+    await active_searches["1:uuid"].task
+    # on_finish runs in its own task after the search task
+    for _ in range(100):
+        if not active_searches:
+            break
+        await asyncio.sleep(0)
+
+    assert redis.data["1:uuid:is_finished"] == "1"
+    assert (f"{FINGERPRINTS_KEY}:fp:result" in redis.data) is cached
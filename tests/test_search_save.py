@@ -0,0 +1,98 @@
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+# Imported before the application, sets default settings of the services
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401, I001
+from app.routers import search as search_router
+from app.routers.history import HISTORY_COUNT_KEY
+from app.routers.search import FINISHED_SEARCH_TTL, expire_redis_data, save_search_from_redis
+from app.services.search_results import decompress_json
+
+RESULTS = {f"https://store{index}.com": {str(index): {"sale_price": str(index)}} for index in range(3)}
+
+
+@pytest.fixture()
+def saved_stores(monkeypatch):
+    saved = []
+
+    async def save_search_stores(db, search_id, stores):
+        saved.append((search_id, stores))
+
+    monkeypatch.setattr(search_router, "save_search_stores", save_search_stores)
+    monkeypatch.setattr(search_router, "SAVE_BATCH_SIZE", 2)
+    return saved
+
+
+def make_db() -> MagicMock:
+    db = MagicMock()
+
+    async def flush():
+        db.add.call_args[0][0].id = 7
+
+    db.flush.side_effect = flush
+    db.commit = AsyncMock()
+    db.rollback = AsyncMock()
+    return db
+
+
+def make_finished_search(redis: FakeRedis):
+    redis.data["1:uuid:page_data"] = json.dumps({"names_list1": ["7260ac"], "names_list2": ["DW5823e"]})
+    redis.data["1:uuid:is_finished"] = "1"
+    redis.data["1:uuid:messages"] = ["Search started", "Search finished"]
+    redis.data["1:uuid:results"] = {store_link: json.dumps(products) for store_link, products in RESULTS.items()}
+    redis.data[f"{HISTORY_COUNT_KEY}:1"] = "3"
+
+
+@pytest.mark.anyio
+async def test_search_is_saved_from_redis(saved_stores):
+    redis = FakeRedis()
+    make_finished_search(redis)
+    db = make_db()
+    assert await save_search_from_redis(db, redis, 1, "uuid") == {"messages": "Saved successfully"}
+
+    search = db.add.call_args[0][0]
+    assert (search.uuid, search.user_id, search.names_list1) == ("uuid", 1, ["7260ac"])
+    assert decompress_json(search.messages_compressed) == ["Search started", "Search finished"]
+    assert search.results_count == 3
+    # Stores are inserted in batches of SAVE_BATCH_SIZE
+    assert [len(stores) for _, stores in saved_stores] == [2, 1]
+    assert dict(store for _, stores in saved_stores for store in stores) == RESULTS
+    db.commit.assert_awaited_once()
+    assert f"{HISTORY_COUNT_KEY}:1" not in redis.data
+
+
+@pytest.mark.anyio
+async def test_only_finished_search_is_saved_from_redis(saved_stores):
+    redis = FakeRedis()
+    db = make_db()
+    response = await save_search_from_redis(db, redis, 1, "uuid")
+    assert response == {"error": True, "messages": "Search data is not found in storage"}
+
+    make_finished_search(redis)
+    redis.data["1:uuid:is_finished"] = "0"
+    response = await save_search_from_redis(db, redis, 1, "uuid")
+    assert response == {"error": True, "messages": "Search is not finished yet"}
+    db.add.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_failed_save_from_redis_is_rolled_back(monkeypatch):
+    monkeypatch.setattr(search_router, "save_search_stores", AsyncMock(side_effect=ValueError("broken")))
+    redis = FakeRedis()
+    make_finished_search(redis)
+    db = make_db()
+    assert await save_search_from_redis(db, redis, 1, "uuid") == {"error": True, "messages": "broken"}
+    db.rollback.assert_awaited_once()
+    db.commit.assert_not_awaited()
+    assert redis.data[f"{HISTORY_COUNT_KEY}:1"] == "3"
+
+
+@pytest.mark.anyio
+async def test_finished_search_is_kept_for_saving():
+    redis = FakeRedis()
+    await expire_redis_data(redis, 1, "uuid")
+    assert redis.expires["1:uuid:results"] == FINISHED_SEARCH_TTL
+    assert redis.expires["1:uuid:page_data"] == FINISHED_SEARCH_TTL
+    assert redis.expires["1:uuid:messages"] == FINISHED_SEARCH_TTL
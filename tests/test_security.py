@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.security import PasswordHasher
+from tests.fakes import anyio_backend  # noqa: F401
+
+
+async def wait_for(condition, timeout: float = 5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Condition is not met")
+
+
+@pytest.mark.anyio
+async def test_operations_over_queue_size_are_rejected():
+    hasher = PasswordHasher(max_workers=1, queue_size=1)
+    release = threading.Event()
+    tasks = [asyncio.create_task(hasher._run(release.wait, 5)) for _ in range(2)]
+    try:
+        await wait_for(lambda: hasher.get_metrics()["pending"] == 2)
+        with pytest.raises(HTTPException) as e:
+            await hasher._run(release.wait, 5)
+        assert e.value.status_code == 503
+    finally:
+        release.set()
+    await asyncio.gather(*tasks)
+    metrics = hasher.get_metrics()
+    assert metrics["pending"] == 0
+    assert metrics["completed"] == 2
+    assert metrics["rejected"] == 1
+
+
+@pytest.mark.anyio
+async def test_cancelled_operation_is_pending_until_finished():
+    hasher = PasswordHasher(max_workers=1, queue_size=0)
+    started, release = threading.Event(), threading.Event()
+
+    def blocked():
+        started.set()
+        release.wait(5)
+
+    task = asyncio.create_task(hasher._run(blocked))
+    try:
+        await wait_for(started.is_set)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # bcrypt is still running in the thread, so the place in the pool is not free
+        assert hasher.get_metrics()["pending"] == 1
+        with pytest.raises(HTTPException):
+            await hasher._run(blocked)
+    finally:
+        release.set()
+    await wait_for(lambda: hasher.get_metrics()["pending"] == 0)
+    assert hasher.get_metrics()["completed"] == 0
+
+
+@pytest.mark.anyio
+async def test_metrics_count_only_successful_operations():
+    hasher = PasswordHasher()
+    password_hash = await hasher.hash("secret")
+    assert await hasher.verify("secret", password_hash)
+    with pytest.raises(ValueError):
+        await hasher.verify("secret", "not a hash")
+
+    metrics = hasher.get_metrics()
+    assert metrics["pending"] == 0
+    assert metrics["completed"] == 2
+    assert metrics["failed"] == 1
+    assert metrics["run_time_avg"] > 0
@@ -0,0 +1,77 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.session_pool import SessionPool, Session, SESSIONS_KEY, SEED_COOKIES
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401
+
+
+@pytest.mark.anyio
+async def test_sessions_are_leased_round_robin():
+    redis = FakeRedis()
+    pool = SessionPool()
+    created = {(await pool.lease(redis)).id for _ in range(4)}
+    assert len(created) == 4
+    leased = [(await pool.lease(redis)).id for _ in range(8)]
+    assert set(leased) == created
+    assert leased[:4] == leased[4:]
+
+
+@pytest.mark.anyio
+async def test_session_keeps_cookies_and_retires_when_challenged():
+    redis = FakeRedis()
+    pool = SessionPool()
+    session = await pool.lease(redis)
+    response = httpx.Response(200, headers={"set-cookie": "isg=new-value; Path=/"},
+                              request=httpx.Request("GET", "https://www.aliexpress.com/"))
+    await pool.release(redis, session, response)
+    stored = await redis.hget(SESSIONS_KEY, session.id)
+    assert b"new-value" in stored
+    assert SEED_COOKIES["isg"] != "new-value"
+
+    await pool.release(redis, session, challenged=True)
+    assert await redis.hget(SESSIONS_KEY, session.id) is not None
+    await pool.release(redis, session, challenged=True)
+    assert await redis.hget(SESSIONS_KEY, session.id) is None
+    assert pool.stats["retired"] == 1
+
+
+@pytest.mark.anyio
+async def test_retired_session_is_not_saved_again():
+    redis = FakeRedis()
+    pool = SessionPool()
+    session = await pool.lease(redis)
+    response = httpx.Response(200, request=httpx.Request("GET", "https://www.aliexpress.com/"))
+    await asyncio.gather(pool.release(redis, session, response), pool.retire(redis, session))
+    assert await redis.hget(SESSIONS_KEY, session.id) is None
+    await pool.release(redis, session, challenged=True)
+    assert await redis.hget(SESSIONS_KEY, session.id) is None
+    assert pool.stats["retired"] == 1
+
+
+@pytest.mark.anyio
+async def test_concurrent_releases_are_not_lost():
+    redis = FakeRedis()
+    pool = SessionPool()
+    session = await pool.lease(redis)
+
+    async def lease_copy() -> Session:
+        # Copy of the session leased by another request
+        return Session.from_json(await redis.hget(SESSIONS_KEY, session.id))
+
+    request = httpx.Request("GET", "https://www.aliexpress.com/")
+    first, second = await lease_copy(), await lease_copy()
+    await asyncio.gather(
+        pool.release(redis, first, httpx.Response(200, headers={"set-cookie": "isg=first"}, request=request)),
+        pool.release(redis, second, httpx.Response(200, headers={"set-cookie": "xman_t=second"}, request=request)),
+    )
+    stored = Session.from_json(await redis.hget(SESSIONS_KEY, session.id))
+    assert stored.requests == 2
+    assert (stored.cookies["isg"], stored.cookies["xman_t"]) == ("first", "second")
+
+    # Each of concurrent challenges is counted, the second one retires the session
+    first, second = await lease_copy(), await lease_copy()
+    await asyncio.gather(pool.release(redis, first, challenged=True), pool.release(redis, second, challenged=True))
+    assert await redis.hget(SESSIONS_KEY, session.id) is None
+    assert pool.stats["retired"] == 1
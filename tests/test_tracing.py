@@ -0,0 +1,111 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+import pytest
+
+from app.search_engine import SearchEngine
+from app.tracing import OtlpExporter, SearchTrace, to_otlp
+from tests.fakes import anyio_backend, mock_get_html  # noqa: F401
+
+session_id = "0fb9617a-1676-4f6e-8f2a-b908038fbf14"
+search_uuid = "ce4203b5-dfd7-492b-bf75-9248058537d5"
+
+
+def _names(trace: dict, spans: list) -> list[str]:
+    return [trace["names"][span[0]] for span in spans]
+
+
+@pytest.mark.anyio
+async def test_search_stages_are_nested_spans():
+    redis = AsyncMock()
+    redis.get.return_value = None
+    engine = SearchEngine(session_id, search_uuid, redis)
+    engine._get_html = MagicMock(side_effect=mock_get_html)
+    engine.max_page = 3
+    engine.enable_pause = False
+    await engine.intersection_in_global_search([("7260ac",), ("DW5823e",)])
+
+    trace = engine.trace.to_compact()
+    spans = trace["spans"]
+    assert trace["trace_id"] == search_uuid.replace("-", "")
+    assert _names(trace, [spans[0]]) == ["intersection_in_global_search"] and spans[0][1] == -1
+    queries = [span for span in spans if trace["names"][span[0]] == "collect_product_stores"]
+    assert [span[4]["search"] for span in queries] == ["7260ac", "DW5823e"]
+    assert all(span[1] == 0 for span in queries)
+
+    pages = [index for index, span in enumerate(spans) if trace["names"][span[0]] == "parse_global_search_page"]
+    assert pages and spans[pages[0]][4] == {"search": "7260ac", "page": 1}
+    children = [span for span in spans if span[1] == pages[0]]
+    assert _names(trace, children) == ["extract", "pagination", "get_script_items", "filter"]
+    for span in children:
+        assert spans[pages[0]][2] <= span[2] and span[2] + span[3] <= spans[pages[0]][2] + spans[pages[0]][3]
+
+    await engine.save_trace()
+    assert any(call.args[0] == f"{session_id}:{search_uuid}:trace" for call in redis.set.call_args_list)
+
+
+@pytest.mark.anyio
+async def test_spans_of_other_tasks_are_not_nested():
+    trace = SearchTrace(search_uuid)
+
+    started = asyncio.Event()
+
+    async def other_task():
+        # E.g. request handler which flushes messages of running search
+        await started.wait()
+        with trace.span("flush_messages"):
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(other_task())
+    with trace.span("search"):
+        with trace.span("page", page=1):
+            started.set()
+            await task
+    with pytest.raises(ValueError):
+        with trace.span("failed"):
+            raise ValueError()
+
+    assert [(name, parent) for name, parent, *_ in trace.spans] == [
+        ("search", -1), ("page", 0), ("flush_messages", -1), ("failed", -1)]
+    assert trace.spans[3][4] == {"error": "ValueError"}
+
+
+def test_otlp_request():
+    trace = SearchTrace(search_uuid)
+    with trace.span("search"):
+        with trace.span("page", page=2):
+            pass
+    request = to_otlp(trace.to_compact(), {"user.id": "1"})
+    resource_spans = request["resourceSpans"][0]
+    assert {"key": "user.id", "value": {"stringValue": "1"}} in resource_spans["resource"]["attributes"]
+    root, page = resource_spans["scopeSpans"][0]["spans"]
+    assert "parentSpanId" not in root and page["parentSpanId"] == root["spanId"]
+    assert len(page["traceId"]) == 32 and len(page["spanId"]) == 16
+    assert page["attributes"] == [{"key": "page", "value": {"intValue": "2"}}]
+    assert int(root["startTimeUnixNano"]) <= int(page["startTimeUnixNano"]) <= int(page["endTimeUnixNano"])
+
+
+@pytest.mark.anyio
+async def test_export_to_collector(monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200 if len(requests) == 1 else 503)
+
+    monkeypatch.setattr("app.tracing.get_settings", lambda: SimpleNamespace(otlp_endpoint="http://collector/v1/traces"))
+    exporter = OtlpExporter()
+    exporter._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    trace = SearchTrace(search_uuid)
+    with trace.span("search"):
+        pass
+
+    assert await exporter.export(trace.to_compact())
+    assert not await exporter.export(trace.to_compact())
+    await exporter.close()
+    assert str(requests[0].url) == "http://collector/v1/traces"
+    assert json.loads(requests[0].content)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"] == "search"
+    assert exporter.get_metrics() == {"exported": 1, "failed": 1}
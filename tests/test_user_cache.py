@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.models.models import User
+from app.services import user_cache as user_cache_module
+from app.services.user_cache import USER_CACHE_CHANNEL, USER_CACHE_KEY, UserCache
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def subscribe(self, channel):
+        pass
+
+    async def listen(self):
+        for message in self.messages:
+            yield message
+
+    async def aclose(self):
+        pass
+
+
+def make_user(username="alice") -> User:
+    return User(id=1, username=username, email=f"{username}@example.com", disabled=False)
+
+
+@pytest.mark.anyio
+async def test_cache_tiers_and_metrics():
+    redis = FakeRedis()
+    cache = UserCache(local_ttl=30)
+    assert await cache.get(redis, "alice") is None
+
+    await cache.set(redis, make_user())
+    assert "password" not in redis.data[f"{USER_CACHE_KEY}:alice"]
+    user = await cache.get(redis, "alice")
+    assert (user.id, user.username, user.disabled) == (1, "alice", False)
+
+    # Other worker has only Redis tier
+    other = UserCache()
+    assert (await other.get(redis, "alice")).email == "alice@example.com"
+    assert other.get_metrics() == {
+        "local_hits": 0, "redis_hits": 1, "misses": 0, "invalidations": 0, "hit_rate": 1.0, "local_size": 1}
+    assert cache.get_metrics()["local_hits"] == 1
+    assert cache.get_metrics()["hit_rate"] == 0.5
+
+
+@pytest.mark.anyio
+async def test_local_entry_expires():
+    redis = FakeRedis()
+    cache = UserCache(local_ttl=0)
+    await cache.set(redis, make_user())
+    await cache.get(redis, "alice")
+    assert cache.stats["local_hits"] == 0 and cache.stats["redis_hits"] == 1
+
+    await redis.delete(f"{USER_CACHE_KEY}:alice")
+    assert await cache.get(redis, "alice") is None
+
+
+@pytest.mark.anyio
+async def test_invalidation_reaches_all_workers():
+    redis = FakeRedis()
+    cache, other = UserCache(), UserCache()
+    await cache.set(redis, make_user())
+    await other.get(redis, "alice")
+
+    await cache.invalidate(redis, "alice")
+    assert f"{USER_CACHE_KEY}:alice" not in redis.data
+    assert redis.published == [(USER_CACHE_CHANNEL, "alice")]
+
+    redis.pubsub = lambda: FakePubSub([{"type": "subscribe", "data": 1}, {"type": "message", "data": b"alice"}])
+    await other.listen_invalidations(redis)
+    assert await other.get(redis, "alice") is None
+    assert cache.get_metrics()["invalidations"] == 1
+
+
+@pytest.mark.anyio
+async def test_changed_user_is_invalidated_after_commit(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(user_cache_module.RedisClient, "get_redis", lambda self: None)
+    monkeypatch.setattr(user_cache_module.user_cache, "schedule_invalidation",
+                        lambda redis, username: invalidated.append(username))
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with Session(engine) as session:
+        session.add(User(username="alice", email="alice@example.com", password="hash"))
+        session.commit()
+        user = session.query(User).one()
+
+        user.disabled = True
+        session.flush()
+        # Other sessions still read the old row, so cache is not cleared yet
+        assert invalidated == []
+        session.rollback()
+        session.commit()
+        assert invalidated == []
+
+        user.username = "bob"
+        session.commit()
+        assert sorted(invalidated) == ["alice", "bob"]
+    await asyncio.sleep(0)
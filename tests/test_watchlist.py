@@ -0,0 +1,182 @@
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+# Imported before the application, sets default settings of the services
+from tests.fakes import FakeRedis, anyio_backend  # noqa: F401, I001
+from app import watchlist_scheduler as watchlist_scheduler_module
+from app.models.models import Search, Watch, WatchDiff
+from app.search_engine import SearchEngine
+from app.services.search_results import compress_json
+from app.services.watchlist import build_snapshot, count_changed_products, diff_results, next_run_time, parse_hours
+from app.watchlist_scheduler import (
+    SCHEDULER_LOCK_KEY,
+    WATCH_CHECKPOINTS_KEY,
+    WATCH_NOTIFICATIONS_KEY,
+    WatchlistScheduler,
+)
+
+RESULTS = {
+    "store1": {"1": {"sale_price": "10.5"}, "2": {"sale_price": "3"}},
+    "store2": {"3": {"sale_price": "7"}},
+}
+
+
+def test_diff_results():
+    snapshot = build_snapshot(RESULTS)
+    assert diff_results(snapshot, RESULTS) == {
+        "added_stores": {}, "removed_stores": [], "added_products": {}, "removed_products": {}, "price_changes": {},
+    }
+    results = {
+        "store1": {"1": {"sale_price": "9.5"}, "4": {"sale_price": "1"}},
+        "store3": {"5": {"sale_price": "2"}},
+    }
+    diff = diff_results(snapshot, results)
+    assert diff["added_stores"] == {"store3": {"5": {"sale_price": "2"}}}
+    assert diff["removed_stores"] == ["store2"]
+    assert diff["added_products"] == {"store1": {"4": {"sale_price": "1"}}}
+    assert diff["removed_products"] == {"store1": ["2"]}
+    assert diff["price_changes"] == {"store1": {"1": [10.5, 9.5]}}
+    assert count_changed_products(diff) == 3
+
+
+def test_parse_hours():
+    assert parse_hours("1-6") == (1, 6)
+    assert parse_hours("22-4") == (22, 4)
+    assert parse_hours("") is None
+    assert parse_hours("night") is None
+
+
+def test_next_run_time():
+    now = datetime(2024, 5, 1, 15, 0).astimezone()
+    assert now + timedelta(hours=6) <= next_run_time(now, 6, 1) < now + timedelta(hours=6, minutes=30)
+    assert next_run_time(now, 6, 1) != next_run_time(now, 6, 2)
+
+    # Daily run is moved to the off-peak slot of the watch which is nearest to the end of the interval
+    runs = [next_run_time(now, 24, watch_id, (1, 6)) for watch_id in range(1, 20)]
+    for run in runs:
+        local = run.astimezone()
+        assert 1 <= local.hour < 6
+        assert now < run and abs(run - (now + timedelta(hours=24))) <= timedelta(hours=24)
+    assert len(set(runs)) > 1
+
+    utc_now = datetime(2024, 5, 1, 15, 0, tzinfo=timezone.utc)
+    assert next_run_time(utc_now, 24, 1, (22, 4)).astimezone().hour in (22, 23, 0, 1, 2, 3)
+
+
+class FakeSession:
+    """
+    Database session which returns one watch and records added objects and executed statements
+    """
+
+    def __init__(self, watch: Watch):
+        self.watch = watch
+        self.added = []
+        self.executed = []
+        self.commits = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def get(self, model, ident, options=None):
+        return self.watch if ident == self.watch.id else None
+
+    def add(self, instance):
+        self.added.append(instance)
+
+    async def flush(self):
+        for index, instance in enumerate(self.added, 1):
+            instance.id = index
+
+    async def execute(self, statement):
+        self.executed.append(statement)
+
+    async def commit(self):
+        self.commits += 1
+
+
+def make_watch() -> Watch:
+    search = Search(id=1, uuid="saved", names_list1=["7260ac"], names_list2=["DW5823e"])
+    return Watch(id=1, user_id=1, search_id=1, search=search, interval_hours=24,
+                 snapshot=compress_json(build_snapshot(RESULTS)))
+
+
+def patch_search(monkeypatch, results: dict, failed_queries: list = ()):
+    async def intersection(self, queries_list, resume=False):
+        self._checkpoint = {"queries_list": queries_list}
+        await self.save_checkpoint()
+        self.failed_queries = list(failed_queries)
+        return results
+
+    monkeypatch.setattr(SearchEngine, "intersection_in_global_search", intersection)
+
+
+@pytest.mark.anyio
+async def test_watch_run_saves_diff_and_notifies(monkeypatch):
+    patch_search(monkeypatch, {**RESULTS, "store3": {"5": {"sale_price": "2"}}})
+    redis = FakeRedis()
+    session = FakeSession(make_watch())
+    scheduler = WatchlistScheduler()
+    await scheduler.run_watch(redis, lambda: session, 1)
+
+    watch_diff = session.added[0]
+    assert isinstance(watch_diff, WatchDiff)
+    assert (watch_diff.added_stores, watch_diff.removed_stores, watch_diff.changed_products) == (1, 0, 0)
+    assert session.watch.next_run_at > session.watch.last_run_at
+    assert session.commits == 1
+    notification = json.loads(redis.data[f"{WATCH_NOTIFICATIONS_KEY}:1"][0])
+    assert notification["diff_id"] == watch_diff.id and notification["search_uuid"] == "saved"
+    assert "watch:1:lock" not in redis.data
+    assert not redis.data[WATCH_CHECKPOINTS_KEY]
+    assert not any(key.endswith(":checkpoint") for key in redis.data)
+    assert scheduler.get_metrics()["diffs"] == 1
+
+
+@pytest.mark.anyio
+async def test_failed_watch_run_is_postponed(monkeypatch):
+    patch_search(monkeypatch, {}, failed_queries=["DW5823e"])
+    redis = FakeRedis()
+    session = FakeSession(make_watch())
+    scheduler = WatchlistScheduler()
+    await scheduler.run_watch(redis, lambda: session, 1)
+
+    assert not session.added
+    update = session.executed[0].compile(dialect=postgresql.dialect())
+    assert str(update).startswith("UPDATE watches SET next_run_at")
+    assert update.params["next_run_at"] > datetime.now().astimezone() + timedelta(minutes=30)
+    assert f"{WATCH_NOTIFICATIONS_KEY}:1" not in redis.data
+    assert "watch:1:lock" not in redis.data
+    assert not redis.data[WATCH_CHECKPOINTS_KEY]
+    assert not any(key.endswith(":checkpoint") for key in redis.data)
+    assert scheduler.get_metrics()["failed"] == 1
+
+
+@pytest.mark.anyio
+async def test_watches_are_run_by_one_scheduler(monkeypatch):
+    run_watch = AsyncMock()
+    monkeypatch.setattr(WatchlistScheduler, "run_watch", run_watch)
+    monkeypatch.setattr(watchlist_scheduler_module, "get_due_watches", AsyncMock(return_value=[1]))
+    redis = FakeRedis()
+    session = FakeSession(make_watch())
+    other, scheduler = WatchlistScheduler(), WatchlistScheduler()
+
+    await redis.set(SCHEDULER_LOCK_KEY, other.id)
+    await scheduler.run_due(redis, lambda: session, 1)
+    run_watch.assert_not_called()
+    assert scheduler.get_metrics()["skipped"] == 1
+
+    # Checkpoint of the run interrupted by stop of the previous scheduler is deleted
+    await redis.delete(SCHEDULER_LOCK_KEY)
+    await redis.set("1:interrupted:checkpoint", "{}")
+    await redis.sadd(WATCH_CHECKPOINTS_KEY, "1:interrupted")
+    await scheduler.run_due(redis, lambda: session, 1)
+    run_watch.assert_called_once()
+    assert SCHEDULER_LOCK_KEY not in redis.data
+    assert "1:interrupted:checkpoint" not in redis.data
+    assert WATCH_CHECKPOINTS_KEY not in redis.data